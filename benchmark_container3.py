@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the Container storage datatypes under add, remove and updatekeys churn.
+Every node has a unique key and a shared key grouping group_size nodes, as flows of a host.
+
+With --memory, measure the memory per node of ContainerNode subclasses with a named logger and a
+Container, against LightContainerNode subclasses and a compact Container.
+
+With --threads, measure the throughput of a mixed workload of lookups, adds and removes from
+threads, on a Container behind a global lock and on a ConcurrentContainer.
+
+Usage: benchmark_container3.py [--nodes 100000] [--group-size 1000] [--datatypes list set ordered]
+       benchmark_container3.py --threads 1 2 4 8 [--nodes 100000] [--stripes 64]
+       benchmark_container3.py --memory 1000000
+"""
+
+import argparse
+import gc
+import logging
+import threading
+import time
+import tracemalloc
+
+import container3
+
+class BenchmarkNode(container3.ContainerNode):
+    """ Node with a unique name and a shared host key """
+
+    def __init__(self, name, host):
+        # Skip the per node logger of ContainerNode
+        self._name = name
+        self.host = host
+
+    def lookupkeys(self):
+        return ((self._name, True), (self.host, False))
+
+class ClassicNode(container3.ContainerNode):
+    """ Node with a named logger and a __dict__ """
+
+    def __init__(self, name, host):
+        # ContainerNode.__init__ without setLevel, which walks every logger for each node
+        self._logger = logging.getLogger('flow{}'.format(name))
+        self._name = name
+        self.host = host
+
+    def lookupkeys(self):
+        return ((self._name, True), (self.host, False))
+
+class LightNode(container3.LightContainerNode):
+    """ Node with the shared logger and slots """
+    __slots__ = ('host', )
+
+    def __init__(self, name, host):
+        super().__init__(name)
+        self.host = host
+
+    def lookupkeys(self):
+        return ((self._name, True), (self.host, False))
+
+def measure(name, func, ops):
+    """ Run func and return a tuple of (name, ops, total seconds) """
+    start = time.perf_counter()
+    func()
+    return (name, ops, time.perf_counter() - start)
+
+def run(datatype, n, group_size, churn):
+    """ Return the measurements of a datatype with n nodes """
+    results = []
+    groups = max(1, n // group_size)
+    nodes = [BenchmarkNode(i, 'host{}'.format(i % groups)) for i in range(n)]
+    ct = container3.Container(datatype=datatype)
+    def _add():
+        for node in nodes:
+            ct.add(node)
+    results.append(measure('add', _add, n))
+    # Move churn nodes to another host and back
+    moved = nodes[:churn]
+    def _updatekeys():
+        for node in moved:
+            node.host = 'host{}'.format((int(node.host[4:]) + 1) % groups)
+            ct.updatekeys(node)
+    results.append(measure('updatekeys', _updatekeys, len(moved)))
+    # Remove and add again churn nodes
+    def _churn():
+        for node in moved:
+            ct.remove(node, callback=False)
+        for node in moved:
+            ct.add(node)
+    results.append(measure('remove+add', _churn, 2 * len(moved)))
+    def _lookup():
+        for node in nodes:
+            ct.lookup(node._name, update=False, check_expire=False)
+    results.append(measure('lookup', _lookup, n))
+    def _remove():
+        for node in nodes:
+            ct.remove(node, callback=False)
+    results.append(measure('remove', _remove, n))
+    results.append(measure('add_many', lambda: ct.add_many(nodes), n))
+    results.append(measure('remove_many', lambda: ct.remove_many(nodes, callback=False), n))
+    return results
+
+def run_threads(ct, lock, nthreads, n, group_size):
+    """ Return the operations per second of nthreads sharing ct, lock wraps every call if not None """
+    groups = max(1, n // group_size)
+    per_thread = n // nthreads
+    def _work(t):
+        nodes = [BenchmarkNode((t, i), 'host{}'.format(i % groups)) for i in range(per_thread)]
+        # Every node is added, looked up 4 times and removed
+        for node in nodes:
+            if lock:
+                with lock:
+                    ct.add(node)
+            else:
+                ct.add(node)
+        for _ in range(4):
+            for node in nodes:
+                if lock:
+                    with lock:
+                        ct.lookup(node._name, update=False, check_expire=False)
+                else:
+                    ct.lookup(node._name, update=False, check_expire=False)
+        for node in nodes:
+            if lock:
+                with lock:
+                    ct.remove(node, callback=False)
+            else:
+                ct.remove(node, callback=False)
+    threads = [threading.Thread(target=_work, args=(t, )) for t in range(nthreads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return 6 * per_thread * nthreads / (time.perf_counter() - start)
+
+def run_memory(cls, compact, n, group_size):
+    """ Return the traced bytes per node of n nodes of cls in a Container """
+    groups = max(1, n // group_size)
+    hosts = ['host{}'.format(i) for i in range(groups)]
+    gc.collect()
+    tracemalloc.start()
+    ct = container3.Container(datatype='set', compact=compact)
+    ct.add_many(cls(i, hosts[i % groups]) for i in range(n))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / n
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the Container datatypes')
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--group-size', type=int, default=1000, help='Nodes per shared key')
+    parser.add_argument('--churn', type=int, default=10000, help='Nodes moved or re-added')
+    parser.add_argument('--datatypes', nargs='+', default=['list', 'set', 'ordered'])
+    parser.add_argument('--threads', type=int, nargs='+', help='Thread counts of the concurrent benchmark')
+    parser.add_argument('--stripes', type=int, default=64, help='Locks of the ConcurrentContainer')
+    parser.add_argument('--memory', type=int, help='Nodes of the memory benchmark')
+    args = parser.parse_args()
+    if args.memory:
+        print('{:<40} {:>12}'.format('design', 'bytes/node'))
+        for (name, cls, compact) in (('LightContainerNode, compact Container', LightNode, True),
+                                     ('LightContainerNode, Container', LightNode, False),
+                                     ('ContainerNode with logger, Container', ClassicNode, False)):
+            print('{:<40} {:>12.1f}'.format(name, run_memory(cls, compact, args.memory, args.group_size)))
+        return
+    if args.threads:
+        print('{:>8} {:>16} {:>16}'.format('threads', 'global lock', 'striped'))
+        for nthreads in args.threads:
+            locked = run_threads(container3.Container(), threading.Lock(), nthreads, args.nodes, args.group_size)
+            striped = run_threads(container3.ConcurrentContainer(stripes=args.stripes), None, nthreads, args.nodes, args.group_size)
+            print('{:>8} {:>16.0f} {:>16.0f}'.format(nthreads, locked, striped))
+        return
+    print('{:<8} {:<12} {:>8} {:>12} {:>12}'.format('datatype', 'operation', 'ops', 'usec/op', 'ops/sec'))
+    for datatype in args.datatypes:
+        for (name, ops, elapsed) in run(datatype, args.nodes, args.group_size, min(args.churn, args.nodes)):
+            print('{:<8} {:<12} {:>8} {:>12.2f} {:>12.0f}'.format(datatype, name, ops, elapsed / ops * 1e6, ops / elapsed))
+
+if __name__ == '__main__':
+    main()
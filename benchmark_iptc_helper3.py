@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the hot paths of iptc_helper3 at growing chain sizes.
+The memory backend runs on any box, the iptc and restore backends require root.
+
+Usage: benchmark_iptc_helper3.py [--backend memory] [--sizes 1000 10000 100000] [--ops 200]
+"""
+
+import argparse
+import ipaddress
+import time
+
+import iptc_helper3
+
+TABLE = 'filter'
+CHAIN = 'BENCHMARK'
+
+def make_rule(n):
+    """ Return a distinct rule_d for every n """
+    src = str(ipaddress.IPv4Address(0x0A000000 + n))
+    return {'src': src, 'protocol': 'tcp', 'tcp': {'dport': str(n % 65535 + 1)}, 'target': 'ACCEPT'}
+
+def measure(name, func, ops):
+    """ Run func ops times and return a tuple of (name, ops, total seconds) """
+    start = time.perf_counter()
+    for i in range(ops):
+        func(i)
+    return (name, ops, time.perf_counter() - start)
+
+def run(size, ops):
+    """ Return the measurements at a chain of size rules """
+    results = []
+    iptc_helper3.add_chain(TABLE, CHAIN, silent=True)
+    iptc_helper3.flush_chain(TABLE, CHAIN)
+    rules = [(CHAIN, make_rule(i), 0) for i in range(size)]
+    results.append(measure('batch_add_rules', lambda i: iptc_helper3.batch_add_rules(TABLE, rules), 1))
+    # Rules beyond the populated range are new
+    new_rules = [make_rule(size + i) for i in range(ops)]
+    results.append(measure('add_rule', lambda i: iptc_helper3.add_rule(TABLE, CHAIN, new_rules[i]), ops))
+    # Cold lookups rebuild the index of the chain, which is kept for the next lookups
+    def _cold(i):
+        iptc_helper3.refresh(TABLE)
+        iptc_helper3.has_rule(TABLE, CHAIN, make_rule(i))
+    results.append(measure('has_rule (cold)', _cold, max(1, ops // 100)))
+    results.append(measure('has_rule (hit)', lambda i: iptc_helper3.has_rule(TABLE, CHAIN, make_rule(i * size // ops)), ops))
+    results.append(measure('has_rule (miss)', lambda i: iptc_helper3.has_rule(TABLE, CHAIN, make_rule(2 * size + i)), ops))
+    results.append(measure('dump_table', lambda i: iptc_helper3.dump_table(TABLE), max(1, ops // 100)))
+    results.append(measure('delete_rule', lambda i: iptc_helper3.delete_rule(TABLE, CHAIN, new_rules[i]), ops))
+    batch = [(CHAIN, rule_d) for rule_d in new_rules]
+    results.append(measure('batch_add_rules (ops)', lambda i: iptc_helper3.batch_add_rules(TABLE, [r + (0, ) for r in batch]), 1))
+    results.append(measure('batch_delete_rules (ops)', lambda i: iptc_helper3.batch_delete_rules(TABLE, batch, silent=False), 1))
+    iptc_helper3.flush_chain(TABLE, CHAIN)
+    iptc_helper3.delete_chain(TABLE, CHAIN)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of iptc_helper3')
+    parser.add_argument('--backend', default='memory', choices=('memory', 'restore', 'iptc'))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--ops', type=int, default=200, help='Operations per measurement')
+    args = parser.parse_args()
+    iptc_helper3.set_backend(args.backend)
+    print('{:>8} {:<26} {:>8} {:>12} {:>12}'.format('rules', 'operation', 'ops', 'usec/op', 'ops/sec'))
+    for size in args.sizes:
+        for (name, ops, elapsed) in run(size, args.ops):
+            print('{:>8} {:<26} {:>8} {:>12.1f} {:>12.0f}'.format(size, name, ops, elapsed / ops * 1e6, ops / elapsed))
+
+if __name__ == '__main__':
+    main()
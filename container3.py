@@ -36,20 +36,46 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 # This module defines a generic Container class and ContainerNode unit
 
+import asyncio
+import bisect
+import collections
+import heapq
+import itertools
 import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
 
 LOGLEVELCONTAINER = logging.INFO
 LOGLEVELNODE = logging.INFO
 
+# Snapshot file header, and chunk header of (number of nodes, length of the pickled keys)
+SNAPSHOT_MAGIC = b'CTNRSNP2'
+SNAPSHOT_CHUNK = 1024
+_SNAPSHOT_HEADER = struct.Struct('!II')
+
 
 class Container(object):
 
-    def __init__(self, name='Container', loglevel=LOGLEVELCONTAINER, datatype='set'):
+    def __init__(self, name='Container', loglevel=LOGLEVELCONTAINER, datatype='set', maxsize=None, eviction='lru', compact=False):
         """
         Initialize the Container.
-        Added datatype parameter to select from list or set.
+        Added datatype parameter to select from list, set or ordered.
             Use set for higher performance
             Use list for preserving insertion order
+            Use ordered for preserving insertion order with the performance of set
+        Added maxsize parameter to bound the number of nodes, evicting one node per add beyond it.
+        Added eviction parameter to select the evicted node.
+            Use lru for the least recently added or looked up node
+            Use lfu for the least frequently looked up node, the oldest one among equals
+            Use expiry for the node with the earliest deadline, the oldest one without deadline otherwise
+        Nodes declaring indexkeys() are registered in sorted indexes for lookup_range() and lookup_prefix().
+        Added compact parameter to store the registered keys of a node as a flat tuple, sharing the unique flags.
+        The nodes of a snapshot() are restored with load(), each node is unpickled on its first lookup.
+        The add, remove, updatekeys and expire events are sent to subscribe() callbacks and events() iterators.
         """
         self._version = 0.7
         self._logger = logging.getLogger(name)
@@ -57,20 +83,48 @@ class Container(object):
         self._name = name
         self._dict = {}             # Indexes lookup keys to nodes
         self._dict_id2keys = {}     # Indexes node ids to registered keys
+        self._indexes = {}          # Indexes index names to _SortedIndex of ordered keys
+        self._dict_id2indexkeys = {}  # Indexes node ids to registered index keys
+        self._heap = []             # Stores (deadline, seq, node) of the nodes with a deadline
+        self._heap_seq = itertools.count()
+        self._sweeper = None        # Asyncio task expiring the nodes
+        self._compact = compact
+        self._key_flags = {}        # Interns the unique flags of the compact keys
+        self._lazy = 0              # Number of loaded nodes not yet unpickled
+        self._observers = []        # Callbacks of the node events
 
         if datatype == 'list':
             self._nodes = []         # Stores a list of indexed nodes
             self._gen_datatype = lambda: []
             self._add_datatype = lambda x,data: x.append(data)
             self._remove_datatype = lambda x,data: x.remove(data)
+            self._extend_datatype = lambda x,data: x.extend(data)
         elif datatype == 'set':
             self._nodes = set()      # Stores a set of indexed nodes
             self._gen_datatype = lambda: set()
             self._add_datatype = lambda x,data: x.add(data)
             self._remove_datatype = lambda x,data: x.remove(data)
+            self._extend_datatype = lambda x,data: x.update(data)
+        elif datatype == 'ordered':
+            self._nodes = {}         # Stores an insertion ordered dict of indexed nodes to None
+            self._gen_datatype = lambda: {}
+            self._add_datatype = lambda x,data: x.__setitem__(data, None)
+            self._remove_datatype = lambda x,data: x.__delitem__(data)
+            self._extend_datatype = lambda x,data: x.update(dict.fromkeys(data))
         else:
             raise Exception('Datatype "{}" not supported!'.format(datatype))
 
+        if eviction not in ('lru', 'lfu', 'expiry'):
+            raise Exception('Eviction "{}" not supported!'.format(eviction))
+        self._maxsize = maxsize
+        self._eviction = eviction
+        self._lru = collections.OrderedDict()   # Indexes node ids to nodes in order of use
+        self._lfu_count = {}                    # Indexes node ids to lookup frequency
+        self._lfu_buckets = {}                  # Indexes lookup frequency to OrderedDict of node ids to nodes
+        self._lfu_min = 0
+        self.evictions = 0          # Number of nodes evicted due to maxsize
+        self.expirations = 0        # Number of nodes removed by expire()
+
     def _add_lookupkeys(self, node, keys):
         for key, isunique in keys:
             # The key is not unique - create a storage of items for key
@@ -89,7 +143,8 @@ class Container(object):
         for key, isunique in keys:
             # The key is not unique - remove from stored items for key
             if not isunique:
-                self._logger.debug('Removed shared key {} of node {}'.format(key, node))
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug('Removed shared key %s of node %s', key, node)
                 self._remove_datatype(self._dict[key], node)
                 # The storage has no more items, remove it
                 if len(self._dict[key]) == 0:
@@ -99,7 +154,8 @@ class Container(object):
                 raise KeyError('Failed to remove: key {} does not exists for node {}'.format(key, node))
             # Add the unique key to the dictionary
             else:
-                self._logger.debug('Removed unique key {} of node {}'.format(key, node))
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug('Removed unique key %s of node %s', key, node)
                 del self._dict[key]
 
     def add(self, node):
@@ -108,6 +164,16 @@ class Container(object):
 
         @param node: The node
         """
+        self._add(node)
+        if self._observers:
+            self._notify('add', node)
+        if self._maxsize is not None:
+            # Evict a node other than the new one, after its add event
+            if len(self._dict_id2keys) > self._maxsize:
+                self._evict()
+            self._track(node)
+
+    def _add(self, node):
         if node in self._nodes:
             raise Exception('Failed to add: node already exists {}'.format(node))
 
@@ -115,10 +181,15 @@ class Container(object):
         keys = node.lookupkeys()
         self._add_lookupkeys(node, keys)
         # Map node id to lookup keys
-        self._dict_id2keys[id(node)] = keys
+        self._dict_id2keys[id(node)] = self._pack_keys(keys)
+        # Register node index keys
+        self._add_indexkeys(node, node.indexkeys())
         # Add node to the storage
         self._add_datatype(self._nodes, node)
-        self._logger.debug('Added node {}'.format(node))
+        # Schedule node expiration
+        self._schedule(node)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Added node %s', node)
 
     def get(self, key, update=False):
         """
@@ -129,15 +200,22 @@ class Container(object):
         @return: The node node or KeyError if not found
         """
         node = self._dict[key]
+        if self._lazy and self._materialize_key(key):
+            node = self._dict[key]
         if update and isinstance(node, ContainerNode):
             node.update()
+        if self._maxsize is not None and isinstance(node, ContainerNode):
+            self._touch(node)
         return node
 
     def getall(self):
         """
         Returns a shallow copy of the internal storage
         """
-        return list(self._nodes)
+        nodes = list(self._nodes)
+        if self._lazy:
+            nodes = self._materialize_all(nodes)
+        return nodes
 
     def has(self, key, check_expire=True):
         """
@@ -169,12 +247,16 @@ class Container(object):
         """
         try:
             node = self._dict[key]
+            if self._lazy and self._materialize_key(key):
+                node = self._dict[key]
             if not isinstance(node, ContainerNode):
                 return node
             if check_expire and node.hasexpired():
                 self.remove(node)
             if update:
                 node.update()
+            if self._maxsize is not None:
+                self._touch(node)
             return node
         except KeyError:
             return None
@@ -185,31 +267,54 @@ class Container(object):
 
         @param node: The node
         """
-        # Remove node lookup keys
-        keys = node.lookupkeys()
-        self._remove_lookupkeys(node, keys)
+        self._remove(node)
+        if self._observers:
+            self._notify('remove', node)
+        # Evaluate callback to ContainerNode item
+        if callback:
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug('Delete callback for node %s', node)
+            node.delete()
+
+    def _remove(self, node):
+        # Remove node registered lookup keys, they differ from lookupkeys() if updatekeys() is pending
+        keys = self._dict_id2keys.get(id(node))
+        if keys is None:
+            raise KeyError('Failed to remove: node does not exist {}'.format(node))
+        self._remove_lookupkeys(node, self._unpack_keys(keys))
         # Remove map node id to lookup keys
         del self._dict_id2keys[id(node)]
+        # Remove node index keys
+        self._remove_indexkeys(node)
         # Remove node from the storage
         self._remove_datatype(self._nodes, node)
-        self._logger.debug('Removed node {}'.format(node))
-        # Evaluate callback to ContainerNode item
-        if callback:
-            self._logger.debug('Delete callback for node {}'.format(node))
-            node.delete()
+        if self._maxsize is not None:
+            self._untrack(node)
+        if type(node) is _SnapshotNode:
+            self._lazy -= 1
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Removed node %s', node)
 
     def removeall(self, callback=True):
         # Iterate all nodes in the storage and remove them
-        for node in self.getall():
+        for node in list(self._nodes):
             self.remove(node, callback)
         # Sanity clear
         self._dict_id2keys.clear()
         self._dict.clear()
+        self._dict_id2indexkeys.clear()
+        self._indexes.clear()
         self._nodes.clear()
+        self._heap.clear()
+        self._lru.clear()
+        self._lfu_count.clear()
+        self._lfu_buckets.clear()
+        self._key_flags.clear()
+        self._lazy = 0
 
     def updatekeys(self, node):
         # Get lookup keys
-        old_keys = self._dict_id2keys[id(node)]
+        old_keys = self._unpack_keys(self._dict_id2keys[id(node)])
         new_keys = node.lookupkeys()
         # Remove previous keys
         self._remove_lookupkeys(node, old_keys)
@@ -218,8 +323,407 @@ class Container(object):
         # Register node lookup keys
         self._add_lookupkeys(node, new_keys)
         # Map node id to lookup keys
-        self._dict_id2keys[id(node)] = new_keys
-        self._logger.debug('Updated keys for node {}'.format(node))
+        self._dict_id2keys[id(node)] = self._pack_keys(new_keys)
+        # Register node index keys
+        self._remove_indexkeys(node)
+        self._add_indexkeys(node, node.indexkeys())
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Updated keys for node %s', node)
+        if self._observers:
+            self._notify('updatekeys', node)
+
+    def add_many(self, nodes):
+        """
+        Add multiple ContainerNodes to the Container.
+        All the lookup keys are checked first, no node is added if any of them collides.
+
+        @param nodes: The iterable of nodes
+        """
+        nodes = list(nodes)
+        ids = [id(node) for node in nodes]
+        if len(set(ids)) != len(ids) or not self._dict_id2keys.keys().isdisjoint(ids):
+            raise Exception('Failed to add: node already exists in {} nodes'.format(len(nodes)))
+        keys_list = [node.lookupkeys() for node in nodes]
+        self._check_lookupkeys(keys_list)
+        # Register all the nodes without further checks, shared keys are added by groups
+        _dict = self._dict
+        shared = collections.defaultdict(list)
+        for node, keys in zip(nodes, keys_list):
+            for key, isunique in keys:
+                if isunique:
+                    _dict[key] = node
+                else:
+                    shared[key].append(node)
+        for key, group in shared.items():
+            if key not in _dict:
+                _dict[key] = self._gen_datatype()
+            self._extend_datatype(_dict[key], group)
+        if self._compact:
+            self._dict_id2keys.update(zip(ids, map(self._pack_keys, keys_list)))
+        else:
+            self._dict_id2keys.update(zip(ids, keys_list))
+        # Register index keys by index, large groups are merged in a single sort
+        indexed = collections.defaultdict(list)
+        for node in nodes:
+            indexkeys = node.indexkeys()
+            if indexkeys:
+                self._dict_id2indexkeys[id(node)] = indexkeys
+                for index, key in indexkeys:
+                    indexed[index].append((key, node))
+        for index, entries in indexed.items():
+            if index not in self._indexes:
+                self._indexes[index] = _SortedIndex()
+            self._indexes[index].extend(entries)
+        self._extend_datatype(self._nodes, nodes)
+        for node in nodes:
+            self._schedule(node)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Added %s nodes', len(nodes))
+        if self._maxsize is not None:
+            for node in nodes:
+                self._track(node)
+        # Observers get the add of every node before the remove of the evicted ones, load() sends a single event
+        if self._observers:
+            for node in nodes:
+                if type(node) is not _SnapshotNode:
+                    self._notify('add', node)
+        if self._maxsize is not None:
+            for _ in range(len(self._dict_id2keys) - self._maxsize):
+                self._evict()
+
+    def remove_many(self, nodes, callback=True):
+        """
+        Remove multiple nodes from the Container.
+        All the nodes are checked first, no node is removed if any of them is not in the Container.
+        The delete callbacks run in a batch once all the nodes are removed.
+
+        @param nodes: The iterable of nodes
+        """
+        nodes = list(nodes)
+        ids = set()
+        for node in nodes:
+            if id(node) not in self._dict_id2keys or id(node) in ids:
+                raise KeyError('Failed to remove: node does not exist {}'.format(node))
+            ids.add(id(node))
+        _dict = self._dict
+        _remove_datatype = self._remove_datatype
+        for node in nodes:
+            for key, isunique in self._unpack_keys(self._dict_id2keys.pop(id(node))):
+                if isunique:
+                    del _dict[key]
+                    continue
+                storage = _dict[key]
+                _remove_datatype(storage, node)
+                if len(storage) == 0:
+                    del _dict[key]
+            self._remove_indexkeys(node)
+            if self._maxsize is not None:
+                self._untrack(node)
+            if type(node) is _SnapshotNode:
+                self._lazy -= 1
+        # Remove the nodes from the storage in a single pass
+        if isinstance(self._nodes, set):
+            self._nodes.difference_update(nodes)
+        elif isinstance(self._nodes, dict):
+            for node in nodes:
+                del self._nodes[node]
+        else:
+            self._nodes[:] = [node for node in self._nodes if id(node) not in ids]
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Removed %s nodes', len(nodes))
+        if self._observers:
+            for node in nodes:
+                self._notify('remove', node)
+        if callback:
+            for node in nodes:
+                node.delete()
+
+    def updatekeys_many(self, nodes):
+        """
+        Update the lookup keys of multiple nodes of the Container.
+        All the new lookup keys are checked first, no keys are updated if any of them collides.
+
+        @param nodes: The iterable of nodes
+        """
+        nodes = list(nodes)
+        for node in nodes:
+            if id(node) not in self._dict_id2keys:
+                raise KeyError('Failed to update: node does not exist {}'.format(node))
+        old_keys_list = [self._unpack_keys(self._dict_id2keys[id(node)]) for node in nodes]
+        new_keys_list = [node.lookupkeys() for node in nodes]
+        # Unique keys of the nodes are released before registering the new ones
+        released = {key for keys in old_keys_list for (key, isunique) in keys if isunique}
+        self._check_lookupkeys(new_keys_list, released)
+        for node, old_keys in zip(nodes, old_keys_list):
+            self._remove_lookupkeys(node, old_keys)
+        for node, new_keys in zip(nodes, new_keys_list):
+            self._add_lookupkeys(node, new_keys)
+            self._dict_id2keys[id(node)] = self._pack_keys(new_keys)
+            self._remove_indexkeys(node)
+            self._add_indexkeys(node, node.indexkeys())
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Updated keys for %s nodes', len(nodes))
+        if self._observers:
+            for node in nodes:
+                self._notify('updatekeys', node)
+
+    def _pack_keys(self, keys):
+        """ Return the registered form of the lookup keys, (flags, key1, key2...) in compact mode """
+        if not self._compact:
+            return keys
+        flags = tuple([isunique for (key, isunique) in keys])
+        flags = self._key_flags.setdefault(flags, flags)
+        return (flags, ) + tuple([key for (key, isunique) in keys])
+
+    def _unpack_keys(self, keys):
+        """ Return the lookup keys of their registered form """
+        if not self._compact:
+            return keys
+        return tuple(zip(keys[1:], keys[0]))
+
+    def _check_lookupkeys(self, keys_list, released=()):
+        """ Raise KeyError if any of the lookup keys of multiple nodes collides, ignoring the released unique keys """
+        unique = [key for keys in keys_list for (key, isunique) in keys if isunique]
+        shared = {key for keys in keys_list for (key, isunique) in keys if not isunique}
+        unique_set = set(unique)
+        if len(unique_set) != len(unique) or not unique_set.isdisjoint(shared):
+            raise KeyError('Failed to add: duplicated keys in {} nodes'.format(len(keys_list)))
+        for key in (self._dict.keys() & unique_set).difference(released):
+            raise KeyError('Failed to add: key {} already exists for node {}'.format(key, self._dict[key]))
+        for key in shared.difference(released):
+            if isinstance(self._dict.get(key), ContainerNode):
+                raise KeyError('Failed to add: key {} already exists for node {}'.format(key, self._dict[key]))
+
+    def lookup_range(self, index, low=None, high=None):
+        """
+        Look up the nodes with an index key between low and high in O(log n + k).
+
+        @param index: The name of the index.
+        @param low: The lowest key included, or None for no lower bound.
+        @param high: The highest key included, or None for no upper bound.
+        @return: The list of nodes in key order.
+        """
+        if index not in self._indexes:
+            return []
+        nodes = self._indexes[index].range(low, high)
+        if self._lazy:
+            nodes = self._materialize_all(nodes)
+        return nodes
+
+    def lookup_prefix(self, index, prefix):
+        """
+        Look up the nodes with a tuple or string index key starting with prefix in O(log n + k).
+
+        @param index: The name of the index.
+        @param prefix: The leading elements of the key.
+        @return: The list of nodes in key order.
+        """
+        if index not in self._indexes:
+            return []
+        nodes = self._indexes[index].prefix(prefix)
+        if self._lazy:
+            nodes = self._materialize_all(nodes)
+        return nodes
+
+    def _add_indexkeys(self, node, indexkeys):
+        if not indexkeys:
+            return
+        self._dict_id2indexkeys[id(node)] = indexkeys
+        for index, key in indexkeys:
+            if index not in self._indexes:
+                self._indexes[index] = _SortedIndex()
+            self._indexes[index].add(key, node)
+
+    def _remove_indexkeys(self, node):
+        indexkeys = self._dict_id2indexkeys.pop(id(node), None)
+        if not indexkeys:
+            return
+        for index, key in indexkeys:
+            self._indexes[index].remove(key, node)
+
+    def subscribe(self, callback):
+        """
+        Register a callback(event, node) of the add, remove, updatekeys and expire events.
+        The callback runs synchronously in the thread changing the Container.
+        Evicted nodes send a remove event.
+        load() sends a single ('load', None) event instead of the add of every node, which would unpickle them.
+        """
+        self._observers.append(callback)
+
+    def unsubscribe(self, callback):
+        """ Unregister a callback of the events """
+        self._observers.remove(callback)
+
+    def events(self, maxsize=1024):
+        """
+        Return a ContainerEvents async iterator of the coalesced events, see ContainerEvents.
+        Must be called from the running event loop of the consumer.
+
+        @param maxsize: The number of nodes with pending events before overflowing.
+        """
+        return ContainerEvents(self, maxsize)
+
+    def _notify(self, event, node):
+        # Observers get the unpickled loaded nodes
+        if type(node) is _SnapshotNode:
+            node = node.node()
+        for callback in list(self._observers):
+            callback(event, node)
+
+    def reschedule(self, node):
+        """
+        Schedule the expiration of a node at its current deadline.
+        Only required when the deadline is brought forward, later deadlines are picked up by expire()
+        """
+        self._schedule(node)
+
+    def expire(self, now=None, callback=True):
+        """
+        Remove the nodes whose deadline is due in O(expired log n).
+        The delete callbacks run in a batch once all the due nodes are removed.
+
+        @param now: The current time, defaults to time.time()
+        @param callback: If activated, call delete() of the expired nodes.
+        @return: The list of expired nodes
+        """
+        if now is None:
+            now = time.time()
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, _, node = heapq.heappop(heap)
+            # The heap holds a reference to the node, its id cannot be reused by another node
+            if id(node) not in self._dict_id2keys:
+                continue
+            deadline = node.deadline()
+            if deadline is None:
+                continue
+            elif deadline > now:
+                # The deadline was extended
+                heapq.heappush(heap, (deadline, next(self._heap_seq), node))
+                continue
+            self._remove(node)
+            expired.append(node)
+        self.expirations += len(expired)
+        if expired and self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Expired %s nodes', len(expired))
+        # The loaded nodes are unpickled for the callbacks
+        expired = [node.node() if type(node) is _SnapshotNode else node for node in expired]
+        if self._observers:
+            for node in expired:
+                self._notify('expire', node)
+        if callback:
+            for node in expired:
+                node.delete()
+        return expired
+
+    def stats(self):
+        """ Return a dictionary with the size, maxsize, evictions and expirations of the Container """
+        return {'size': len(self), 'maxsize': self._maxsize, 'eviction': self._eviction,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+    def start_sweeper(self, interval=1.0):
+        """
+        Start an asyncio task that expires the due nodes, must be called from the running event loop.
+        The task wakes up at the earliest deadline, or at least every interval seconds.
+        """
+        if self._sweeper is None:
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep(interval))
+        return self._sweeper
+
+    def stop_sweeper(self):
+        """ Stop the asyncio task that expires the due nodes """
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    async def _sweep(self, interval):
+        while True:
+            self.expire()
+            timeout = interval
+            if self._heap:
+                timeout = min(interval, max(0, self._heap[0][0] - time.time()))
+            await asyncio.sleep(timeout)
+
+    def _track(self, node):
+        """ Register a new node for eviction """
+        if self._eviction == 'lfu':
+            self._lfu_count[id(node)] = 1
+            self._lfu_buckets.setdefault(1, collections.OrderedDict())[id(node)] = node
+            self._lfu_min = 1
+        else:
+            self._lru[id(node)] = node
+
+    def _untrack(self, node):
+        """ Unregister a removed node for eviction """
+        if self._eviction == 'lfu':
+            count = self._lfu_count.pop(id(node), None)
+            if count is None:
+                return
+            bucket = self._lfu_buckets[count]
+            del bucket[id(node)]
+            if not bucket:
+                del self._lfu_buckets[count]
+        else:
+            self._lru.pop(id(node), None)
+
+    def _touch(self, node):
+        """ Register a lookup of a node for eviction """
+        if self._eviction == 'lru':
+            if id(node) in self._lru:
+                self._lru.move_to_end(id(node))
+        elif self._eviction == 'lfu':
+            count = self._lfu_count.get(id(node))
+            if count is None:
+                return
+            bucket = self._lfu_buckets[count]
+            del bucket[id(node)]
+            if not bucket:
+                del self._lfu_buckets[count]
+                if self._lfu_min == count:
+                    self._lfu_min = count + 1
+            self._lfu_count[id(node)] = count + 1
+            self._lfu_buckets.setdefault(count + 1, collections.OrderedDict())[id(node)] = node
+
+    def _evict(self):
+        """ Remove one node according to the eviction policy and call its delete() """
+        node = self._victim()
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Evicted node %s', node)
+        self.evictions += 1
+        self.remove(node, callback=True)
+
+    def _victim(self):
+        """ Return the node to evict according to the eviction policy """
+        node = None
+        if self._eviction == 'lfu':
+            if self._lfu_min not in self._lfu_buckets:
+                # Removals emptied the least frequency bucket
+                self._lfu_min = min(self._lfu_buckets)
+            node = next(iter(self._lfu_buckets[self._lfu_min].values()))
+        elif self._eviction == 'expiry':
+            while self._heap and node is None:
+                deadline, _, _node = heapq.heappop(self._heap)
+                if id(_node) not in self._dict_id2keys:
+                    continue
+                _deadline = _node.deadline()
+                if _deadline is not None and _deadline > deadline:
+                    heapq.heappush(self._heap, (_deadline, next(self._heap_seq), _node))
+                elif _deadline is not None:
+                    node = _node
+        if node is None:
+            node = next(iter(self._lru.values()))
+        return node
+
+    def _schedule(self, node):
+        deadline = node.deadline()
+        if deadline is None:
+            return
+        heapq.heappush(self._heap, (deadline, next(self._heap_seq), node))
+        # Drop the entries of removed nodes when they outnumber the nodes
+        if len(self._heap) > 2 * len(self._dict_id2keys) + 64:
+            self._heap = [entry for entry in self._heap if id(entry[2]) in self._dict_id2keys]
+            heapq.heapify(self._heap)
 
     def __len__(self):
         """ Returns the length of the internal list node """
@@ -229,10 +733,604 @@ class Container(object):
         return '{} ({} items)'.format(self._name, len(self))
 
     def dump(self):
-        return '\n'.join(['#{} {}'.format(i+1, node.dump()) for i, node in enumerate(self._nodes)])
+        return '\n'.join(['#{} {}'.format(i+1, node.dump()) for i, node in enumerate(self.getall())])
+
+    def snapshot(self, path):
+        """
+        Write the nodes to a binary file, streaming chunks of SNAPSHOT_CHUNK nodes.
+        A chunk holds the pickled list of lookup keys, index keys and deadline of its nodes, then the pickled nodes.
+        The file is written next to path and renamed, a reader never sees a partial snapshot.
+
+        @param path: The path of the snapshot file.
+        @return: The number of nodes written.
+        """
+        n = 0
+        tmp_path = '{}.tmp'.format(path)
+        nodes = list(self._nodes)
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            for i in range(0, len(nodes), SNAPSHOT_CHUNK):
+                entries = []
+                datas = []
+                for node in nodes[i:i + SNAPSHOT_CHUNK]:
+                    if type(node) is _SnapshotNode:
+                        # Copy the pickled node without unpickling it
+                        data = node.data()
+                    else:
+                        data = pickle.dumps(node, pickle.HIGHEST_PROTOCOL)
+                    keys = self._unpack_keys(self._dict_id2keys[id(node)])
+                    indexkeys = self._dict_id2indexkeys.get(id(node), ())
+                    entries.append((keys, indexkeys, node.deadline(), len(data)))
+                    datas.append(data)
+                keys_data = pickle.dumps(entries, pickle.HIGHEST_PROTOCOL)
+                f.write(_SNAPSHOT_HEADER.pack(len(entries), len(keys_data)))
+                f.write(keys_data)
+                f.writelines(datas)
+                n += len(entries)
+        os.replace(tmp_path, path)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Written snapshot of %s nodes to %s', n, path)
+        return n
+
+    def load(self, path):
+        """
+        Add the nodes of a snapshot file, which is memory mapped.
+        Only the keys are read, each node is unpickled on its first lookup and expires at its stored deadline.
+        An unpickled node is added again, moving to the end of the list and ordered datatypes.
+
+        @param path: The path of the snapshot file.
+        @return: The number of nodes added.
+        """
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            mm.close()
+            raise Exception('Failed to load: {} is not a snapshot'.format(path))
+        nodes = []
+        pos = len(SNAPSHOT_MAGIC)
+        size = len(mm)
+        while pos < size:
+            count, keys_len = _SNAPSHOT_HEADER.unpack_from(mm, pos)
+            pos += _SNAPSHOT_HEADER.size
+            entries = pickle.loads(mm[pos:pos + keys_len])
+            pos += keys_len
+            for keys, indexkeys, deadline, length in entries:
+                nodes.append(_SnapshotNode(mm, pos, length, keys, indexkeys, deadline))
+                pos += length
+        self.add_many(nodes)
+        self._lazy += len(nodes)
+        if self._observers:
+            self._notify('load', None)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Loaded snapshot of %s nodes from %s', len(nodes), path)
+        return len(nodes)
+
+    def _materialize(self, placeholder):
+        """ Replace a loaded node with its unpickled node and return it """
+        node = placeholder.node()
+        self._remove(placeholder)
+        self._add(node)
+        if self._maxsize is not None:
+            self._track(node)
+        return node
+
+    def _materialize_key(self, key):
+        """ Replace the loaded nodes of a lookup key, return True if any was replaced """
+        value = self._dict.get(key)
+        if type(value) is _SnapshotNode:
+            self._materialize(value)
+            return True
+        if value is None or isinstance(value, ContainerNode):
+            return False
+        placeholders = [node for node in value if type(node) is _SnapshotNode]
+        for placeholder in placeholders:
+            self._materialize(placeholder)
+        return len(placeholders) > 0
+
+    def _materialize_all(self, nodes):
+        return [self._materialize(node) if type(node) is _SnapshotNode else node for node in nodes]
+
+
+class ConcurrentContainer(Container):
+
+    def __init__(self, name='ConcurrentContainer', loglevel=LOGLEVELCONTAINER, datatype='set', maxsize=None, eviction='lru', compact=False, stripes=64):
+        """
+        Initialize the thread-safe Container.
+        Added stripes parameter to select the number of locks, the keys are mapped to a lock by hash.
+            add, remove and updatekeys hold the locks of all the keys of the node, lookups take no lock
+            getall, dump and removeall hold all the locks for a consistent view
+        The indexes, the expiry heap and the eviction order are guarded by an internal lock held briefly.
+        The eviction runs after releasing the locks of the added nodes.
+        The list datatype is not supported, use ordered for preserving insertion order.
+        The subscribe() callbacks of add, remove and updatekeys run holding the locks of the node keys.
+        """
+        # Removing from a list rewrites it, losing the nodes added or removed meanwhile by other threads
+        if datatype == 'list':
+            raise Exception('Datatype "{}" not supported!'.format(datatype))
+        super().__init__(name, loglevel, datatype, maxsize, eviction, compact)
+        self._stripes = [threading.RLock() for _ in range(stripes)]
+        self._meta_lock = threading.RLock()     # Guards indexes, heap and eviction order, taken after the stripes
+        self._evict_lock = threading.RLock()    # Serializes the evicting threads, taken before the stripes
+
+    def _stripes_of(self, *keys_list):
+        """ Return the sorted indexes of the stripes of the lookup keys, sorting avoids deadlocks """
+        n = len(self._stripes)
+        return sorted({hash(key) % n for keys in keys_list for (key, isunique) in keys})
+
+    def _acquire(self, stripes):
+        for i in stripes:
+            self._stripes[i].acquire()
+
+    def _release(self, stripes):
+        for i in reversed(stripes):
+            self._stripes[i].release()
+
+    def _registered(self, node):
+        keys = self._dict_id2keys.get(id(node))
+        if keys is None:
+            raise KeyError('Failed to lock: node does not exist {}'.format(node))
+        return keys
+
+    def add(self, node):
+        stripes = self._stripes_of(node.lookupkeys())
+        self._acquire(stripes)
+        try:
+            super().add(node)
+        finally:
+            self._release(stripes)
+        self._evict_overflow()
+
+    def remove(self, node, callback=True):
+        # Retry if the keys of the node were updated before holding their locks
+        while True:
+            keys = self._registered(node)
+            stripes = self._stripes_of(self._unpack_keys(keys))
+            self._acquire(stripes)
+            try:
+                if self._dict_id2keys.get(id(node)) is keys:
+                    super().remove(node, callback=False)
+                    break
+            finally:
+                self._release(stripes)
+        if callback:
+            node.delete()
+
+    def updatekeys(self, node):
+        while True:
+            keys = self._registered(node)
+            stripes = self._stripes_of(self._unpack_keys(keys), node.lookupkeys())
+            self._acquire(stripes)
+            try:
+                if self._dict_id2keys.get(id(node)) is keys:
+                    super().updatekeys(node)
+                    return
+            finally:
+                self._release(stripes)
+
+    def add_many(self, nodes):
+        nodes = list(nodes)
+        stripes = self._stripes_of(*[node.lookupkeys() for node in nodes])
+        self._acquire(stripes)
+        try:
+            super().add_many(nodes)
+        finally:
+            self._release(stripes)
+        self._evict_overflow()
+
+    def remove_many(self, nodes, callback=True):
+        nodes = list(nodes)
+        while True:
+            keys_list = [self._registered(node) for node in nodes]
+            stripes = self._stripes_of(*map(self._unpack_keys, keys_list))
+            self._acquire(stripes)
+            try:
+                if all(self._dict_id2keys.get(id(node)) is keys for node, keys in zip(nodes, keys_list)):
+                    super().remove_many(nodes, callback=False)
+                    break
+            finally:
+                self._release(stripes)
+        if callback:
+            for node in nodes:
+                node.delete()
+
+    def updatekeys_many(self, nodes):
+        nodes = list(nodes)
+        while True:
+            keys_list = [self._registered(node) for node in nodes]
+            stripes = self._stripes_of(*map(self._unpack_keys, keys_list), *[node.lookupkeys() for node in nodes])
+            self._acquire(stripes)
+            try:
+                if all(self._dict_id2keys.get(id(node)) is keys for node, keys in zip(nodes, keys_list)):
+                    super().updatekeys_many(nodes)
+                    return
+            finally:
+                self._release(stripes)
+
+    def removeall(self, callback=True):
+        stripes = range(len(self._stripes))
+        self._acquire(stripes)
+        try:
+            super().removeall(callback)
+        finally:
+            self._release(stripes)
+
+    def getall(self):
+        """
+        Returns a consistent shallow copy of the internal storage
+        """
+        stripes = range(len(self._stripes))
+        self._acquire(stripes)
+        try:
+            nodes = list(self._nodes)
+        finally:
+            self._release(stripes)
+        if self._lazy:
+            nodes = self._materialize_all(nodes)
+        return nodes
+
+    def snapshot(self, path):
+        stripes = range(len(self._stripes))
+        self._acquire(stripes)
+        try:
+            return super().snapshot(path)
+        finally:
+            self._release(stripes)
+
+    def _materialize(self, placeholder):
+        # Another thread may have replaced the loaded node meanwhile
+        stripes = self._stripes_of(placeholder.lookupkeys())
+        self._acquire(stripes)
+        try:
+            if id(placeholder) not in self._dict_id2keys:
+                return placeholder.node()
+            return super()._materialize(placeholder)
+        finally:
+            self._release(stripes)
+
+    def lookup_range(self, index, low=None, high=None):
+        with self._meta_lock:
+            nodes = self._indexes[index].range(low, high) if index in self._indexes else []
+        # The loaded nodes are unpickled holding their stripes, which are taken before the internal lock
+        if self._lazy:
+            nodes = self._materialize_all(nodes)
+        return nodes
+
+    def lookup_prefix(self, index, prefix):
+        with self._meta_lock:
+            nodes = self._indexes[index].prefix(prefix) if index in self._indexes else []
+        if self._lazy:
+            nodes = self._materialize_all(nodes)
+        return nodes
+
+    def expire(self, now=None, callback=True):
+        if now is None:
+            now = time.time()
+        # Pop the due nodes and remove them without holding the internal lock
+        due = []
+        with self._meta_lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                _, _, node = heapq.heappop(heap)
+                due.append(node)
+        expired = []
+        for node in due:
+            keys = self._dict_id2keys.get(id(node))
+            if keys is None:
+                continue
+            stripes = self._stripes_of(self._unpack_keys(keys))
+            self._acquire(stripes)
+            try:
+                if self._dict_id2keys.get(id(node)) is not keys:
+                    continue
+                deadline = node.deadline()
+                if deadline is None:
+                    continue
+                elif deadline > now:
+                    # The deadline was extended
+                    self._schedule(node)
+                    continue
+                self._remove(node)
+                expired.append(node)
+            finally:
+                self._release(stripes)
+        with self._meta_lock:
+            self.expirations += len(expired)
+        if expired and self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Expired %s nodes', len(expired))
+        # The loaded nodes are unpickled for the callbacks
+        expired = [node.node() if type(node) is _SnapshotNode else node for node in expired]
+        if self._observers:
+            for node in expired:
+                self._notify('expire', node)
+        if callback:
+            for node in expired:
+                node.delete()
+        return expired
+
+    def _add_indexkeys(self, node, indexkeys):
+        if indexkeys:
+            with self._meta_lock:
+                super()._add_indexkeys(node, indexkeys)
+
+    def _remove_indexkeys(self, node):
+        if id(node) in self._dict_id2indexkeys:
+            with self._meta_lock:
+                super()._remove_indexkeys(node)
+
+    def _schedule(self, node):
+        if node.deadline() is not None:
+            with self._meta_lock:
+                super()._schedule(node)
+
+    def _track(self, node):
+        with self._meta_lock:
+            super()._track(node)
+
+    def _untrack(self, node):
+        with self._meta_lock:
+            super()._untrack(node)
+
+    def _touch(self, node):
+        with self._meta_lock:
+            super()._touch(node)
+
+    def _evict(self):
+        """ Defer the eviction to _evict_overflow() once the locks of the added nodes are released """
+        pass
+
+    def _evict_overflow(self):
+        """ Evict nodes until the size is within maxsize """
+        if self._maxsize is None or len(self._dict_id2keys) <= self._maxsize:
+            return
+        with self._evict_lock:
+            while len(self._dict_id2keys) > self._maxsize:
+                with self._meta_lock:
+                    node = self._victim()
+                    self.evictions += 1
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug('Evicted node %s', node)
+                try:
+                    self.remove(node, callback=True)
+                except KeyError:
+                    # The node was removed by another thread
+                    with self._meta_lock:
+                        self.evictions -= 1
+
+
+class ContainerEvents(object):
+    """
+    Bounded async iterator of the events of a Container, yielding tuples of (event, node).
+    The pending events of a node are coalesced into one, updatekeys after add is an add,
+    remove or expire after add cancels both, and add after remove or expire is an updatekeys.
+    Beyond maxsize nodes with pending events, the events are dropped and ('overflow', None) is yielded,
+    the consumer is expected to resynchronize from getall(), as after the ('load', None) event of load().
+    The events may be produced from other threads than the one of the event loop it is created in.
+    """
+
+    def __init__(self, container, maxsize=1024):
+        self._container = container
+        self._maxsize = maxsize
+        self._pending = collections.OrderedDict()   # Indexes node ids to (event, node) in order of change
+        self._overflow = False
+        self._closed = False
+        self._signaled = False      # The ready event is set or about to be set
+        self._lock = threading.Lock()
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        container.subscribe(self._on_event)
+
+    def _on_event(self, event, node):
+        with self._lock:
+            if self._overflow:
+                return
+            # The pending event holds a reference to the node, its id cannot be reused by another node
+            previous = self._pending.pop(id(node), None)
+            if previous is not None:
+                event = _coalesce_events(previous[0], event)
+            if event is not None:
+                self._pending[id(node)] = (event, node)
+            if len(self._pending) > self._maxsize:
+                self._pending.clear()
+                self._overflow = True
+            # Wake up the consumer once per burst of events
+            signaled, self._signaled = self._signaled, True
+        if not signaled:
+            self._wakeup()
+
+    def _wakeup(self):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._ready.set()
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    def _take(self, all_events):
+        """ Return the list of pending events, the oldest one unless all_events, clearing the ready flag if none """
+        with self._lock:
+            if self._overflow:
+                self._overflow = False
+                return [('overflow', None)]
+            if self._pending:
+                if not all_events:
+                    return [self._pending.popitem(last=False)[1]]
+                events = list(self._pending.values())
+                self._pending.clear()
+                return events
+            self._ready.clear()
+            self._signaled = False
+            return []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            events = self._take(False)
+            if events:
+                return events[0]
+            if self._closed:
+                raise StopAsyncIteration
+            await self._ready.wait()
+
+    async def batch(self):
+        """ Wait for events and return the list of all the pending events, or an empty list once closed """
+        while True:
+            events = self._take(True)
+            if events or self._closed:
+                return events
+            await self._ready.wait()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def close(self):
+        """ Stop receiving events, the iteration ends once the pending events are consumed """
+        if not self._closed:
+            self._closed = True
+            self._container.unsubscribe(self._on_event)
+            self._wakeup()
+
+
+def _coalesce_events(previous, event):
+    """ Return the event equivalent to previous followed by event of the same node, None if they cancel out """
+    if previous == 'add':
+        if event in ('remove', 'expire'):
+            return None
+        if event == 'updatekeys':
+            return 'add'
+    elif previous in ('remove', 'expire') and event == 'add':
+        return 'updatekeys'
+    return event
+
+
+class _SortedIndex(object):
+    """
+    Sorted keys of an index with the nodes in parallel, duplicated keys keep insertion order.
+    Keys are stored in blocks of at most 2 * BLOCK entries with the last key of every block,
+    an add or remove bisects the blocks and shifts a single block in O(log n + BLOCK).
+    """
+    BLOCK = 512
+
+    def __init__(self):
+        self._keys = []         # Stores the sorted blocks of keys
+        self._nodes = []        # Stores the blocks of nodes in parallel
+        self._maxes = []        # Stores the last key of every block
+        self._len = 0
+
+    def add(self, key, node):
+        if not self._maxes:
+            self._keys.append([key])
+            self._nodes.append([node])
+            self._maxes.append(key)
+            self._len = 1
+            return
+        # The first block with a greater key, the last block otherwise
+        i = bisect.bisect_right(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+        keys = self._keys[i]
+        j = bisect.bisect_right(keys, key)
+        keys.insert(j, key)
+        self._nodes[i].insert(j, node)
+        self._maxes[i] = keys[-1]
+        self._len += 1
+        if len(keys) > 2 * self.BLOCK:
+            self._split(i)
+
+    def extend(self, entries):
+        """ Add a list of (key, node), sorting once if it is large compared to the index """
+        if len(entries) < 16 or len(entries) < self._len // 8:
+            for key, node in entries:
+                self.add(key, node)
+            return
+        # The sort is stable, the duplicated keys keep insertion order
+        merged = sorted(itertools.chain(self._entries(), entries), key=lambda entry: entry[0])
+        n = self.BLOCK
+        self._keys = [[key for key, node in merged[i:i + n]] for i in range(0, len(merged), n)]
+        self._nodes = [[node for key, node in merged[i:i + n]] for i in range(0, len(merged), n)]
+        self._maxes = [keys[-1] for keys in self._keys]
+        self._len = len(merged)
+
+    def remove(self, key, node):
+        i = bisect.bisect_left(self._maxes, key)
+        # Duplicated keys may span several blocks
+        while i < len(self._maxes) and not key < self._keys[i][0]:
+            keys = self._keys[i]
+            nodes = self._nodes[i]
+            j = bisect.bisect_left(keys, key)
+            while j < len(keys) and not key < keys[j]:
+                if nodes[j] is node:
+                    del keys[j]
+                    del nodes[j]
+                    self._len -= 1
+                    if keys:
+                        self._maxes[i] = keys[-1]
+                    else:
+                        del self._keys[i]
+                        del self._nodes[i]
+                        del self._maxes[i]
+                    return
+                j += 1
+            i += 1
+        raise KeyError('Failed to remove: index key {} does not exists for node {}'.format(key, node))
+
+    def range(self, low, high):
+        i, j = (0, 0) if low is None else self._position(low)
+        result = []
+        while i < len(self._keys):
+            keys = self._keys[i]
+            if high is None or not high < self._maxes[i]:
+                result += self._nodes[i][j:]
+            else:
+                result += self._nodes[i][j:bisect.bisect_right(keys, high, j)]
+                break
+            i, j = i + 1, 0
+        return result
+
+    def prefix(self, prefix):
+        n = len(prefix)
+        i, j = self._position(prefix)
+        result = []
+        while i < len(self._keys):
+            keys = self._keys[i]
+            k = j
+            while k < len(keys) and keys[k][:n] == prefix:
+                k += 1
+            result += self._nodes[i][j:k]
+            if k < len(keys):
+                break
+            i, j = i + 1, 0
+        return result
+
+    def _position(self, key):
+        """ Return the (block, offset) of the first key not lower than key """
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return (i, 0)
+        return (i, bisect.bisect_left(self._keys[i], key))
+
+    def _split(self, i):
+        keys = self._keys[i]
+        nodes = self._nodes[i]
+        half = len(keys) // 2
+        self._keys[i:i + 1] = [keys[:half], keys[half:]]
+        self._nodes[i:i + 1] = [nodes[:half], nodes[half:]]
+        self._maxes[i:i + 1] = [keys[half - 1], keys[-1]]
+
+    def _entries(self):
+        for keys, nodes in zip(self._keys, self._nodes):
+            yield from zip(keys, nodes)
+
+    def __len__(self):
+        return self._len
 
 
 class ContainerNode(object):
+    # Subclasses without __slots__ keep a per instance __dict__
+    __slots__ = ('_logger', '_name', '__weakref__')
 
     def __init__(self, name='ContainerNode', loglevel=LOGLEVELNODE):
         """ Initialize the ContainerNode """
@@ -246,10 +1344,21 @@ class ContainerNode(object):
         isunique = True
         return ((key, isunique),)
 
+    def indexkeys(self):
+        """
+        Return the ordered index keys of the node as a tuple of (index, key)
+        The keys of an index are comparable, such as network_helper3.ipaddr_to_int() integers or tuples
+        """
+        return ()
+
     def hasexpired(self):
         """ Return True if the TTL of the node has expired """
         return False
 
+    def deadline(self):
+        """ Return the time.time() when the node expires, or None if it does not expire """
+        return None
+
     def update(self):
         """
         Perform additional actions when the node is being updated.
@@ -272,6 +1381,72 @@ class ContainerNode(object):
         return self._name
 
 
+_LIGHT_NODE_LOGGER = logging.getLogger('ContainerNode')
+
+
+class LightContainerNode(ContainerNode):
+    """
+    ContainerNode sharing a class logger, without a per instance logger nor __dict__.
+    Subclasses declare their attributes in __slots__ for the memory savings to hold.
+    """
+    __slots__ = ()
+
+    def __init__(self, name='ContainerNode'):
+        """ Initialize the LightContainerNode """
+        self._logger = _LIGHT_NODE_LOGGER
+        self._name = name
+
+
+class _SnapshotNode(LightContainerNode):
+    """ Node loaded from a snapshot file, standing for the pickled node until its first lookup """
+    __slots__ = ('_mm', '_offset', '_length', '_keys', '_indexkeys', '_deadline', '_node')
+
+    def __init__(self, mm, offset, length, keys, indexkeys, deadline):
+        self._logger = _LIGHT_NODE_LOGGER
+        self._name = offset
+        self._mm = mm
+        self._offset = offset
+        self._length = length
+        self._keys = keys
+        self._indexkeys = indexkeys
+        self._deadline = deadline
+        self._node = None
+
+    def data(self):
+        """ Return the pickled node """
+        if self._node is not None:
+            return pickle.dumps(self._node, pickle.HIGHEST_PROTOCOL)
+        return self._mm[self._offset:self._offset + self._length]
+
+    def node(self):
+        """ Return the unpickled node, releasing the snapshot file """
+        if self._node is None:
+            self._node = pickle.loads(self.data())
+            self._mm = None
+        return self._node
+
+    def lookupkeys(self):
+        return self._keys
+
+    def indexkeys(self):
+        return self._indexkeys
+
+    def deadline(self):
+        return self._deadline
+
+    def hasexpired(self):
+        return self._deadline is not None and self._deadline <= time.time()
+
+    def delete(self):
+        self.node().delete()
+
+    def dump(self):
+        return self.node().dump()
+
+    def __repr__(self):
+        return 'SnapshotNode@{}'.format(self._offset)
+
+
 if __name__ == "__main__":
     ct = Container()
     cn1 = ContainerNode('cn1')
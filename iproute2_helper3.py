@@ -69,6 +69,9 @@ def ipset_test(name, entry, family=AF_INET, etype='ip'):
     except:
         return False
 
+def ipset_swap(name_a, name_b):
+    return ips.swap(name_a, name_b)
+
 def ipset_exists(name):
     return [x for x in ips.list()
             if x.get_attr('IPSET_ATTR_SETNAME') == name]
@@ -0,0 +1,267 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2017, Jesus Llorente Santos, Aalto University, Finland
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+
+* Neither the name of the copyright holder nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+# NOTES
+# - Reads run in an executor, writes of a table are queued to the single writer task of that table
+# - The writer applies all the writes queued back to back within one Transaction, i.e. a single commit
+#   If any of them fails the Transaction is rolled back and the writes are replayed one Transaction each
+# - Reads and the writer of a table are serialized by the table locks of iptc_helper3, held by its public functions
+#   and by its Transaction from begin to commit
+# - Writes use the iptc batch path, the restore backend would bypass the transaction of the writer
+
+import asyncio
+import functools
+import time
+
+import iptc_helper3
+
+TABLES = ('security', 'raw', 'mangle', 'nat', 'filter')
+
+class AsyncIptcHelper(object):
+    """
+    Asyncio front-end of iptc_helper3 with its public functions as coroutines.
+    Every write resolves when the commit of the writes merged with it lands.
+    """
+
+    def __init__(self, executor=None, max_batch=1000):
+        self.executor = executor    # Executor of reads and commits, None uses the default executor of the loop
+        self.max_batch = max_batch  # Maximum number of writes merged into a commit
+        self.commits = 0            # Number of commits done by the writers
+        self.writes = 0             # Number of writes applied by the writers
+        self._latency = {}          # Indexes function names to [count, total, max, last] in seconds
+        self._writers = {}          # Indexes (table, ipv6) to (asyncio.Queue, asyncio.Task)
+        self._closed = False
+
+    def get_latency(self):
+        """ Return a dictionary of format {function: {count, total, mean, max, last}} with latencies in seconds """
+        d = {}
+        for name, (count, total, maximum, last) in self._latency.items():
+            d[name] = {'count': count, 'total': total, 'mean': total / count, 'max': maximum, 'last': last}
+        return d
+
+    async def close(self):
+        """ Wait for the queued writes and stop the writers """
+        self._closed = True
+        writers, self._writers = self._writers, {}
+        for (queue, task) in writers.values():
+            queue.put_nowait(None)
+        await asyncio.gather(*[task for (queue, task) in writers.values()])
+
+    # Read operations
+    async def has_chain(self, table, chain, ipv6=False):
+        return await self._read('has_chain', iptc_helper3.has_chain, table, chain, ipv6=ipv6)
+
+    async def has_rule(self, table, chain, rule_d, ipv6=False):
+        return await self._read('has_rule', iptc_helper3.has_rule, table, chain, rule_d, ipv6=ipv6)
+
+    async def get_chains(self, table, ipv6=False):
+        return await self._read('get_chains', iptc_helper3.get_chains, table, ipv6=ipv6)
+
+    async def get_rule(self, table, chain, position=0, ipv6=False, silent=False):
+        return await self._read('get_rule', iptc_helper3.get_rule, table, chain, position=position, ipv6=ipv6, silent=silent)
+
+    async def get_rule_statistics(self, table, chain, rule_d, ipv6=False):
+        return await self._read('get_rule_statistics', iptc_helper3.get_rule_statistics, table, chain, rule_d, ipv6=ipv6)
+
+    async def get_rule_position(self, table, chain, rule_d, ipv6=False):
+        return await self._read('get_rule_position', iptc_helper3.get_rule_position, table, chain, rule_d, ipv6=ipv6)
+
+    async def get_chain_counters(self, table, chain, ipv6=False, zero=False):
+        d = await self.get_table_counters(table, chains=(chain, ), ipv6=ipv6, zero=zero)
+        return d[chain]
+
+    async def get_table_counters(self, table, chains=None, ipv6=False, zero=False):
+        # Zeroing the counters is a write
+        if zero:
+            return await self._write('get_table_counters', iptc_helper3.get_table_counters, table, chains=chains, ipv6=ipv6, zero=True)
+        return await self._read('get_table_counters', iptc_helper3.get_table_counters, table, chains=chains, ipv6=ipv6)
+
+    async def repr_all(self, ipv6=False):
+        return ''.join(await asyncio.gather(*[self.repr_table(table, ipv6=ipv6) for table in TABLES]))
+
+    async def repr_table(self, table, ipv6=False):
+        return await self._read('repr_table', iptc_helper3.repr_table, table, ipv6=ipv6)
+
+    async def repr_chain(self, table, chain, ipv6=False, indent='\t'):
+        return await self._read('repr_chain', iptc_helper3.repr_chain, table, chain, ipv6=ipv6, indent=indent)
+
+    async def dump_all(self, ipv6=False):
+        dumps = await asyncio.gather(*[self.dump_table(table, ipv6=ipv6) for table in TABLES])
+        return dict(zip(TABLES, dumps))
+
+    async def dump_table(self, table, ipv6=False):
+        return await self._read('dump_table', iptc_helper3.dump_table, table, ipv6=ipv6)
+
+    async def dump_chain(self, table, chain, ipv6=False):
+        return await self._read('dump_chain', iptc_helper3.dump_chain, table, chain, ipv6=ipv6)
+
+    # Write operations
+    async def flush_all(self, ipv6=False):
+        await asyncio.gather(*[self.flush_table(table, ipv6=ipv6) for table in TABLES])
+
+    async def flush_table(self, table, ipv6=False):
+        return await self._write('flush_table', iptc_helper3.flush_table, table, ipv6=ipv6)
+
+    async def flush_chain(self, table, chain, ipv6=False, silent=False):
+        return await self._write('flush_chain', iptc_helper3.flush_chain, table, chain, ipv6=ipv6, silent=silent)
+
+    async def zero_table(self, table, ipv6=False):
+        return await self._write('zero_table', iptc_helper3.zero_table, table, ipv6=ipv6)
+
+    async def zero_chain(self, table, chain, ipv6=False):
+        return await self._write('zero_chain', iptc_helper3.zero_chain, table, chain, ipv6=ipv6)
+
+    async def add_chain(self, table, chain, ipv6=False, silent=False):
+        return await self._write('add_chain', iptc_helper3.add_chain, table, chain, ipv6=ipv6, silent=silent)
+
+    async def add_rule(self, table, chain, rule_d, position=0, ipv6=False):
+        return await self._write('add_rule', iptc_helper3.add_rule, table, chain, rule_d, position=position, ipv6=ipv6)
+
+    async def insert_rule(self, table, chain, rule_d, ipv6=False):
+        return await self._write('insert_rule', iptc_helper3.insert_rule, table, chain, rule_d, ipv6=ipv6)
+
+    async def delete_chain(self, table, chain, ipv6=False, flush=False, silent=False):
+        return await self._write('delete_chain', iptc_helper3.delete_chain, table, chain, ipv6=ipv6, flush=flush, silent=silent)
+
+    async def delete_rule(self, table, chain, rule_d, ipv6=False, silent=False):
+        return await self._write('delete_rule', iptc_helper3.delete_rule, table, chain, rule_d, ipv6=ipv6, silent=silent)
+
+    async def replace_rule(self, table, chain, old_rule_d, new_rule_d, ipv6=False):
+        return await self._write('replace_rule', iptc_helper3.replace_rule, table, chain, old_rule_d, new_rule_d, ipv6=ipv6)
+
+    async def batch_add_chains(self, table, chains, ipv6=False, flush=True):
+        return await self._write('batch_add_chains', iptc_helper3.batch_add_chains, table, chains, ipv6=ipv6, flush=flush)
+
+    async def batch_delete_chains(self, table, chains, ipv6=False):
+        return await self._write('batch_delete_chains', iptc_helper3.batch_delete_chains, table, chains, ipv6=ipv6)
+
+    async def batch_add_rules(self, table, batch_rules, ipv6=False):
+        return await self._write('batch_add_rules', iptc_helper3.batch_add_rules, table, batch_rules, ipv6=ipv6, backend='iptc')
+
+    async def batch_delete_rules(self, table, batch_rules, ipv6=False, silent=True):
+        return await self._write('batch_delete_rules', iptc_helper3.batch_delete_rules, table, batch_rules, ipv6=ipv6,
+                                 silent=silent, backend='iptc')
+
+    async def reconcile(self, desired, table, ipv6=False, dry_run=False):
+        if dry_run:
+            return await self._read('reconcile', _reconcile, table, desired, ipv6=ipv6, dry_run=True)
+        return await self._write('reconcile', _reconcile, table, desired, ipv6=ipv6)
+
+    def _record(self, name, latency):
+        entry = self._latency.get(name)
+        if entry is None:
+            self._latency[name] = [1, latency, latency, latency]
+            return
+        entry[0] += 1
+        entry[1] += latency
+        entry[2] = max(entry[2], latency)
+        entry[3] = latency
+
+    async def _read(self, name, func, table, *args, ipv6=False, **kwargs):
+        """ Run a read of a table in the executor, serialized with the writer of the table """
+        start = time.monotonic()
+        call = functools.partial(func, table, *args, ipv6=ipv6, **kwargs)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+        finally:
+            self._record(name, time.monotonic() - start)
+
+    async def _write(self, name, func, table, *args, ipv6=False, **kwargs):
+        """ Queue a write of a table to its writer and wait for the commit """
+        if self._closed:
+            raise Exception('Failed to write: helper is closed')
+        loop = asyncio.get_running_loop()
+        key = (table, ipv6)
+        if key not in self._writers:
+            queue = asyncio.Queue()
+            self._writers[key] = (queue, loop.create_task(self._writer(key, queue)))
+        future = loop.create_future()
+        self._writers[key][0].put_nowait((name, func, args, kwargs, future, time.monotonic()))
+        return await future
+
+    async def _writer(self, key, queue):
+        """ Apply the writes of a table, merging the ones queued back to back into one commit """
+        loop = asyncio.get_running_loop()
+        while True:
+            writes = [await queue.get()]
+            while len(writes) < self.max_batch and not queue.empty():
+                writes.append(queue.get_nowait())
+            stop = writes[-1] is None
+            writes = [write for write in writes if write is not None]
+            if writes:
+                try:
+                    results = await loop.run_in_executor(self.executor, self._apply, key, writes)
+                except Exception as e:
+                    results = [(False, e)] * len(writes)
+                self.commits += 1
+                self.writes += len(writes)
+                now = time.monotonic()
+                for (name, func, args, kwargs, future, start), (success, value) in zip(writes, results):
+                    self._record(name, now - start)
+                    if future.cancelled():
+                        continue
+                    if success:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+            if stop:
+                return
+
+    def _apply(self, key, writes):
+        """
+        Apply writes within one transaction of the table, return a list of (success, result or exception)
+        If any write fails the transaction is rolled back and the writes are replayed in a transaction each
+        """
+        table, ipv6 = key
+        try:
+            with iptc_helper3.Transaction(table, ipv6=ipv6):
+                return [(True, func(table, *args, ipv6=ipv6, **kwargs))
+                        for (name, func, args, kwargs, future, start) in writes]
+        except Exception as e:
+            if len(writes) == 1:
+                return [(False, e)]
+        # A failed write may leave partial changes in the transaction, only the failed writes must fail
+        results = []
+        for (name, func, args, kwargs, future, start) in writes:
+            try:
+                with iptc_helper3.Transaction(table, ipv6=ipv6):
+                    results.append((True, func(table, *args, ipv6=ipv6, **kwargs)))
+            except Exception as e:
+                results.append((False, e))
+        return results
+
+    def __repr__(self):
+        return 'AsyncIptcHelper ({} writers, {} commits, {} writes)'.format(len(self._writers), self.commits, self.writes)
+
+def _reconcile(table, desired, ipv6=False, dry_run=False):
+    # Table is the first argument of the functions run by the writers
+    return iptc_helper3.reconcile(desired, table, ipv6=ipv6, dry_run=dry_run)
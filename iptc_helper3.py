@@ -34,6 +34,13 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # - Table names are lowercase - filter, mangle, nat, raw
 # - Chain names are uppercase - FORWARD, INPUT, OUTPUT, PREROUTING, POSTROUTING
 # - Both chains and tables are singletons
+# - Read operations are served from a cached table snapshot keyed by (table, ipv6)
+#   Writes done via this module keep the snapshot up to date, use refresh() or CACHE_MAXAGE
+#   to pick up changes done outside of the process
+# - Rules of a chain are indexed by the fingerprint of their decoded rule_d
+# - Within a Transaction all functions share uncommitted table handles, committed once at the end
+# - Functions on a table hold its lock, other threads wait for the end of a Transaction on the table
+# - Table handles are created by a backend - python-iptc, iptables-save/restore or an in-memory model
 
 # TODO
 # - Use Table.ALL when the iptc code is fixed for iterating all tables
@@ -46,9 +53,153 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # batch_add_chains   has changed
 # batch_delete_rules has changed
 
-import iptc
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import difflib
+import functools
+import hashlib
+import inspect
+import ipaddress
+import itertools
+import json
+import shlex
+import socket
+import subprocess
+import threading
+import time
+
+try:
+    import iptc
+except ImportError:
+    # Only the memory and restore backends are available
+    iptc = None
+
+# Backend used by batch_add_rules and batch_delete_rules - iptc or restore
+BATCH_BACKEND = 'iptc'
+# Binaries used by the restore backend, either a path or a list with the command line
+IPTABLES_RESTORE = 'iptables-restore'
+IP6TABLES_RESTORE = 'ip6tables-restore'
+# Binaries used by the save read path, either a path or a list with the command line
+IPTABLES_SAVE = 'iptables-save'
+IP6TABLES_SAVE = 'ip6tables-save'
+
+# Built-in chains of every table
+BUILTIN_CHAINS = {'security': ('INPUT', 'FORWARD', 'OUTPUT'),
+                  'raw':      ('PREROUTING', 'OUTPUT'),
+                  'mangle':   ('PREROUTING', 'INPUT', 'FORWARD', 'OUTPUT', 'POSTROUTING'),
+                  'nat':      ('PREROUTING', 'INPUT', 'OUTPUT', 'POSTROUTING'),
+                  'filter':   ('INPUT', 'FORWARD', 'OUTPUT')}
+
+# Maximum length of a chain name
+CHAIN_MAXLEN = 28
+# Maximum length of an ipset name
+IPSET_MAXLEN = 31
+
+# Table snapshot cache
+CACHE_ENABLED = True
+CACHE_MAXAGE = None     # Max age of a snapshot in seconds, None never expires
+
+_TABLE_CACHE = {}       # Indexes (table, ipv6) to _TableSnapshot
+_TABLE_GENERATION = {}  # Indexes (table, ipv6) to generation counter
+
+# Rule encoding cache, 0 disables the cache
+ENCODE_CACHE_SIZE = 1024
+
+_ENCODE_CACHE = collections.OrderedDict()   # Indexes (fingerprint, ipv6) to [iptc_rule, decoded fingerprint]
+_ENCODE_CACHE_LOCK = threading.Lock()
+_ENCODE_CACHE_STATS = {'hits': 0, 'misses': 0}
+
+# Instrumentation of the internal operations and the latency of the public functions, see get_instrumentation()
+INSTRUMENT = False
+INSTRUMENT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+_INSTRUMENT_COUNTERS = dict.fromkeys(('gettable', 'commit', 'refresh', 'encode', 'build', 'decode', 'scan'), 0)
+_INSTRUMENT_LATENCY = {}    # Indexes (function, table) to [bucket counts, sum, count]
+_INSTRUMENT_LOCK = threading.Lock()
+
+# Backend of the table handles - iptc, restore, memory or a backend object, see set_backend()
+_BACKEND = None
+
+_LOCAL = threading.local()  # Stores the active Transaction and the batch_begin Transaction of a thread
+_TABLE_LOCKS = {}           # Indexes (table, ipv6) to the lock of the table handle
+_TABLE_LOCKS_LOCK = threading.Lock()
+_DUAL_EXECUTOR = None       # Worker threads of the dual-stack functions
+_DUAL_LOCK = threading.Lock()   # Serializes the dual-stack workers but for their commits, libxtables state is process-wide
+
+# ICMP types and REJECT types with an ICMPv6 equivalent, used by translate_rule
+_ICMP6_TYPES = {'any': 'any', 'echo-reply': 'echo-reply', '0': '129', 'echo-request': 'echo-request', '8': '128',
+                'destination-unreachable': 'destination-unreachable', '3': '1',
+                'time-exceeded': 'time-exceeded', '11': '3', 'parameter-problem': 'parameter-problem', '12': '4'}
+_ICMP6_REJECT = {'icmp-net-unreachable': 'icmp6-no-route', 'icmp-host-unreachable': 'icmp6-addr-unreachable',
+                 'icmp-port-unreachable': 'icmp6-port-unreachable', 'icmp-net-prohibited': 'icmp6-adm-prohibited',
+                 'icmp-host-prohibited': 'icmp6-adm-prohibited', 'icmp-admin-prohibited': 'icmp6-adm-prohibited'}
+
+def refresh(table=None, ipv6=False):
+    """ Invalidate the cached snapshot of a table, or of all tables if None """
+    if table:
+        tables = (table, )
+    else:
+        tables = [k[0] for k in _TABLE_CACHE if k[1] == ipv6]
+    for table in tables:
+        _cache_invalidate(table, ipv6=ipv6)
 
-MODE_BATCH = False
+def get_encode_cache_stats():
+    """ Return a dictionary with the hits, misses and size of the rule encoding cache """
+    with _ENCODE_CACHE_LOCK:
+        return dict(_ENCODE_CACHE_STATS, size=len(_ENCODE_CACHE), maxsize=ENCODE_CACHE_SIZE)
+
+def clear_encode_cache():
+    """ Remove all entries and statistics of the rule encoding cache """
+    with _ENCODE_CACHE_LOCK:
+        _ENCODE_CACHE.clear()
+        _ENCODE_CACHE_STATS.update(hits=0, misses=0)
+
+def get_instrumentation():
+    """
+    Return a snapshot of the instrumentation with format {'counters': {name: count}, 'latency': {function: {table: d}}}.
+    Latency d has the format {'count', 'sum', 'buckets': [(upper bound in seconds, cumulative count)]}
+    """
+    with _INSTRUMENT_LOCK:
+        latency = {}
+        for (name, table), (buckets, total, count) in _INSTRUMENT_LATENCY.items():
+            cumulative = list(itertools.accumulate(buckets))
+            latency.setdefault(name, {})[table] = {'count': count, 'sum': total,
+                                                   'buckets': list(zip(INSTRUMENT_BUCKETS + (float('inf'), ), cumulative))}
+        counters = dict(_INSTRUMENT_COUNTERS)
+    counters.update(('encode_cache_{}'.format(k), v) for k, v in get_encode_cache_stats().items() if k in ('hits', 'misses'))
+    return {'counters': counters, 'latency': latency}
+
+def reset_instrumentation():
+    """ Reset all the counters and latency histograms of the instrumentation """
+    with _INSTRUMENT_LOCK:
+        _INSTRUMENT_COUNTERS.update(dict.fromkeys(_INSTRUMENT_COUNTERS, 0))
+        _INSTRUMENT_LATENCY.clear()
+
+def render_prometheus(prefix='iptc_helper'):
+    """ Return the instrumentation in the Prometheus text exposition format """
+    snapshot = get_instrumentation()
+    lines = ['# HELP {}_operations_total Internal operations done by iptc_helper3'.format(prefix),
+             '# TYPE {}_operations_total counter'.format(prefix)]
+    for name, count in sorted(snapshot['counters'].items()):
+        lines.append('{}_operations_total{{operation="{}"}} {}'.format(prefix, name, count))
+    lines += ['# HELP {}_call_duration_seconds Latency of the public functions of iptc_helper3'.format(prefix),
+              '# TYPE {}_call_duration_seconds histogram'.format(prefix)]
+    for name, tables in sorted(snapshot['latency'].items()):
+        for table, d in sorted(tables.items()):
+            labels = 'function="{}",table="{}"'.format(name, table)
+            for bound, count in d['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_call_duration_seconds_bucket{{{},le="{}"}} {}'.format(prefix, labels, le, count))
+            lines.append('{}_call_duration_seconds_sum{{{}}} {}'.format(prefix, labels, repr(d['sum'])))
+            lines.append('{}_call_duration_seconds_count{{{}}} {}'.format(prefix, labels, d['count']))
+    return '\n'.join(lines) + '\n'
+
+def get_generation(table, ipv6=False):
+    """ Return the generation counter of a table, increased on every write via this module """
+    return _TABLE_GENERATION.get((table, ipv6), 0)
 
 def flush_all(ipv6=False):
     """ Flush all tables """
@@ -57,14 +208,16 @@ def flush_all(ipv6=False):
 
 def flush_table(table, ipv6=False):
     """ Flush a table """
-    iptc_table = _iptc_gettable(table, ipv6=ipv6)
+    iptc_table = _iptc_gettable(table, ipv6=ipv6, refresh=True)
     iptc_table.flush()
+    _cache_update(table, ipv6=ipv6, drop_index=True)
 
 def flush_chain(table, chain, ipv6=False, silent=False):
     """ Flush a chain """
     try:
-        iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
+        iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6, refresh=True)
         iptc_chain.flush()
+        _cache_update(table, chain=chain, ipv6=ipv6, drop_index=True)
     except Exception as e:
         if not silent:
             raise
@@ -76,13 +229,15 @@ def zero_all(table, ipv6=False):
 
 def zero_table(table, ipv6=False):
     """ Zero a table """
-    iptc_table = _iptc_gettable(table, ipv6=ipv6)
+    iptc_table = _iptc_gettable(table, ipv6=ipv6, refresh=True)
     iptc_table.zero_entries()
+    _cache_update(table, ipv6=ipv6, drop_index=True)
 
 def zero_chain(table, chain, ipv6=False):
     """ Zero a chain """
-    iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
+    iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6, refresh=True)
     iptc_chain.zero_counters()
+    _cache_update(table, chain=chain, ipv6=ipv6, drop_index=True)
 
 def has_chain(table, chain, ipv6=False):
     """ Return True if chain exists in table False otherwise """
@@ -90,15 +245,15 @@ def has_chain(table, chain, ipv6=False):
 
 def has_rule(table, chain, rule_d, ipv6=False):
     """ Return True if rule exists in chain False otherwise """
-    iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
-    iptc_rule  = _encode_iptc_rule(rule_d, ipv6=ipv6)
-    return iptc_rule in iptc_chain.rules
+    index = _iptc_getindex(table, chain, ipv6=ipv6)
+    return _rule_fingerprint(rule_d, ipv6=ipv6) in index
 
 def add_chain(table, chain, ipv6=False, silent=False):
     """ Return True if chain was added successfuly to a table, raise Exception otherwise """
     try:
-        iptc_table = _iptc_gettable(table, ipv6=ipv6)
+        iptc_table = _iptc_gettable(table, ipv6=ipv6, refresh=True)
         iptc_table.create_chain(chain)
+        _cache_update(table, chain=chain, ipv6=ipv6, drop_index=True)
         return True
     except Exception as e:
         if not silent:
@@ -107,22 +262,28 @@ def add_chain(table, chain, ipv6=False, silent=False):
 
 def add_rule(table, chain, rule_d, position=0, ipv6=False):
     """ Add a rule to a chain in a given position. 0=append, 1=first, n=nth position """
-    iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
+    iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6, refresh=True)
     iptc_rule  = _encode_iptc_rule(rule_d, ipv6=ipv6)
+    index = _iptc_getindex(table, chain, ipv6=ipv6, build=False)
     if position == 0:
         # Insert rule in last position -> append
         iptc_chain.append_rule(iptc_rule)
+        _position = len(index) if index is not None else 0
     elif position > 0:
         # Insert rule in given position -> adjusted as iptables CLI
         iptc_chain.insert_rule(iptc_rule, position - 1)
+        _position = position - 1
     elif position < 0:
         # Insert rule in given position starting from bottom -> not available in iptables CLI
-        nof_rules = len(iptc_chain.rules)
+        nof_rules = len(_iptc_rules(iptc_chain))
         _position = position + nof_rules
         # Insert at the top if the position has looped over
         if _position <= 0:
             _position = 0
         iptc_chain.insert_rule(iptc_rule, _position)
+    if index is not None:
+        index.insert(_position, _rule_fingerprint(rule_d, ipv6=ipv6))
+    _cache_update(table, ipv6=ipv6)
 
 def insert_rule(table, chain, rule_d, ipv6=False):
     """ Add a rule to a chain in the 1st position """
@@ -133,8 +294,9 @@ def delete_chain(table, chain, ipv6=False, flush=False, silent=False):
     try:
         if flush:
             flush_chain(table, chain, ipv6=ipv6, silent=silent)
-        iptc_table = _iptc_gettable(table, ipv6=ipv6)
+        iptc_table = _iptc_gettable(table, ipv6=ipv6, refresh=True)
         iptc_table.delete_chain(chain)
+        _cache_update(table, chain=chain, ipv6=ipv6, drop_index=True)
     except Exception as e:
         if not silent:
             raise
@@ -142,9 +304,16 @@ def delete_chain(table, chain, ipv6=False, flush=False, silent=False):
 def delete_rule(table, chain, rule_d, ipv6=False, silent=False):
     """ Delete a rule from a chain """
     try:
-        iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
+        iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6, refresh=True)
         iptc_rule  = _encode_iptc_rule(rule_d, ipv6=ipv6)
         iptc_chain.delete_rule(iptc_rule)
+        index = _iptc_getindex(table, chain, ipv6=ipv6, build=False)
+        fingerprint = _rule_fingerprint(rule_d, ipv6=ipv6)
+        if index is not None and fingerprint in index:
+            index.delete(fingerprint)
+            _cache_update(table, ipv6=ipv6)
+        else:
+            _cache_update(table, chain=chain, ipv6=ipv6, drop_index=True)
     except Exception as e:
         if not silent:
             raise
@@ -163,12 +332,12 @@ def get_rule(table, chain, position=0, ipv6=False, silent=False):
         elif position > 0:
             # Return specific rule by position
             iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
-            iptc_rule = iptc_chain.rules[position - 1]
+            iptc_rule = _iptc_rules(iptc_chain)[position - 1]
             return _decode_iptc_rule(iptc_rule, ipv6=ipv6)
         elif position < 0:
             # Return last rule  -> not available in iptables CLI
             iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
-            iptc_rule = iptc_chain.rules[position]
+            iptc_rule = _iptc_rules(iptc_chain)[position]
             return _decode_iptc_rule(iptc_rule, ipv6=ipv6)
     except Exception as e:
         if not silent:
@@ -176,27 +345,139 @@ def get_rule(table, chain, position=0, ipv6=False, silent=False):
 
 def replace_rule(table, chain, old_rule_d, new_rule_d, ipv6=False):
     """ Replaces an existing rule of a chain """
-    iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
-    iptc_old_rule = _encode_iptc_rule(old_rule_d, ipv6=ipv6)
+    iptc_chain, iptc_rule, index, position = _iptc_getrule(table, chain, old_rule_d, ipv6=ipv6)
     iptc_new_rule = _encode_iptc_rule(new_rule_d, ipv6=ipv6)
-    iptc_chain.replace_rule(iptc_new_rule, iptc_chain.rules.index(iptc_old_rule))
+    iptc_chain.replace_rule(iptc_new_rule, position)
+    index.replace(position, _rule_fingerprint(new_rule_d, ipv6=ipv6))
+    _cache_update(table, ipv6=ipv6)
 
 def get_rule_statistics(table, chain, rule_d, ipv6=False):
     """ Return a tuple with the rule counters (numberOfBytes, numberOfPackets) """
-    if not has_rule(table, chain, rule_d, ipv6=ipv6):
-        raise AttributeError('Chain <{}@{}> has no rule <{}>'.format(chain, table, rule_d))
-    iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
-    iptc_rule  = _encode_iptc_rule(rule_d, ipv6=ipv6)
-    iptc_rule_index = iptc_chain.rules.index(iptc_rule)
-    return iptc_chain.rules[iptc_rule_index].get_counters()
+    # Counters are read from a refreshed table
+    iptc_chain, iptc_rule, index, position = _iptc_getrule(table, chain, rule_d, ipv6=ipv6)
+    counters = iptc_rule.get_counters()
+    index.counters[position] = counters
+    return counters
 
 def get_rule_position(table, chain, rule_d, ipv6=False):
     """ Return the position of a rule within a chain """
-    if not has_rule(table, chain, rule_d):
+    index = _iptc_getindex(table, chain, ipv6=ipv6)
+    fingerprint = _rule_fingerprint(rule_d, ipv6=ipv6)
+    if fingerprint not in index:
         raise AttributeError('Chain <{}@{}> has no rule <{}>'.format(chain, table, rule_d))
-    iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
-    iptc_rule  = _encode_iptc_rule(rule_d, ipv6=ipv6)
-    return iptc_chain.rules.index(iptc_rule)
+    return index.position(fingerprint)
+
+def get_chain_counters(table, chain, ipv6=False, zero=False):
+    """ Return a RuleCounters of all rules of a chain read in a single pass, zero the counters in the same commit """
+    return get_table_counters(table, chains=(chain, ), ipv6=ipv6, zero=zero)[chain]
+
+def get_table_counters(table, chains=None, ipv6=False, zero=False):
+    """ Return a dictionary of format {chain: RuleCounters} read in a single pass, zero the counters in the same commit """
+    d = {}
+    iptc_table = _batch_begin_table(table, ipv6=ipv6)
+    try:
+        if chains is None:
+            chains = [iptc_chain.name for iptc_chain in iptc_table.chains]
+        indexes = {}
+        for chain in chains:
+            if not iptc_table.is_chain(chain):
+                raise AttributeError('Table <{}> has no chain <{}>'.format(table, chain))
+            d[chain], indexes[chain] = _harvest_chain(_backend().chain(iptc_table, chain), table, ipv6=ipv6)
+            if zero:
+                _backend().chain(iptc_table, chain).zero_counters()
+    except Exception:
+        _batch_abort_table(table, ipv6=ipv6)
+        raise
+    _batch_end_table(table, ipv6=ipv6)
+    # Keep the indexes of the harvested chains
+    snapshot = _TABLE_CACHE.get((table, ipv6))
+    if snapshot is not None:
+        for chain, index in indexes.items():
+            if zero:
+                index.counters = [(0, 0)] * len(index)
+            snapshot.indexes[chain] = index
+    return d
+
+
+class RuleCounters(object):
+    """ Counters of the rules of a chain stored in arrays, positions start at 0 """
+    __slots__ = ('table', 'chain', 'ipv6', 'timestamp', 'fingerprints', 'packets', 'bytes', 'positions')
+
+    def __init__(self, table, chain, ipv6=False):
+        self.table = table
+        self.chain = chain
+        self.ipv6 = ipv6
+        self.timestamp = time.monotonic()
+        self.fingerprints = []              # Stores the rule fingerprints in chain order
+        self.packets = array.array('Q')     # Stores the packet counters in chain order
+        self.bytes = array.array('Q')       # Stores the byte counters in chain order
+        self.positions = {}                 # Indexes fingerprints to their first position
+
+    def get(self, rule_d):
+        """ Return a tuple with the rule counters (packets, bytes) """
+        return self[_rule_fingerprint(rule_d, ipv6=self.ipv6)]
+
+    def totals(self):
+        """ Return a dictionary of format {fingerprint: (packets, bytes)} adding up duplicated rules """
+        d = {}
+        for i, fingerprint in enumerate(self.fingerprints):
+            packets, nbytes = d.get(fingerprint, (0, 0))
+            d[fingerprint] = (packets + self.packets[i], nbytes + self.bytes[i])
+        return d
+
+    def __getitem__(self, fingerprint):
+        i = self.positions[fingerprint]
+        return (self.packets[i], self.bytes[i])
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.positions
+
+    def __iter__(self):
+        return zip(self.fingerprints, self.packets, self.bytes)
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __repr__(self):
+        return 'RuleCounters <{}@{}> ({} rules)'.format(self.chain, self.table, len(self))
+
+class CounterPoller(object):
+    """
+    Poll the counters of the chains of a table and compute per-interval deltas and rates.
+    A counter lower than in the previous poll is considered reset and counted from 0.
+    """
+
+    def __init__(self, table, chains=None, ipv6=False, zero=False):
+        self.table = table
+        self.chains = chains
+        self.ipv6 = ipv6
+        self.zero = zero
+        self._last = None           # Indexes (chain, fingerprint) to (packets, bytes)
+        self._timestamp = None
+
+    def poll(self):
+        """
+        Return a dictionary of format {(chain, fingerprint): (packets, bytes, packets_rate, bytes_rate)}
+        with the deltas since the previous poll. The first poll returns an empty dictionary.
+        """
+        counters_d = get_table_counters(self.table, chains=self.chains, ipv6=self.ipv6, zero=self.zero)
+        timestamp = time.monotonic()
+        current = {}
+        for chain, counters in counters_d.items():
+            for fingerprint, value in counters.totals().items():
+                current[(chain, fingerprint)] = value
+        d = {}
+        if self._last is not None:
+            interval = (timestamp - self._timestamp) or 1e-9
+            for key, (packets, nbytes) in current.items():
+                # Zeroed counters start from 0 on every poll
+                last_packets, last_bytes = (0, 0) if self.zero else self._last.get(key, (0, 0))
+                delta_packets = packets - last_packets if packets >= last_packets else packets
+                delta_bytes = nbytes - last_bytes if nbytes >= last_bytes else nbytes
+                d[key] = (delta_packets, delta_bytes, delta_packets / interval, delta_bytes / interval)
+        self._last = current
+        self._timestamp = timestamp
+        return d
 
 
 def test_rule(rule_d, ipv6=False):
@@ -210,7 +491,7 @@ def test_rule(rule_d, ipv6=False):
 def test_match(name, value, ipv6=False):
     """ Return True if the match is valid, False otherwise """
     try:
-        iptc_rule = iptc.Rule6() if ipv6 else iptc.Rule()
+        iptc_rule = _backend().rule(ipv6=ipv6)
         _iptc_setmatch(iptc_rule, name, value)
         return True
     except:
@@ -219,7 +500,7 @@ def test_match(name, value, ipv6=False):
 def test_target(name, value, ipv6=False):
     """ Return True if the target is valid, False otherwise """
     try:
-        iptc_rule = iptc.Rule6() if ipv6 else iptc.Rule()
+        iptc_rule = _backend().rule(ipv6=ipv6)
         _iptc_settarget(iptc_rule, {name:value})
         return True
     except:
@@ -228,21 +509,17 @@ def test_target(name, value, ipv6=False):
 
 def repr_all(ipv6=False):
     """ Return a string representation of all tables """
-    s = ''
-    for table in ['security', 'raw', 'mangle', 'nat', 'filter']:
-        s += repr_table(table, ipv6=ipv6)
-    return s
-    #return '\n'.join(repr_table(table, ipv6=ipv6) for table in ['security', 'raw', 'mangle', 'nat', 'filter'])
+    return ''.join(repr_table(table, ipv6=ipv6) for table in ['security', 'raw', 'mangle', 'nat', 'filter'])
 
 def repr_table(table, ipv6=False):
     """ Return a string representation of a table """
     iptc_table = _iptc_gettable(table, ipv6=ipv6)
-    return '\n'.join('[{}]\n{}'.format(c.name, repr_chain(table, c.name)) for c in iptc_table.chains)
+    return '\n'.join('[{}]\n{}'.format(c.name, repr_chain(table, c.name, ipv6=ipv6)) for c in iptc_table.chains)
 
 def repr_chain(table, chain, ipv6=False, indent = '\t'):
     """ Return a string representation of a chain """
     iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
-    return '\n'.join('{}{}'.format(indent, _repr_rule(r, ipv6=ipv6)) for r in iptc_chain.rules)
+    return '\n'.join('{}{}'.format(indent, _repr_rule(r, ipv6=ipv6)) for r in _iptc_rules(iptc_chain))
 
 
 def dump_all(ipv6=False):
@@ -264,107 +541,1267 @@ def dump_chain(table, chain, ipv6=False):
     """ Return a list with the dictionary representation of the rules of a table """
     l = []
     iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
-    for i, iptc_rule in enumerate(iptc_chain.rules):
+    for i, iptc_rule in enumerate(_iptc_rules(iptc_chain)):
         l.append(_decode_iptc_rule(iptc_rule, ipv6=ipv6))
     return l
 
+def iter_all(ipv6=False):
+    """ Yield the rules of all tables one at a time with format (table, chain, index, rule_d, counters) """
+    for table in ['security', 'raw', 'mangle', 'nat', 'filter']:
+        yield from iter_table(table, ipv6=ipv6)
+
+def iter_table(table, ipv6=False):
+    """ Yield the rules of a table one at a time with format (table, chain, index, rule_d, counters) """
+    iptc_table = _iptc_gettable(table, ipv6=ipv6)
+    for chain in [iptc_chain.name for iptc_chain in iptc_table.chains]:
+        yield from iter_chain(table, chain, ipv6=ipv6)
+
+def iter_chain(table, chain, ipv6=False):
+    """ Yield the rules of a chain one at a time with format (table, chain, index, rule_d, counters), index starts at 1 """
+    iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6)
+    for i, iptc_rule in enumerate(_iptc_iterrules(iptc_chain), 1):
+        yield (table, chain, i, _decode_iptc_rule(iptc_rule, ipv6=ipv6), iptc_rule.get_counters())
+
+def write_jsonl(f, table=None, ipv6=False):
+    """
+    Write the rules of a table, or all tables if None, to a file object as one JSON object per line
+    with format {table, chain, index, rule, packets, bytes}. Return the number of rules written
+    """
+    records = iter_table(table, ipv6=ipv6) if table else iter_all(ipv6=ipv6)
+    n = 0
+    for (_table, chain, index, rule_d, (packets, nbytes)) in records:
+        f.write(json.dumps({'table': _table, 'chain': chain, 'index': index, 'rule': rule_d,
+                            'packets': packets, 'bytes': nbytes}))
+        f.write('\n')
+        n += 1
+    return n
+
+def write_save(f, table=None, ipv6=False, counters=False):
+    """ Write a table, or all tables if None, to a file object as iptables-save text. Return the number of rules written """
+    n = 0
+    for _table in ([table] if table else ['security', 'raw', 'mangle', 'nat', 'filter']):
+        iptc_table = _iptc_gettable(_table, ipv6=ipv6)
+        f.write('*{}\n'.format(_table))
+        for iptc_chain in iptc_table.chains:
+            # The policy counters are written as iptables-save does, user-defined chains have none
+            policy, policy_counters = iptc_table.get_policy(iptc_chain.name)
+            packets, nbytes = policy_counters or (0, 0)
+            f.write(':{} {} [{}:{}]\n'.format(iptc_chain.name, getattr(policy, 'name', policy) or '-', packets, nbytes))
+        for (_, chain, index, rule_d, (packets, nbytes)) in iter_table(_table, ipv6=ipv6):
+            if counters:
+                f.write('[{}:{}] '.format(packets, nbytes))
+            f.write('-A {} {}\n'.format(chain, _render_rule(rule_d, ipv6=ipv6)))
+            n += 1
+        f.write('COMMIT\n')
+    return n
+
+
+class Transaction(object):
+    """
+    Share uncommitted table handles among all the functions of this module.
+    Tables are loaded on first use and committed once when the transaction ends,
+    pending changes are discarded if an exception leaves the transaction.
+
+    The handles are process-wide, so the tables of the transaction are locked from begin to commit or rollback:
+    the functions of this module called from other threads on these tables wait for the end of the transaction.
+    Tables are committed one by one, a failed commit discards the tables not committed yet.
+    Changes done by other processes, or via python-iptc directly, are not isolated.
+    The iter_ generators do not hold the lock between two rules.
+
+    with Transaction(('filter', 'nat'), ipv6=(False, True)) as t:
+        add_rule('filter', 'INPUT', rule_d)
+    """
+
+    def __init__(self, tables=None, ipv6=False):
+        if isinstance(tables, str):
+            tables = (tables, )
+        self.tables = tuple(tables) if tables else ('security', 'raw', 'mangle', 'nat', 'filter')
+        self.families = tuple(ipv6) if isinstance(ipv6, (list, tuple)) else (ipv6, )
+        self.roundtrips = 0         # Number of kernel round trips done by the transaction
+        self.roundtrips_saved = 0   # Number of kernel round trips avoided by the transaction
+        self._handles = {}          # Indexes (table, ipv6) to uncommitted iptc_table
+        self._locks = []            # Table locks held by the transaction
+
+    def covers(self, table, ipv6=False):
+        """ Return True if the table is part of the transaction """
+        return table in self.tables and ipv6 in self.families
+
+    def gettable(self, table, ipv6=False):
+        """ Return the uncommitted iptc_table of the transaction, load it on first use """
+        key = (table, ipv6)
+        if key not in self._handles:
+            iptc_table = _iptc_loadtable(table, ipv6=ipv6, refresh=True)
+            iptc_table.autocommit = False
+            self._handles[key] = iptc_table
+            self.roundtrips += 1
+        return self._handles[key]
+
+    def begin(self):
+        """ Make the transaction active in the current thread """
+        if getattr(_LOCAL, 'transaction', None) is not None:
+            raise Exception('Failed to begin: transaction already in progress')
+        # Acquire in a fixed order, transactions on overlapping tables cannot deadlock
+        for (table, ipv6) in sorted(set(itertools.product(self.tables, self.families))):
+            lock = _table_lock(table, ipv6=ipv6)
+            lock.acquire()
+            self._locks.append(lock)
+        _LOCAL.transaction = self
+        return self
+
+    def commit(self):
+        """ Commit all the tables of the transaction in a single round trip per table """
+        _LOCAL.transaction = None
+        try:
+            while self._handles:
+                (table, ipv6), iptc_table = next(iter(self._handles.items()))
+                try:
+                    # Refresh ignores the errors of its own commit
+                    iptc_table.commit()
+                except Exception:
+                    # Discard the pending changes of the tables not committed yet
+                    self.rollback()
+                    raise
+                del self._handles[(table, ipv6)]
+                iptc_table.refresh()
+                iptc_table.autocommit = True
+                self.roundtrips += 1
+                _cache_update(table, ipv6=ipv6)
+        finally:
+            self._release()
+
+    def rollback(self):
+        """ Discard the pending changes of all the tables of the transaction """
+        _LOCAL.transaction = None
+        handles, self._handles = self._handles, {}
+        try:
+            for (table, ipv6), iptc_table in handles.items():
+                iptc_table.close()
+                iptc_table.autocommit = True
+                iptc_table.refresh()
+                if INSTRUMENT:
+                    _instrument_count('refresh')
+                _cache_invalidate(table, ipv6=ipv6)
+        finally:
+            self._release()
+
+    def _release(self):
+        locks, self._locks = self._locks, []
+        for lock in reversed(locks):
+            lock.release()
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def __repr__(self):
+        return 'Transaction {} ipv6={} ({} roundtrips, {} saved)'.format(self.tables, self.families,
+                                                                         self.roundtrips, self.roundtrips_saved)
 
 def batch_begin(table = None, ipv6=False):
-    """ Disable autocommit on a table """
-    MODE_BATCH = True
-    if table:
-        tables = (table, )
-    else:
-        tables = ('security', 'raw', 'mangle', 'nat', 'filter')
-    for table in tables:
-        iptc_table = _iptc_gettable(table, ipv6=ipv6)
-        iptc_table.autocommit = False
+    """ Disable autocommit on a table, or all tables if None, until batch_end in the same thread """
+    _LOCAL.batch = Transaction(table, ipv6=ipv6).begin()
 
 def batch_end(table = None, ipv6=False):
-    """ Enable autocommit on table and commit changes """
-    MODE_BATCH = False
-    if table:
-        tables = (table, )
-    else:
-        tables = ('security', 'raw', 'mangle', 'nat', 'filter')
-    for table in tables:
-        iptc_table = _iptc_gettable(table, ipv6=ipv6)
-        iptc_table.autocommit = True
+    """ Enable autocommit and commit the changes of all tables since batch_begin in the same thread """
+    transaction = getattr(_LOCAL, 'batch', None)
+    _LOCAL.batch = None
+    if transaction is not None:
+        transaction.commit()
+
+class WriteCoalescer(object):
+    """
+    Buffer add_rule/delete_rule mutations and apply them with one commit per table.
+    Mutations are flushed after window seconds since the first buffered one, or when count are buffered.
+    The add of a rule followed by its delete cancel each other out.
+    Mutations return a concurrent.futures.Future, use the _async variants from asyncio.
+    """
+
+    def __init__(self, window=0.05, count=1000):
+        self.window = window
+        self.count = count
+        self.flushes = 0            # Number of flushes done
+        self.cancelled = 0          # Number of mutations cancelled out before reaching the kernel
+        self.flush_latency = 0.0    # Duration of the last flush in seconds
+        self.flush_latency_max = 0.0
+        self.flush_latency_total = 0.0
+        self._pending = []          # Stores the buffered mutations in order
+        self._adds = {}             # Indexes (table, chain, ipv6, fingerprint) to buffered adds
+        self._depth = 0
+        self._deadline = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def depth(self):
+        """ Return the number of buffered mutations """
+        return self._depth
+
+    def add_rule(self, table, chain, rule_d, position=0, ipv6=False):
+        """ Buffer add_rule and return a Future resolved when the commit lands """
+        key = (table, chain, ipv6, _fingerprint(rule_d))
+        entry = ['add', table, chain, rule_d, position, ipv6, concurrent.futures.Future()]
+        with self._cond:
+            self._adds.setdefault(key, []).append(entry)
+            self._submit(entry)
+        return entry[-1]
+
+    def delete_rule(self, table, chain, rule_d, ipv6=False):
+        """ Buffer delete_rule and return a Future resolved when the commit lands """
+        key = (table, chain, ipv6, _fingerprint(rule_d))
+        future = concurrent.futures.Future()
+        with self._cond:
+            adds = self._adds.get(key)
+            if not adds:
+                self._submit(['delete', table, chain, rule_d, None, ipv6, future])
+                return future
+            # Cancel out the buffered add of the same rule
+            entry = adds.pop()
+            entry[0] = None
+            self._depth -= 1
+            self.cancelled += 2
+        entry[-1].set_result(None)
+        future.set_result(None)
+        return future
+
+    def add_rule_async(self, table, chain, rule_d, position=0, ipv6=False):
+        """ Buffer add_rule and return an asyncio Future """
+        return asyncio.wrap_future(self.add_rule(table, chain, rule_d, position=position, ipv6=ipv6))
+
+    def delete_rule_async(self, table, chain, rule_d, ipv6=False):
+        """ Buffer delete_rule and return an asyncio Future """
+        return asyncio.wrap_future(self.delete_rule(table, chain, rule_d, ipv6=ipv6))
+
+    def flush(self):
+        """ Apply the buffered mutations in the calling thread """
+        # Taking and applying under the same lock commits the flushes in the order they were buffered
+        with self._flush_lock:
+            with self._cond:
+                pending = self._take()
+            self._apply(pending)
+
+    def close(self):
+        """ Apply the buffered mutations and stop the flushing thread """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _submit(self, entry):
+        if self._closed:
+            raise Exception('Failed to submit: coalescer is closed')
+        self._pending.append(entry)
+        self._depth += 1
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='WriteCoalescer', daemon=True)
+            self._thread.start()
+        if self._deadline is None:
+            # Wake up the flushing thread waiting without a deadline
+            self._deadline = time.monotonic() + self.window
+            self._cond.notify()
+        elif self._depth >= self.count:
+            self._cond.notify()
+
+    def _take(self):
+        pending, self._pending = self._pending, []
+        self._adds.clear()
+        self._depth = 0
+        self._deadline = None
+        return pending
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._deadline is None:
+                        self._cond.wait()
+                        continue
+                    timeout = self._deadline - time.monotonic()
+                    if timeout <= 0 or self._depth >= self.count:
+                        break
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+            self.flush()
+
+    def _apply(self, pending):
+        """ Apply mutations with one transaction per table, resolving their futures, called holding the flush lock """
+        groups = {}
+        for entry in pending:
+            if entry[0] is not None:
+                groups.setdefault((entry[1], entry[5]), []).append(entry)
+        if not groups:
+            return
+        start = time.monotonic()
+        for (table, ipv6), entries in groups.items():
+            done = []
+            try:
+                with Transaction(table, ipv6=ipv6):
+                    for (op, table, chain, rule_d, position, ipv6, future) in entries:
+                        try:
+                            if op == 'add':
+                                add_rule(table, chain, rule_d, position=position, ipv6=ipv6)
+                            else:
+                                delete_rule(table, chain, rule_d, ipv6=ipv6)
+                            done.append(future)
+                        except Exception as e:
+                            future.set_exception(e)
+            except Exception as e:
+                for future in done:
+                    future.set_exception(e)
+            else:
+                for future in done:
+                    future.set_result(None)
+        self.flushes += 1
+        self.flush_latency = time.monotonic() - start
+        self.flush_latency_max = max(self.flush_latency_max, self.flush_latency)
+        self.flush_latency_total += self.flush_latency
+
+    def __repr__(self):
+        return 'WriteCoalescer ({} pending, {} flushes, {} cancelled)'.format(self._depth, self.flushes, self.cancelled)
 
 def batch_add_chains(table, chains, ipv6=False, flush=True):
     """ Add multiple chains to a table """
     iptc_table = _batch_begin_table(table, ipv6=ipv6)
-    for chain in chains:
-        if iptc_table.is_chain(chain):
-            iptc_chain = iptc.Chain(iptc_table, chain)
-        else:
-            iptc_chain = iptc_table.create_chain(chain)
-        if flush:
-            iptc_chain.flush()
+    try:
+        for chain in chains:
+            if iptc_table.is_chain(chain):
+                iptc_chain = _backend().chain(iptc_table, chain)
+            else:
+                iptc_chain = iptc_table.create_chain(chain)
+            if flush:
+                iptc_chain.flush()
+    except Exception:
+        _batch_abort_table(table, ipv6=ipv6)
+        raise
     _batch_end_table(table, ipv6=ipv6)
 
 def batch_delete_chains(table, chains, ipv6=False):
     """ Delete multiple chains of a table """
     iptc_table = _batch_begin_table(table, ipv6=ipv6)
-    for chain in chains:
-        if iptc_table.is_chain(chain):
-            iptc_chain = iptc.Chain(iptc_table, chain)
-            iptc_chain.flush()
-            iptc_table.delete_chain(chain)
+    try:
+        for chain in chains:
+            if iptc_table.is_chain(chain):
+                iptc_chain = _backend().chain(iptc_table, chain)
+                iptc_chain.flush()
+                iptc_table.delete_chain(chain)
+    except Exception:
+        _batch_abort_table(table, ipv6=ipv6)
+        raise
     _batch_end_table(table, ipv6=ipv6)
 
-def batch_add_rules(table, batch_rules, ipv6=False):
+def batch_add_rules(table, batch_rules, ipv6=False, backend=None):
     """ Add multiple rules to a table with format (chain, rule_d, position) """
+    if (backend or BATCH_BACKEND) == 'restore':
+        restore_rules(table, batch_rules, ipv6=ipv6)
+        return
     iptc_table = _batch_begin_table(table, ipv6=ipv6)
-    for (chain, rule_d, position) in batch_rules:
-        iptc_chain = iptc.Chain(iptc_table, chain)
-        iptc_rule  = _encode_iptc_rule(rule_d, ipv6=ipv6)
-        if position == 0:
-            # Insert rule in last position -> append
-            iptc_chain.append_rule(iptc_rule)
-        elif position > 0:
-            # Insert rule in given position -> adjusted as iptables CLI
-            iptc_chain.insert_rule(iptc_rule, position-1)
-        elif position < 0:
-            # Insert rule in given position starting from bottom -> not available in iptables CLI
-            nof_rules = len(iptc_chain.rules)
-            iptc_chain.insert_rule(iptc_rule, position + nof_rules)
+    try:
+        for (chain, rule_d, position) in batch_rules:
+            iptc_chain = _backend().chain(iptc_table, chain)
+            iptc_rule  = _encode_iptc_rule(rule_d, ipv6=ipv6)
+            if position == 0:
+                # Insert rule in last position -> append
+                iptc_chain.append_rule(iptc_rule)
+            elif position > 0:
+                # Insert rule in given position -> adjusted as iptables CLI
+                iptc_chain.insert_rule(iptc_rule, position-1)
+            elif position < 0:
+                # Insert rule in given position starting from bottom -> not available in iptables CLI
+                nof_rules = len(_iptc_rules(iptc_chain))
+                iptc_chain.insert_rule(iptc_rule, position + nof_rules)
+    except Exception:
+        _batch_abort_table(table, ipv6=ipv6)
+        raise
     _batch_end_table(table, ipv6=ipv6)
 
-def batch_delete_rules(table, batch_rules, ipv6=False, silent=True):
+def batch_delete_rules(table, batch_rules, ipv6=False, silent=True, backend=None):
     """ Delete  multiple rules from  table with format (chain, rule_d) """
     try:
+        if (backend or BATCH_BACKEND) == 'restore':
+            restore_rules(table, [(chain, rule_d, None) for (chain, rule_d) in batch_rules], ipv6=ipv6)
+            return
         iptc_table = _batch_begin_table(table, ipv6=ipv6)
-        for (chain, rule_d) in batch_rules:
-            iptc_chain = iptc.Chain(iptc_table, chain)
-            iptc_rule  = _encode_iptc_rule(rule_d, ipv6=ipv6)
-            iptc_chain.delete_rule(iptc_rule)
+        try:
+            for (chain, rule_d) in batch_rules:
+                iptc_chain = _backend().chain(iptc_table, chain)
+                iptc_rule  = _encode_iptc_rule(rule_d, ipv6=ipv6)
+                iptc_chain.delete_rule(iptc_rule)
+        except Exception:
+            _batch_abort_table(table, ipv6=ipv6)
+            raise
         _batch_end_table(table, ipv6=ipv6)
     except Exception as e:
         if not silent:
             raise
 
 
+def reconcile(desired, table, ipv6=False, dry_run=False):
+    """
+    Reconcile a table with a desired state with the format of dump_table {chain: [rule_d]}.
+    The difference with the current snapshot is applied in a single commit, chains not in desired are left untouched.
+    Return the operations with format (operation, chain, position, rule_d), positions start at 1 as in iptables CLI
+    Operations are add_chain, flush, insert, replace and delete.
+    """
+    plan, indexes = _reconcile_plan(desired, table, ipv6=ipv6)
+    if dry_run or not plan:
+        return [op[:4] for op in plan]
+    _reconcile_apply(table, plan, ipv6=ipv6)
+    # The new state of the chains is known, keep the indexes up to date
+    snapshot = _TABLE_CACHE.get((table, ipv6))
+    if snapshot is not None:
+        snapshot.indexes.update(indexes)
+    return [op[:4] for op in plan]
+
+
+def translate_rule(rule_d, ipv6=False):
+    """
+    Return a rule_d written for IPv4 translated to the family of ipv6, or None if the rule does not apply to it.
+    IPv6 drops fragment and translates icmp into icmp6, rules with addresses of the other family do not apply.
+    """
+    family = _rule_family(rule_d)
+    if family is not None and family != (6 if ipv6 else 4):
+        return None
+    if not ipv6:
+        if 'icmp6' in rule_d or str(rule_d.get('protocol', '')).lstrip('!') in ('icmpv6', 'ipv6-icmp', '58'):
+            return None
+        return rule_d
+    d = {}
+    for name, value in rule_d.items():
+        if name == 'fragment':
+            continue
+        elif name == 'protocol' and str(value).lstrip('!') in ('icmp', '1'):
+            d[name] = '!icmpv6' if str(value).startswith('!') else 'icmpv6'
+        elif name == 'icmp':
+            value = _translate_icmp(value)
+            if value is None:
+                return None
+            d['icmp6'] = value
+        elif name == 'target':
+            d[name] = _translate_target(value)
+        else:
+            d[name] = value
+    return d
+
+def batch_add_rules_dual(table, batch_rules, backend=None):
+    """ Add multiple rules with format (chain, rule_d, position) to the IPv4 and IPv6 tables, committed in parallel """
+    return _dual_apply(table, lambda ipv6: batch_add_rules(table, _dual_batch(batch_rules, ipv6), ipv6=ipv6, backend=backend))
+
+def batch_delete_rules_dual(table, batch_rules, silent=True, backend=None):
+    """ Delete multiple rules with format (chain, rule_d) from the IPv4 and IPv6 tables, committed in parallel """
+    return _dual_apply(table, lambda ipv6: batch_delete_rules(table, _dual_batch(batch_rules, ipv6), ipv6=ipv6,
+                                                              silent=silent, backend=backend))
+
+def reconcile_dual(desired, table, dry_run=False):
+    """ Reconcile the IPv4 and IPv6 tables with a desired state committed in parallel, return the operations with format {ipv6: ops} """
+    def _reconcile(ipv6):
+        family_desired = {}
+        for chain, rules in desired.items():
+            family_desired[chain] = [_rule for _rule in (translate_rule(rule_d, ipv6=ipv6) for rule_d in rules) if _rule is not None]
+        return reconcile(family_desired, table, ipv6=ipv6, dry_run=dry_run)
+    return _dual_apply(table, _reconcile)
+
+def shard_rules(chain, rules, field='src', leaf_size=16, fanout=2):
+    """
+    Split a long list of rules matching on src or dst into a balanced tree of sub-chains.
+    Inner chains jump to their children with an iprange match, so every packet is checked against O(log n) rules.
+    The ranges of the rules must be either equal or disjoint, otherwise the order of evaluation would change.
+    Return a tuple with the chains with format {chain: [rule_d]}, to be used with reconcile or restore_table,
+    and the leaves with format [(first, last, leaf_chain)] sorted by address to be used with shard_lookup.
+    """
+    if field not in ('src', 'dst'):
+        raise ValueError('Field {} not supported, use src or dst'.format(field))
+    if leaf_size < 1 or fanout < 2:
+        raise ValueError('Invalid leaf_size {} or fanout {}'.format(leaf_size, fanout))
+    items = []
+    for i, rule_d in enumerate(rules):
+        first, last = _shard_range(rule_d, field)
+        items.append((first, last, i, rule_d))
+    # Stable sort by address range, rule order is kept for equal ranges
+    items.sort(key=lambda x: (x[0], x[1], x[2]))
+    for prev, item in zip(items, items[1:]):
+        if (prev[0], prev[1]) != (item[0], item[1]) and item[0] <= prev[1]:
+            raise ValueError('Rules with overlapping {} {} and {} cannot be sharded'.format(field, prev[3][field], item[3][field]))
+    chains_d = {}
+    leaves = []
+    _shard_tree(chain, chain, items, field, leaf_size, fanout, chains_d, leaves, [0])
+    return (chains_d, leaves)
+
+def shard_lookup(leaves, rule_d, field='src'):
+    """
+    Return the leaf chain of a sharded tree where a rule_d is to be added or removed,
+    or None if the rule is not covered by any leaf and the rules need to be sharded again
+    """
+    first, last = _shard_range(rule_d, field)
+    i = bisect.bisect_right(leaves, (first, ))
+    if i == len(leaves) or leaves[i][0] != first:
+        i -= 1
+    if i < 0 or leaves[i][1] < last:
+        return None
+    return leaves[i][2]
+
+
+def compile_ipsets(rules, ipv6=False, prefix='iptc', min_size=2, reorder=False):
+    """
+    Collapse groups of rules that only differ in src or dst into a single rule with a set match.
+    Only consecutive rules are grouped unless reorder is set, when the order of the rules does not matter.
+    Return a tuple with the new rules and the sets with format {name: {'stype', 'family', 'entries'}}.
+    Set names are derived from the rest of the rule so compiling the same rules yields the same names.
+    """
+    groups = []         # Stores lists of (rule_d, field, key) in order
+    last = {}           # Indexes group keys to their last group when reordering
+    for rule_d in rules:
+        field = _ipset_field(rule_d)
+        key = None
+        if field is not None:
+            rest = {k: v for k, v in rule_d.items() if k != field}
+            key = (field, _fingerprint(rest))
+        if key is not None and reorder and key in last:
+            last[key].append((rule_d, field, key))
+        elif key is not None and not reorder and groups and groups[-1][0][2] == key:
+            groups[-1].append((rule_d, field, key))
+        else:
+            groups.append([(rule_d, field, key)])
+            last[key] = groups[-1]
+    new_rules = []
+    sets = {}
+    seen = {}           # Indexes group keys to the number of sets created
+    for group in groups:
+        rule_d, field, key = group[0]
+        if key is None or len(group) < min_size:
+            new_rules += [item[0] for item in group]
+            continue
+        seen[key] = seen.get(key, 0) + 1
+        name = _ipset_name(prefix, (key, seen[key]), ipv6)
+        entries = [item[0][field] for item in group]
+        networks = [ipaddress.ip_network(entry, strict=False) for entry in entries]
+        is_host = all(n.prefixlen == n.max_prefixlen for n in networks)
+        sets[name] = {'stype': 'hash:ip' if is_host else 'hash:net',
+                      'family': socket.AF_INET6 if ipv6 else socket.AF_INET,
+                      'entries': [str(n.network_address) if is_host else str(n) for n in networks]}
+        new_rule_d = {k: v for k, v in rule_d.items() if k != field}
+        set_d = {'match-set': [name, field]}
+        if 'set' not in new_rule_d:
+            new_rule_d['set'] = set_d
+        elif isinstance(new_rule_d['set'], list):
+            new_rule_d['set'] = new_rule_d['set'] + [set_d]
+        else:
+            new_rule_d['set'] = [new_rule_d['set'], set_d]
+        new_rules.append(new_rule_d)
+    return (new_rules, sets)
+
+def apply_ipsets(sets):
+    """ Create the sets returned by compile_ipsets, existing sets are replaced atomically with a swap """
+    import iproute2_helper3
+    for name, set_d in sets.items():
+        etype = 'ip' if set_d['stype'] == 'hash:ip' else 'net'
+        maxelem = max(65536, len(set_d['entries']))
+        exists = iproute2_helper3.ipset_exists(name)
+        target = '{}_'.format(name[:IPSET_MAXLEN - 1]) if exists else name
+        if exists and iproute2_helper3.ipset_exists(target):
+            iproute2_helper3.ipset_destroy(target)
+        iproute2_helper3.ipset_create(target, stype=set_d['stype'], family=set_d['family'], maxelem=maxelem)
+        for entry in set_d['entries']:
+            iproute2_helper3.ipset_add(target, entry, family=set_d['family'], etype=etype)
+        if exists:
+            iproute2_helper3.ipset_swap(target, name)
+            iproute2_helper3.ipset_destroy(target)
+
+
+def restore_table(table, chains_d, ipv6=False, noflush=False, policies=None):
+    """
+    Apply a dictionary representation of a table with format {chain: [rule_d]} in a single iptables-restore.
+    Without noflush the table is replaced atomically, otherwise only the given chains are flushed and rewritten.
+    Policies of built-in chains can be set with a dictionary of format {chain: policy}.
+    """
+    text = render_restore_table(table, chains_d, ipv6=ipv6, policies=policies)
+    _restore_exec(text, ipv6=ipv6, noflush=noflush)
+    _cache_invalidate(table, ipv6=ipv6)
+
+def restore_rules(table, batch_rules, ipv6=False):
+    """
+    Apply multiple rule operations to a table in a single iptables-restore --noflush.
+    Format (chain, rule_d, position) with position 0=append, n=nth position, None=delete
+    """
+    text = render_restore_rules(table, batch_rules, ipv6=ipv6)
+    _restore_exec(text, ipv6=ipv6, noflush=True)
+    _cache_invalidate(table, ipv6=ipv6)
+
+def save_dump_all(ipv6=False, counters=False, path=None):
+    """
+    Return a dictionary representation of all tables parsed from iptables-save or from a saved file.
+    With counters the rules are returned as tuples of (rule_d, (packets, bytes))
+    """
+    return parse_save(_save_read(ipv6=ipv6, counters=counters, path=path), ipv6=ipv6, counters=counters)
+
+def save_dump_table(table, ipv6=False, counters=False, path=None):
+    """ Return a dictionary representation of a table parsed from iptables-save or from a saved file """
+    text = _save_read(table, ipv6=ipv6, counters=counters, path=path)
+    return parse_save(text, ipv6=ipv6, counters=counters).get(table, {})
+
+def save_dump_chain(table, chain, ipv6=False, counters=False, path=None):
+    """ Return a list with the dictionary representation of the rules of a chain parsed from iptables-save """
+    d = save_dump_table(table, ipv6=ipv6, counters=counters, path=path)
+    if chain not in d:
+        raise AttributeError('Table <{}> has no chain <{}>'.format(table, chain))
+    return d[chain]
+
+def parse_save(text, ipv6=False, counters=False):
+    """
+    Return a dictionary representation of iptables-save text with format {table: {chain: [rule_d]}}.
+    With counters the rules are returned as tuples of (rule_d, (packets, bytes)), use iptables-save -c
+    """
+    d = {}
+    chains_d = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        elif line.startswith('*'):
+            chains_d = d.setdefault(line[1:], {})
+        elif line.startswith(':'):
+            chains_d.setdefault(line[1:].split()[0], [])
+        elif line == 'COMMIT':
+            chains_d = None
+        else:
+            chain, rule_d, rule_counters = _parse_save_rule(line, ipv6=ipv6)
+            rules = chains_d.setdefault(chain, [])
+            rules.append((rule_d, rule_counters) if counters else rule_d)
+    return d
+
+
+def render_restore_table(table, chains_d, ipv6=False, policies=None):
+    """ Return the iptables-restore text of a dictionary representation of a table """
+    policies = policies or {}
+    lines = ['*{}'.format(table)]
+    for chain in chains_d:
+        if chain in BUILTIN_CHAINS.get(table, ()):
+            if chain in policies:
+                lines.append(':{} {} [0:0]'.format(chain, policies[chain]))
+        else:
+            lines.append(':{} - [0:0]'.format(chain))
+    for chain, rules in chains_d.items():
+        for rule_d in rules:
+            lines.append('-A {} {}'.format(chain, _render_rule(rule_d, ipv6=ipv6)))
+    lines.append('COMMIT\n')
+    return '\n'.join(lines)
+
+def render_restore_rules(table, batch_rules, ipv6=False):
+    """ Return the iptables-restore --noflush text of multiple rule operations with format (chain, rule_d, position) """
+    lines = ['*{}'.format(table)]
+    for (chain, rule_d, position) in batch_rules:
+        if position is None:
+            lines.append('-D {} {}'.format(chain, _render_rule(rule_d, ipv6=ipv6)))
+        elif position == 0:
+            lines.append('-A {} {}'.format(chain, _render_rule(rule_d, ipv6=ipv6)))
+        elif position > 0:
+            lines.append('-I {} {} {}'.format(chain, position, _render_rule(rule_d, ipv6=ipv6)))
+        else:
+            raise ValueError('Negative position {} not supported by iptables-restore'.format(position))
+    lines.append('COMMIT\n')
+    return '\n'.join(lines)
+
+
+class BackendError(Exception):
+    """ Error of an operation on the table model of the memory and restore backends """
+    pass
+
+def set_backend(backend):
+    """
+    Set the backend of the table handles, either iptc, restore, memory or a backend object.
+    The snapshot and encoding caches are cleared as they hold objects of the previous backend
+    Return the backend object
+    """
+    global _BACKEND
+    if backend == 'iptc':
+        backend = IptcBackend()
+    elif backend == 'restore':
+        backend = SaveRestoreBackend()
+    elif backend == 'memory':
+        backend = MemoryBackend()
+    elif isinstance(backend, str):
+        raise ValueError('Unknown backend <{}>'.format(backend))
+    _BACKEND = backend
+    _TABLE_CACHE.clear()
+    clear_encode_cache()
+    return backend
+
+def get_backend():
+    """ Return the backend object of the table handles """
+    return _backend()
+
+class IptcBackend(object):
+    """
+    Backend of python-iptc operating on libiptc.
+    Every backend creates objects with the interface of iptc.Table, iptc.Chain and iptc.Rule
+    """
+    name = 'iptc'
+
+    def __init__(self):
+        if iptc is None:
+            raise ImportError('python-iptc is not available')
+
+    def table(self, name, ipv6=False):
+        return iptc.Table6(name) if ipv6 else iptc.Table(name)
+
+    def chain(self, iptc_table, name):
+        return iptc.Chain(iptc_table, name)
+
+    def rule(self, ipv6=False):
+        return iptc.Rule6() if ipv6 else iptc.Rule()
+
+class MemoryBackend(object):
+    """
+    Backend of a pure Python table model, the committed state is kept in memory.
+    Tables are singletons working on an uncommitted copy of the committed state, as libiptc handles do
+    """
+    name = 'memory'
+
+    def __init__(self):
+        self.commits = 0            # Number of writes of the committed state
+        self.refreshes = 0          # Number of reads of the committed state
+        self._state = {}            # Indexes (table, ipv6) to committed ({chain: [rule]}, {chain: policy})
+        self._tables = {}           # Indexes (table, ipv6) to _MemoryTable
+
+    def table(self, name, ipv6=False):
+        key = (name, ipv6)
+        if key not in self._tables:
+            if name not in BUILTIN_CHAINS:
+                raise BackendError('Table does not exist <{}>'.format(name))
+            self._tables[key] = _MemoryTable(self, name, ipv6=ipv6)
+        return self._tables[key]
+
+    def chain(self, iptc_table, name):
+        return _MemoryChain(iptc_table, name)
+
+    def rule(self, ipv6=False):
+        return _MemoryRule(ipv6=ipv6)
+
+    def load(self, name, ipv6=False):
+        """ Return a copy of the committed state of a table with format ({chain: [rule]}, {chain: policy}) """
+        self.refreshes += 1
+        key = (name, ipv6)
+        if key not in self._state:
+            builtin = BUILTIN_CHAINS[name]
+            self._state[key] = ({chain: [] for chain in builtin}, {chain: 'ACCEPT' for chain in builtin})
+        chains, policies = self._state[key]
+        return ({chain: list(rules) for chain, rules in chains.items()}, dict(policies))
+
+    def store(self, name, chains, policies, ipv6=False):
+        """ Replace the committed state of a table """
+        self.commits += 1
+        self._state[(name, ipv6)] = ({chain: list(rules) for chain, rules in chains.items()}, dict(policies))
+
+    def policy_counters(self, name, chain, ipv6=False):
+        """ Return the counters (packets, bytes) of the policy of a built-in chain, no packet traverses the memory tables """
+        return (0, 0)
+
+class SaveRestoreBackend(MemoryBackend):
+    """
+    Backend of the table model read with iptables-save and committed with iptables-restore.
+    A commit replaces the whole table with its counters in a single execution
+    """
+    name = 'restore'
+
+    def __init__(self):
+        super().__init__()
+        self._policy_counters = {}  # Indexes (table, ipv6) to {chain: (packets, bytes)} of the last load
+
+    def load(self, name, ipv6=False):
+        self.refreshes += 1
+        text = _save_read(name, ipv6=ipv6, counters=True)
+        chains = {chain: [] for chain in BUILTIN_CHAINS[name]}
+        policies = {chain: 'ACCEPT' for chain in BUILTIN_CHAINS[name]}
+        policy_counters = {}
+        for line in text.splitlines():
+            if line.startswith(':'):
+                fields = line[1:].split()
+                chain, policy = fields[:2]
+                chains.setdefault(chain, [])
+                if policy != '-':
+                    policies[chain] = policy
+                    if len(fields) > 2:
+                        policy_counters[chain] = tuple(int(value) for value in fields[2].strip('[]').split(':'))
+            elif line.startswith('-A') or line.startswith('['):
+                chain, rule_d, counters = _parse_save_rule(line, ipv6=ipv6)
+                rule = _build_iptc_rule(rule_d, ipv6=ipv6, backend=self)
+                chains.setdefault(chain, []).append(rule._copy(counters))
+        self._policy_counters[(name, ipv6)] = policy_counters
+        return (chains, policies)
+
+    def store(self, name, chains, policies, ipv6=False):
+        self.commits += 1
+        lines = ['*{}'.format(name)]
+        for chain in chains:
+            # The policy counters of the last load are restored, as the counters of the rules
+            packets, nbytes = self.policy_counters(name, chain, ipv6=ipv6) if chain in policies else (0, 0)
+            lines.append(':{} {} [{}:{}]'.format(chain, policies.get(chain, '-'), packets, nbytes))
+        for chain, rules in chains.items():
+            for rule in rules:
+                args = _render_rule(_decode_iptc_rule(rule, ipv6=ipv6), ipv6=ipv6)
+                lines.append('[{}:{}] -A {} {}'.format(*rule.get_counters(), chain, args))
+        lines.append('COMMIT\n')
+        _restore_exec('\n'.join(lines), ipv6=ipv6, counters=True)
+
+    def policy_counters(self, name, chain, ipv6=False):
+        return self._policy_counters.get((name, ipv6), {}).get(chain, (0, 0))
+
+
 ### INTERNAL FUNCTIONS ###
-def _iptc_gettable(table, ipv6=False):
-    """ Return an updated view of an iptc_table """
-    iptc_table = iptc.Table6(table) if ipv6 else iptc.Table(table)
-    if MODE_BATCH is False:
-        iptc_table.commit()
-        iptc_table.refresh()
+def _backend():
+    """ Return the backend of the table handles, python-iptc unless set_backend() was called """
+    if _BACKEND is None:
+        return set_backend('iptc')
+    return _BACKEND
+
+class _MemoryTable(object):
+    """ Table handle of the memory backend with the interface of iptc.Table """
+
+    def __init__(self, backend, name, ipv6=False):
+        self.name = name
+        self.autocommit = True
+        self._backend = backend
+        self._ipv6 = ipv6
+        self._dirty = False
+        self._chains, self._policies = backend.load(name, ipv6=ipv6)
+
+    @property
+    def chains(self):
+        return [_MemoryChain(self, chain) for chain in self._chains]
+
+    def commit(self):
+        if self._dirty:
+            self._backend.store(self.name, self._chains, self._policies, ipv6=self._ipv6)
+            self._dirty = False
+
+    def refresh(self):
+        self.commit()
+        self._chains, self._policies = self._backend.load(self.name, ipv6=self._ipv6)
+
+    def close(self):
+        # Discard the uncommitted changes
+        self._dirty = False
+        self._chains, self._policies = {}, {}
+
+    def is_chain(self, chain):
+        return chain in self._chains
+
+    def builtin_chain(self, chain):
+        return getattr(chain, 'name', chain) in BUILTIN_CHAINS[self.name]
+
+    def get_policy(self, chain):
+        """ Return a tuple (policy, (packets, bytes)) of a built-in chain, (None, None) otherwise """
+        chain = getattr(chain, 'name', chain)
+        if not self.builtin_chain(chain):
+            return (None, None)
+        return (self._policies.get(chain), self._backend.policy_counters(self.name, chain, ipv6=self._ipv6))
+
+    def create_chain(self, chain):
+        if chain in self._chains:
+            raise BackendError('Chain already exists <{}>'.format(chain))
+        self._chains[chain] = []
+        self._modified()
+        return _MemoryChain(self, chain)
+
+    def delete_chain(self, chain):
+        chain = getattr(chain, 'name', chain)
+        if chain not in self._chains or self.builtin_chain(chain):
+            raise BackendError('Chain cannot be deleted <{}>'.format(chain))
+        if self._chains[chain]:
+            raise BackendError('Chain is not empty <{}>'.format(chain))
+        del self._chains[chain]
+        self._modified()
+
+    def flush(self):
+        # Flush all chains and delete the user-defined ones
+        self._chains = {chain: [] for chain in self._chains if self.builtin_chain(chain)}
+        self._modified()
+
+    def zero_entries(self, chain=None):
+        for name, rules in self._chains.items():
+            if chain is None or chain == name:
+                self._chains[name] = [rule._copy() for rule in rules]
+        self._modified()
+
+    def _rules(self, chain):
+        try:
+            return self._chains[chain]
+        except KeyError:
+            raise BackendError('Chain does not exist <{}>'.format(chain))
+
+    def _modified(self):
+        self._dirty = True
+        if self.autocommit:
+            self.refresh()
+
+class _MemoryChain(object):
+    """ Chain of the memory backend with the interface of iptc.Chain """
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    @property
+    def rules(self):
+        return list(self.table._rules(self.name))
+
+    def append_rule(self, rule):
+        self.table._rules(self.name).append(rule._copy())
+        self.table._modified()
+
+    def insert_rule(self, rule, position=0):
+        rules = self.table._rules(self.name)
+        if position > len(rules):
+            raise BackendError('Index of insertion too big <{}>'.format(position))
+        rules.insert(position, rule._copy())
+        self.table._modified()
+
+    def replace_rule(self, rule, position=0):
+        rules = self.table._rules(self.name)
+        if position >= len(rules):
+            raise BackendError('Index of replacement too big <{}>'.format(position))
+        rules[position] = rule._copy()
+        self.table._modified()
+
+    def delete_rule(self, rule):
+        try:
+            self.table._rules(self.name).remove(rule)
+        except ValueError:
+            raise BackendError('Bad rule (does a matching rule exist in that chain?)')
+        self.table._modified()
+
+    def flush(self):
+        self.table._rules(self.name)[:] = []
+        self.table._modified()
+
+    def zero_counters(self):
+        self.table.zero_entries(self.name)
+
+    def get_policy(self):
+        return self.table._policies.get(self.name)
+
+class _MemoryRule(object):
+    """ Rule of the memory backend with the interface of iptc.Rule, rules compare equal as libiptc does """
+    __hash__ = None
+
+    def __init__(self, ipv6=False):
+        self.ipv6 = ipv6
+        self.src = '::/0' if ipv6 else '0.0.0.0/0.0.0.0'
+        self.dst = '::/0' if ipv6 else '0.0.0.0/0.0.0.0'
+        self.protocol = 'ip'
+        self.in_interface = None
+        self.out_interface = None
+        self.fragment = False
+        self.matches = []
+        self.target = None
+        self.counters = (0, 0)
+        self._key = None
+
+    def __setattr__(self, name, value):
+        if name in ('src', 'dst'):
+            # Normalize the address as iptc.Rule does
+            inv = value.startswith('!')
+            value = _parse_save_address(value.lstrip('!'), ipv6=self.ipv6)
+            value = '!{}'.format(value) if inv else value
+        elif name == 'protocol':
+            value = str(value).lower()
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            object.__setattr__(self, '_key', None)
+
+    def __eq__(self, other):
+        if not isinstance(other, _MemoryRule):
+            return NotImplemented
+        return self._getkey() == other._getkey()
+
+    def create_match(self, name):
+        match = _MemoryExtension(self, name)
+        self.matches.append(match)
+        self._key = None
+        return match
+
+    def create_target(self, name):
+        self.target = _MemoryExtension(self, name)
+        return self.target
+
+    def get_counters(self):
+        return self.counters
+
+    def _copy(self, counters=(0, 0)):
+        """ Return a copy of the rule with the given counters, as stored in a chain """
+        rule = _MemoryRule(ipv6=self.ipv6)
+        for name in ('src', 'dst', 'protocol', 'in_interface', 'out_interface', 'fragment', 'target'):
+            object.__setattr__(rule, name, getattr(self, name))
+        rule.matches = list(self.matches)
+        object.__setattr__(rule, 'counters', counters)
+        object.__setattr__(rule, '_key', self._getkey())
+        return rule
+
+    def _getkey(self):
+        if self._key is None:
+            target = self.target._getkey() if self.target else None
+            key = (self.src, self.dst, self.protocol, self.in_interface, self.out_interface, self.fragment,
+                   tuple(match._getkey() for match in self.matches), target)
+            object.__setattr__(self, '_key', key)
+        return self._key
+
+class _MemoryExtension(object):
+    """ Match or target of the memory backend with the interface of iptc.Match and iptc.Target """
+
+    def __init__(self, rule, name):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, '_rule', rule)
+        object.__setattr__(self, '_params', {})
+
+    def __setattr__(self, name, value):
+        # Normalize the value as get_all_parameters() of iptc.Match does
+        if isinstance(value, (list, tuple)):
+            values = [str(v) for v in value]
+        elif value is None or value == '' or value is True:
+            values = []
+        else:
+            value = str(value)
+            values = ['!', value[1:].strip()] if value.startswith('!') else [value]
+        self._params[name.replace('_', '-')] = values
+        object.__setattr__(self._rule, '_key', None)
+
+    def get_all_parameters(self):
+        return {k: list(v) for k, v in self._params.items()}
+
+    def _getkey(self):
+        return (self.name, _fingerprint(self._params))
+
+class _TableSnapshot(object):
+    """ Cached view of an iptc_table and the generation it was taken at """
+    __slots__ = ('iptc_table', 'generation', 'timestamp', 'indexes')
+
+    def __init__(self, iptc_table, generation):
+        self.iptc_table = iptc_table
+        self.generation = generation
+        self.timestamp = time.monotonic()
+        self.indexes = {}           # Indexes chain names to _ChainIndex
+
+    def isvalid(self, generation):
+        if self.generation != generation:
+            return False
+        if CACHE_MAXAGE is not None and time.monotonic() - self.timestamp > CACHE_MAXAGE:
+            return False
+        return True
+
+class _ChainIndex(object):
+    """ Index of the rules of a chain by fingerprint, positions start at 0 """
+    __slots__ = ('fingerprints', 'counters', 'positions')
+
+    def __init__(self):
+        self.fingerprints = []      # Stores the rule fingerprints in chain order
+        self.counters = []          # Stores the rule counters in chain order
+        self.positions = {}         # Indexes fingerprints to their first position
+
+    @classmethod
+    def from_chain(cls, iptc_chain, ipv6=False):
+        """ Build the index in a single pass over the rules of an iptc_chain """
+        index = cls()
+        for iptc_rule in _iptc_rules(iptc_chain):
+            index.fingerprints.append(_fingerprint(_decode_iptc_rule(iptc_rule, ipv6=ipv6)))
+            index.counters.append(iptc_rule.get_counters())
+        index._reindex(0)
+        return index
+
+    def position(self, fingerprint):
+        return self.positions[fingerprint]
+
+    def get_counters(self, fingerprint):
+        return self.counters[self.positions[fingerprint]]
+
+    def insert(self, position, fingerprint, counters=(0, 0)):
+        if position >= len(self.fingerprints):
+            # Append is O(1), existing positions remain the same
+            self.fingerprints.append(fingerprint)
+            self.counters.append(counters)
+            self.positions.setdefault(fingerprint, len(self.fingerprints) - 1)
+            return
+        self.fingerprints.insert(position, fingerprint)
+        self.counters.insert(position, counters)
+        self._reindex(position)
+
+    def delete(self, fingerprint):
+        position = self.positions[fingerprint]
+        del self.fingerprints[position]
+        del self.counters[position]
+        self._reindex(position)
+
+    def replace(self, position, fingerprint, counters=(0, 0)):
+        self.fingerprints[position] = fingerprint
+        self.counters[position] = counters
+        self._reindex(position)
+
+    def _reindex(self, start):
+        """ Recalculate the positions of the fingerprints from start onwards """
+        positions = {k: v for k, v in self.positions.items() if v < start}
+        for position in range(start, len(self.fingerprints)):
+            positions.setdefault(self.fingerprints[position], position)
+        self.positions = positions
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.positions
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+def _cache_invalidate(table, ipv6=False):
+    """ Increase the generation of a table and drop its cached snapshot """
+    key = (table, ipv6)
+    _TABLE_GENERATION[key] = _TABLE_GENERATION.get(key, 0) + 1
+    _TABLE_CACHE.pop(key, None)
+
+def _cache_update(table, chain=None, ipv6=False, drop_index=False):
+    """ Increase the generation of a table after a write via this module, keeping its snapshot """
+    key = (table, ipv6)
+    generation = _TABLE_GENERATION.get(key, 0) + 1
+    _TABLE_GENERATION[key] = generation
+    transaction = getattr(_LOCAL, 'transaction', None)
+    if transaction is not None and transaction.covers(table, ipv6):
+        # Autocommit would have done a commit and refresh of the table
+        transaction.roundtrips_saved += 1
+    elif INSTRUMENT:
+        # The write was committed and the table refreshed
+        _instrument_count('commit')
+        _instrument_count('refresh')
+    snapshot = _TABLE_CACHE.get(key)
+    if snapshot is None:
+        return
+    snapshot.generation = generation
+    if drop_index and chain is None:
+        snapshot.indexes.clear()
+    elif drop_index:
+        snapshot.indexes.pop(chain, None)
+
+def _iptc_gettable(table, ipv6=False, refresh=False):
+    """ Return an updated view of an iptc_table, use refresh to bypass the snapshot cache """
+    if INSTRUMENT:
+        _instrument_count('gettable')
+    transaction = getattr(_LOCAL, 'transaction', None)
+    if transaction is not None and transaction.covers(table, ipv6):
+        if refresh:
+            transaction.roundtrips_saved += 1
+        return transaction.gettable(table, ipv6=ipv6)
+    return _iptc_loadtable(table, ipv6=ipv6, refresh=refresh)
+
+def _iptc_loadtable(table, ipv6=False, refresh=False):
+    """ Return an iptc_table from the snapshot cache, or commit and refresh it """
+    key = (table, ipv6)
+    generation = _TABLE_GENERATION.get(key, 0)
+    snapshot = _TABLE_CACHE.get(key)
+    if CACHE_ENABLED and snapshot is not None and snapshot.isvalid(generation):
+        if refresh:
+            # Refresh the table handle, the indexes are kept up to date by the writes via this module
+            snapshot.iptc_table.commit()
+            snapshot.iptc_table.refresh()
+            if INSTRUMENT:
+                _instrument_count('commit')
+                _instrument_count('refresh')
+        return snapshot.iptc_table
+    iptc_table = _backend().table(table, ipv6=ipv6)
+    iptc_table.commit()
+    iptc_table.refresh()
+    if INSTRUMENT:
+        _instrument_count('commit')
+        _instrument_count('refresh')
+    if CACHE_ENABLED:
+        _TABLE_CACHE[key] = _TableSnapshot(iptc_table, generation)
     return iptc_table
 
-def _iptc_getchain(table, chain, ipv6=False, silent=False):
+def _iptc_getchain(table, chain, ipv6=False, silent=False, refresh=False):
     """ Return an iptc_chain of an updated table """
     try:
-        iptc_table = _iptc_gettable(table, ipv6=ipv6)
+        iptc_table = _iptc_gettable(table, ipv6=ipv6, refresh=refresh)
         if not iptc_table.is_chain(chain):
             raise AttributeError('Table <{}> has no chain <{}>'.format(table, chain))
-        return iptc.Chain(iptc_table, chain)
+        return _backend().chain(iptc_table, chain)
     except Exception as e:
         if not silent:
             raise
 
+def _iptc_getindex(table, chain, ipv6=False, build=True):
+    """ Return the _ChainIndex of a chain from the snapshot, build it if not available """
+    iptc_table = _iptc_gettable(table, ipv6=ipv6)
+    snapshot = _TABLE_CACHE.get((table, ipv6))
+    if snapshot is not None and chain in snapshot.indexes:
+        return snapshot.indexes[chain]
+    if not build:
+        return None
+    if not iptc_table.is_chain(chain):
+        raise AttributeError('Table <{}> has no chain <{}>'.format(table, chain))
+    index = _ChainIndex.from_chain(_backend().chain(iptc_table, chain), ipv6=ipv6)
+    if snapshot is not None:
+        snapshot.indexes[chain] = index
+    return index
+
+def _iptc_getrule(table, chain, rule_d, ipv6=False):
+    """
+    Return the iptc_chain of a refreshed table, the iptc_rule of a rule_d, the _ChainIndex and the position of the rule.
+    The position is taken from the index and checked against the refreshed chain,
+    the indexes are rebuilt if the chain was changed outside this module.
+    """
+    index = _iptc_getindex(table, chain, ipv6=ipv6)
+    fingerprint = _rule_fingerprint(rule_d, ipv6=ipv6)
+    if fingerprint not in index:
+        raise AttributeError('Chain <{}@{}> has no rule <{}>'.format(chain, table, rule_d))
+    position = index.position(fingerprint)
+    iptc_chain = _iptc_getchain(table, chain, ipv6=ipv6, refresh=True)
+    iptc_rules = _iptc_rules(iptc_chain)
+    if position < len(iptc_rules) and _fingerprint(_decode_iptc_rule(iptc_rules[position], ipv6=ipv6)) == fingerprint:
+        return (iptc_chain, iptc_rules[position], index, position)
+    # The indexes of the table are stale
+    index = _ChainIndex.from_chain(iptc_chain, ipv6=ipv6)
+    snapshot = _TABLE_CACHE.get((table, ipv6))
+    if snapshot is not None:
+        snapshot.indexes.clear()
+        snapshot.indexes[chain] = index
+    if fingerprint not in index:
+        raise AttributeError('Chain <{}@{}> has no rule <{}>'.format(chain, table, rule_d))
+    position = index.position(fingerprint)
+    return (iptc_chain, iptc_rules[position], index, position)
+
+def _iptc_rules(iptc_chain):
+    """ Return the iptc_rules of an iptc_chain, a full scan of the chain """
+    if INSTRUMENT:
+        _instrument_count('scan')
+    return iptc_chain.rules
+
+def _iptc_iterrules(iptc_chain):
+    """ Yield the iptc_rules of an iptc_chain one at a time, walking the libiptc entries if the backend has them """
+    iptc_table = iptc_chain.table
+    if not hasattr(iptc_table, 'first_rule'):
+        yield from _iptc_rules(iptc_chain)
+        return
+    if INSTRUMENT:
+        _instrument_count('scan')
+    handle = _iptc_handle(iptc_table)
+    entry = iptc_table.first_rule(iptc_chain.name)
+    while entry:
+        yield iptc_table.create_rule(entry, iptc_chain)
+        # The entries belong to the handle, a refresh frees them
+        if _iptc_handle(iptc_table) is not handle:
+            raise Exception('Failed to iterate chain <{}>: table refreshed'.format(iptc_chain.name))
+        entry = iptc_table.next_rule(entry)
+
+def _iptc_handle(iptc_table):
+    """
+    Return the libiptc handle of an iptc_table, only compared to detect a refresh.
+    The only access to python-iptc internals: the public API has no accessor of the handle freed by refresh()
+    """
+    return getattr(iptc_table, '_handle', None)
+
 def _iptc_setattr(object, name, value):
     # Translate attribute name
     name = name.replace('-', '_')
@@ -403,11 +1840,45 @@ def _iptc_settarget(iptc_rule, value):
         iptc_target = iptc_rule.create_target(value)
 
 def _encode_iptc_rule(rule_d, ipv6=False):
+    """ Return an iptc_rule of a rule_d from the encoding cache, the iptc_rule must not be modified """
+    return _encode_iptc_rule_cached(rule_d, ipv6=ipv6)[0]
+
+def _encode_iptc_rule_cached(rule_d, ipv6=False):
+    """ Return the encoding cache entry [iptc_rule, decoded fingerprint] of a rule_d """
+    if INSTRUMENT:
+        _instrument_count('encode')
     # Sanity check
     assert(isinstance(rule_d, dict))
+    if ENCODE_CACHE_SIZE <= 0:
+        return [_build_iptc_rule(rule_d, ipv6=ipv6), None]
+    try:
+        # The encoded matches follow the order of the keys, unlike the fingerprint
+        key = (_ordered_fingerprint(rule_d), ipv6)
+        hash(key)
+    except TypeError:
+        # Unhashable values cannot be cached
+        return [_build_iptc_rule(rule_d, ipv6=ipv6), None]
+    with _ENCODE_CACHE_LOCK:
+        entry = _ENCODE_CACHE.get(key)
+        if entry is not None:
+            _ENCODE_CACHE.move_to_end(key)
+            _ENCODE_CACHE_STATS['hits'] += 1
+            return entry
+        _ENCODE_CACHE_STATS['misses'] += 1
+    entry = [_build_iptc_rule(rule_d, ipv6=ipv6), None]
+    with _ENCODE_CACHE_LOCK:
+        _ENCODE_CACHE[key] = entry
+        while len(_ENCODE_CACHE) > ENCODE_CACHE_SIZE:
+            _ENCODE_CACHE.popitem(last=False)
+    return entry
+
+def _build_iptc_rule(rule_d, ipv6=False, backend=None):
+    """ Return a new iptc_rule of a rule_d, created by the current backend if None """
+    if INSTRUMENT:
+        _instrument_count('build')
     # Basic rule attributes
     rule_attr = ('src', 'dst', 'protocol', 'in-interface', 'out-interface', 'fragment')
-    iptc_rule = iptc.Rule6() if ipv6 else iptc.Rule()
+    iptc_rule = (backend or _backend()).rule(ipv6=ipv6)
     # Avoid issues with matches that require basic parameters to be configured first
     for name in rule_attr:
         if name in rule_d:
@@ -428,15 +1899,17 @@ def _encode_iptc_rule(rule_d, ipv6=False):
 
 def _decode_iptc_rule(iptc_rule, ipv6=False):
     """ Return a dictionary representation of an iptc_rule """
+    if INSTRUMENT:
+        _instrument_count('decode')
     d = {}
     if ipv6==False and iptc_rule.src != '0.0.0.0/0.0.0.0':
         d['src'] = iptc_rule.src
     elif ipv6==True and iptc_rule.src != '::/0':
         d['src'] = iptc_rule.src
     if ipv6==False and iptc_rule.dst != '0.0.0.0/0.0.0.0':
-        d['dst'] = iptc_rule.dst.rstrip('/255.255.255.255')
+        d['dst'] = _strip_suffix(iptc_rule.dst, '/255.255.255.255')
     elif ipv6==True and iptc_rule.dst != '::/0':
-        d['dst'] = iptc_rule.dst.rstrip('/128')
+        d['dst'] = _strip_suffix(iptc_rule.dst, '/128')
     if iptc_rule.protocol != 'ip':
         d['protocol'] = iptc_rule.protocol
     if iptc_rule.in_interface is not None:
@@ -460,45 +1933,598 @@ def _decode_iptc_rule(iptc_rule, ipv6=False):
     # Return a filtered dictionary
     return _filter_empty_field(d)
 
+def _fingerprint(value):
+    """ Return a canonical and hashable representation of a rule_d """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _fingerprint(v)) for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_fingerprint(v) for v in value)
+    return value
+
+def _ordered_fingerprint(value):
+    """ Return a hashable representation of a rule_d keeping the order of its keys """
+    if isinstance(value, dict):
+        return tuple((k, _ordered_fingerprint(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(_ordered_fingerprint(v) for v in value)
+    return value
+
+def _rule_fingerprint(rule_d, ipv6=False):
+    """ Return the fingerprint of a rule_d with the same normalization of _decode_iptc_rule """
+    entry = _encode_iptc_rule_cached(rule_d, ipv6=ipv6)
+    if entry[1] is None:
+        entry[1] = _fingerprint(_decode_iptc_rule(entry[0], ipv6=ipv6))
+    return entry[1]
+
 def _repr_rule(iptc_rule, ipv6=False):
     """ Return a string representation of an iptc_rule """
-    s = ''
+    l = []
     if ipv6==False and iptc_rule.src != '0.0.0.0/0.0.0.0':
-        s += 'src {} '.format(iptc_rule.src)
+        l.append('src {}'.format(iptc_rule.src))
     elif ipv6==True and iptc_rule.src != '::/0':
-        s += 'src {} '.format(iptc_rule.src)
+        l.append('src {}'.format(iptc_rule.src))
     if ipv6==False and iptc_rule.dst != '0.0.0.0/0.0.0.0':
-        s += 'dst {} '.format(iptc_rule.dst)
+        l.append('dst {}'.format(iptc_rule.dst))
     elif ipv6==True and iptc_rule.dst != '::/0':
-        s += 'dst {} '.format(iptc_rule.dst)
+        l.append('dst {}'.format(iptc_rule.dst))
     if iptc_rule.protocol != 'ip':
-        s += 'protocol {} '.format(iptc_rule.protocol)
+        l.append('protocol {}'.format(iptc_rule.protocol))
     if iptc_rule.in_interface is not None:
-        s += 'in {} '.format(iptc_rule.in_interface)
+        l.append('in {}'.format(iptc_rule.in_interface))
     if iptc_rule.out_interface is not None:
-        s += 'out {} '.format(iptc_rule.out_interface)
+        l.append('out {}'.format(iptc_rule.out_interface))
     if ipv6 == False and iptc_rule.fragment:
-        s += 'fragment '
+        l.append('fragment')
     for m in iptc_rule.matches:
-        s += '{} {} '.format(m.name, m.get_all_parameters())
+        l.append('{} {}'.format(m.name, m.get_all_parameters()))
     if iptc_rule.target and iptc_rule.target.name and len(iptc_rule.target.get_all_parameters()):
-        s += '-j {} '.format(iptc_rule.target.get_all_parameters())
+        l.append('-j {}'.format(iptc_rule.target.get_all_parameters()))
     elif iptc_rule.target and iptc_rule.target.name:
-        s += '-j {} '.format(iptc_rule.target.name)
-    return s
+        l.append('-j {}'.format(iptc_rule.target.name))
+    # Keep the trailing space of the former representation
+    return ''.join('{} '.format(x) for x in l)
 
 def _batch_begin_table(table, ipv6=False):
     """ Disable autocommit on a table """
-    iptc_table = _iptc_gettable(table, ipv6=ipv6)
+    iptc_table = _iptc_gettable(table, ipv6=ipv6, refresh=True)
     iptc_table.autocommit = False
     return iptc_table
 
 def _batch_end_table(table, ipv6=False):
-    """ Enable autocommit on table and commit changes """
-    iptc_table = _iptc_gettable(table, ipv6=ipv6)
+    """ Enable autocommit on table and commit changes, deferred to the end of an active transaction """
+    transaction = getattr(_LOCAL, 'transaction', None)
+    if transaction is not None and transaction.covers(table, ipv6):
+        _cache_update(table, ipv6=ipv6, drop_index=True)
+        return transaction.gettable(table, ipv6=ipv6)
+    iptc_table = _backend().table(table, ipv6=ipv6)
+    try:
+        # Refresh ignores the errors of its own commit
+        _dual_unlocked(iptc_table.commit)
+    except Exception:
+        _batch_abort_table(table, ipv6=ipv6)
+        raise
+    iptc_table.refresh()
     iptc_table.autocommit = True
+    _cache_update(table, ipv6=ipv6, drop_index=True)
     return iptc_table
 
+def _batch_abort_table(table, ipv6=False):
+    """ Discard the pending changes of a table and enable autocommit, deferred to an active transaction """
+    transaction = getattr(_LOCAL, 'transaction', None)
+    if transaction is not None and transaction.covers(table, ipv6):
+        return transaction.gettable(table, ipv6=ipv6)
+    iptc_table = _backend().table(table, ipv6=ipv6)
+    iptc_table.close()
+    iptc_table.autocommit = True
+    iptc_table.refresh()
+    if INSTRUMENT:
+        _instrument_count('refresh')
+    _cache_invalidate(table, ipv6=ipv6)
+    return iptc_table
+
+def _reconcile_chain(chain, rules, index):
+    """ Return the operations to turn the indexed chain into rules and the resulting _ChainIndex """
+    fingerprints = [fingerprint for (fingerprint, rule_d) in rules]
+    new_index = _ChainIndex()
+    plan = []
+    seen = set()        # Fingerprints of the already reconciled head of the chain
+    offset = 0
+    matcher = difflib.SequenceMatcher(None, index.fingerprints, fingerprints, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            for k in range(i2 - i1):
+                new_index.insert(len(new_index), fingerprints[j1 + k], index.counters[i1 + k])
+            seen.update(fingerprints[j1:j2])
+            continue
+        # Position of current rule i1 in the chain being modified, starting at 0
+        position = i1 + offset
+        n = min(i2 - i1, j2 - j1)
+        for k in range(n):
+            plan.append(('replace', chain, position + 1, rules[j1 + k][1], None))
+            new_index.insert(len(new_index), fingerprints[j1 + k])
+            seen.add(fingerprints[j1 + k])
+            position += 1
+        for k in range(i1 + n, i2):
+            # Deletion matches the first rule found, an equal rule at the head requires a rewrite
+            if index.fingerprints[k] in seen:
+                return (_reconcile_rewrite(chain, rules), _reconcile_index(fingerprints))
+            plan.append(('delete', chain, position + 1, None, k))
+        for k in range(j1 + n, j2):
+            plan.append(('insert', chain, position + 1, rules[k][1], None))
+            new_index.insert(len(new_index), fingerprints[k])
+            seen.add(fingerprints[k])
+            position += 1
+        offset = position - i2
+    return (plan, new_index)
+
+def _reconcile_rewrite(chain, rules):
+    """ Return the operations to flush a chain and append rules """
+    plan = [('flush', chain, None, None, None)]
+    plan += [('insert', chain, i + 1, rule_d, None) for i, (fingerprint, rule_d) in enumerate(rules)]
+    return plan
+
+def _reconcile_index(fingerprints):
+    """ Return a _ChainIndex of new rules """
+    index = _ChainIndex()
+    for fingerprint in fingerprints:
+        index.insert(len(index), fingerprint)
+    return index
+
+def _reconcile_plan(desired, table, ipv6=False):
+    """ Return the operations to reconcile a table with a desired state and the resulting indexes """
+    # Chains are created first as rules may jump to any of them
+    creates = []
+    plan = []
+    indexes = {}
+    iptc_table = _iptc_gettable(table, ipv6=ipv6)
+    for chain, rules in desired.items():
+        rules = [(_rule_fingerprint(rule_d, ipv6=ipv6), rule_d) for rule_d in rules]
+        if not iptc_table.is_chain(chain):
+            creates.append(('add_chain', chain, None, None, None))
+            plan += _reconcile_rewrite(chain, rules)[1:]
+            indexes[chain] = _reconcile_index([fingerprint for (fingerprint, rule_d) in rules])
+            continue
+        index = _iptc_getindex(table, chain, ipv6=ipv6)
+        chain_plan, indexes[chain] = _reconcile_chain(chain, rules, index)
+        # Decode the rules to be deleted from the snapshot
+        if any(op[0] == 'delete' for op in chain_plan):
+            iptc_rules = _iptc_rules(_backend().chain(iptc_table, chain))
+            chain_plan = [op[:3] + (_decode_iptc_rule(iptc_rules[op[4]], ipv6=ipv6), op[4]) if op[0] == 'delete' else op
+                          for op in chain_plan]
+        plan += chain_plan
+    return (creates + plan, indexes)
+
+def _reconcile_apply(table, plan, ipv6=False):
+    """ Apply the operations of a reconcile plan in a single commit """
+    iptc_table = _batch_begin_table(table, ipv6=ipv6)
+    try:
+        # Rules to be deleted are taken from the refreshed table before any modification
+        iptc_rules = {}
+        for (op, chain, position, rule_d, origin) in plan:
+            if op == 'delete' and chain not in iptc_rules:
+                iptc_rules[chain] = _iptc_rules(_backend().chain(iptc_table, chain))
+        for (op, chain, position, rule_d, origin) in plan:
+            if op == 'add_chain':
+                iptc_table.create_chain(chain)
+                continue
+            iptc_chain = _backend().chain(iptc_table, chain)
+            if op == 'flush':
+                iptc_chain.flush()
+            elif op == 'insert':
+                iptc_chain.insert_rule(_encode_iptc_rule(rule_d, ipv6=ipv6), position - 1)
+            elif op == 'replace':
+                iptc_chain.replace_rule(_encode_iptc_rule(rule_d, ipv6=ipv6), position - 1)
+            elif op == 'delete':
+                iptc_chain.delete_rule(iptc_rules[chain][origin])
+    except Exception:
+        _batch_abort_table(table, ipv6=ipv6)
+        raise
+    _batch_end_table(table, ipv6=ipv6)
+
+def _rule_family(rule_d):
+    """ Return 4 or 6 as the family of the addresses of a rule_d, None if it has none """
+    values = [rule_d[name] for name in ('src', 'dst') if name in rule_d]
+    iprange = rule_d.get('iprange')
+    for params in (iprange if isinstance(iprange, list) else [iprange]):
+        if isinstance(params, dict):
+            values += [params[name] for name in ('src-range', 'dst-range') if name in params]
+    for value in values:
+        addr = value.lstrip('!').strip().partition('/')[0].partition('-')[0]
+        try:
+            return ipaddress.ip_address(addr).version
+        except ValueError:
+            continue
+    return None
+
+def _translate_icmp(value):
+    """ Return the icmp6 match of an icmp match, None if an ICMP type has no ICMPv6 equivalent """
+    if isinstance(value, list):
+        values = [_translate_icmp(v) for v in value]
+        return None if None in values else values
+    d = {}
+    for name, param in value.items():
+        if name != 'icmp-type':
+            d[name] = param
+            continue
+        inv = param.startswith('!')
+        icmp_type = _ICMP6_TYPES.get(param.lstrip('!').strip())
+        if icmp_type is None:
+            return None
+        d['icmpv6-type'] = '!{}'.format(icmp_type) if inv else icmp_type
+    return d
+
+def _translate_target(value):
+    """ Return a target with the ICMPv6 equivalent of its REJECT type """
+    if not isinstance(value, dict) or 'REJECT' not in value:
+        return value
+    params = dict(value['REJECT'])
+    if params.get('reject-with', '').startswith('icmp-'):
+        # Unknown types fall back to the IPv6 default icmp6-port-unreachable
+        reject_with = _ICMP6_REJECT.get(params.pop('reject-with'))
+        if reject_with is not None:
+            params['reject-with'] = reject_with
+    return {'REJECT': params}
+
+def _dual_batch(batch_rules, ipv6=False):
+    """ Return the items of a batch with translated rule_d, skipping the ones that do not apply to the family """
+    batch = []
+    for item in batch_rules:
+        rule_d = translate_rule(item[1], ipv6=ipv6)
+        if rule_d is not None:
+            batch.append((item[0], rule_d) + tuple(item[2:]))
+    return batch
+
+def _dual_apply(table, func):
+    """
+    Run func(ipv6) on a table for IPv4 and IPv6 on worker threads, return the results with format {ipv6: result}
+    The encoding of the rules uses the process-wide state of libxtables, so the workers take turns
+    under _DUAL_LOCK and only their commits run in parallel, see _dual_unlocked()
+    """
+    global _DUAL_EXECUTOR
+    if _DUAL_EXECUTOR is None:
+        _DUAL_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='iptc_dual')
+    if getattr(_LOCAL, 'transaction', None) is not None:
+        # The handles of the transaction belong to the calling thread, which holds the table locks
+        return {ipv6: func(ipv6) for ipv6 in (False, True)}
+    futures = {ipv6: _DUAL_EXECUTOR.submit(_dual_call, table, func, ipv6) for ipv6 in (False, True)}
+    # Wait for both families before raising an exception of either of them
+    concurrent.futures.wait(futures.values())
+    return {ipv6: future.result() for ipv6, future in futures.items()}
+
+def _dual_call(table, func, ipv6):
+    """ Run func(ipv6) on a dual-stack worker holding the table lock, then _DUAL_LOCK, always in this order """
+    with _table_lock(table, ipv6=ipv6), _DUAL_LOCK:
+        _LOCAL.dual = True
+        try:
+            return func(ipv6)
+        finally:
+            _LOCAL.dual = False
+
+def _dual_unlocked(func, *args, **kwargs):
+    """ Run a commit, releasing _DUAL_LOCK on a dual-stack worker to let the other family go on meanwhile """
+    if not getattr(_LOCAL, 'dual', False):
+        return func(*args, **kwargs)
+    _LOCAL.dual = False
+    _DUAL_LOCK.release()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _DUAL_LOCK.acquire()
+        _LOCAL.dual = True
+
+def _harvest_chain(iptc_chain, table, ipv6=False):
+    """ Return a RuleCounters and a _ChainIndex of an iptc_chain, decode the rules only if not indexed """
+    iptc_rules = _iptc_rules(iptc_chain)
+    index = _iptc_getindex(table, iptc_chain.name, ipv6=ipv6, build=False)
+    if index is None or len(index) != len(iptc_rules):
+        index = _ChainIndex()
+        index.fingerprints = [_fingerprint(_decode_iptc_rule(iptc_rule, ipv6=ipv6)) for iptc_rule in iptc_rules]
+        index.counters = [(0, 0)] * len(iptc_rules)
+        index._reindex(0)
+    counters = RuleCounters(table, iptc_chain.name, ipv6=ipv6)
+    counters.fingerprints = list(index.fingerprints)
+    counters.positions = dict(index.positions)
+    for i, iptc_rule in enumerate(iptc_rules):
+        packets, nbytes = iptc_rule.get_counters()
+        counters.packets.append(packets)
+        counters.bytes.append(nbytes)
+        index.counters[i] = (packets, nbytes)
+    return (counters, index)
+
+def _ipset_field(rule_d):
+    """ Return the only address field of a rule_d that can be moved to a set, None otherwise """
+    fields = [k for k in ('src', 'dst') if k in rule_d]
+    if len(fields) != 1:
+        return None
+    value = rule_d[fields[0]]
+    if not isinstance(value, str) or value.startswith('!'):
+        return None
+    try:
+        ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        return None
+    return fields[0]
+
+def _ipset_name(prefix, key, ipv6=False):
+    """ Return a set name derived from the group key """
+    digest = hashlib.sha1(repr((key, ipv6)).encode()).hexdigest()
+    name = '{}_{}'.format(prefix, digest[:IPSET_MAXLEN - len(prefix) - 2][:12])
+    if len(name) > IPSET_MAXLEN:
+        raise ValueError('Set name {} is longer than {} characters'.format(name, IPSET_MAXLEN))
+    return name
+
+def _shard_range(rule_d, field):
+    """ Return a tuple with the first and last addresses of the field of a rule_d """
+    value = rule_d.get(field)
+    if not value or value.startswith('!'):
+        raise ValueError('Rule {} has no sharding field {}'.format(rule_d, field))
+    network = ipaddress.ip_network(value, strict=False)
+    return (network.network_address, network.broadcast_address)
+
+def _shard_tree(root, chain, items, field, leaf_size, fanout, chains_d, leaves, counter):
+    """ Add the rules of a sub-tree to chains_d and its leaves to leaves """
+    if len(chain) > CHAIN_MAXLEN:
+        raise ValueError('Chain name {} is longer than {} characters'.format(chain, CHAIN_MAXLEN))
+    if len(items) <= leaf_size:
+        chains_d[chain] = [item[3] for item in items]
+        leaves.append((items[0][0], max(item[1] for item in items), chain))
+        return
+    chains_d[chain] = []
+    size = -(-len(items) // fanout)
+    for i in range(0, len(items), size):
+        group = items[i:i + size]
+        counter[0] += 1
+        child = '{}_{}'.format(root, counter[0])
+        first, last = group[0][0], max(item[1] for item in group)
+        option = 'src-range' if field == 'src' else 'dst-range'
+        chains_d[chain].append({'iprange': {option: '{}-{}'.format(first, last)}, 'target': child})
+        _shard_tree(root, child, group, field, leaf_size, fanout, chains_d, leaves, counter)
+
+def _restore_quote(value):
+    """ Return a value quoted for iptables-restore if needed """
+    value = '{}'.format(value)
+    if value == '' or any(c in value for c in ' \t"\'#'):
+        return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+    return value
+
+def _render_option(option, value):
+    """ Return the iptables arguments of an option, negated values start with ! """
+    if isinstance(value, (list, tuple)):
+        values = list(value)
+    elif value is True or value == '' or value is None:
+        values = []
+    else:
+        values = ['{}'.format(value)]
+    inv = False
+    if len(values) and values[0] == '!':
+        inv = True
+        values = values[1:]
+    elif len(values) and values[0].startswith('!'):
+        inv = True
+        values[0] = values[0][1:]
+    args = ['!'] if inv else []
+    args.append(option)
+    args += [_restore_quote(v) for v in values]
+    return args
+
+def _render_rule(rule_d, ipv6=False):
+    """ Return the iptables arguments of a rule_d as a string """
+    # Sanity check
+    assert(isinstance(rule_d, dict))
+    rule_opts = {'src': '-s', 'dst': '-d', 'protocol': '-p', 'in-interface': '-i', 'out-interface': '-o'}
+    # Basic rule attributes go first, as done in _encode_iptc_rule
+    rule_d = {k.replace('_', '-'): v for k, v in rule_d.items()}
+    args = []
+    for name, option in rule_opts.items():
+        if name in rule_d:
+            args += _render_option(option, rule_d[name])
+    if rule_d.get('fragment') and not ipv6:
+        args += _render_option('-f', rule_d['fragment'])
+    for name, value in rule_d.items():
+        if name in rule_opts or name in ('fragment', 'target'):
+            continue
+        for value_d in (value if isinstance(value, (list, tuple)) else [value]):
+            args += ['-m', name]
+            if isinstance(value_d, dict):
+                for k, v in value_d.items():
+                    args += _render_option('--{}'.format(k.replace('_', '-')), v)
+            else:
+                args += _render_option('--{}'.format(name), value_d)
+    target = rule_d.get('target')
+    if isinstance(target, dict):
+        for name, value_d in target.items():
+            args += ['-j', name.replace('_', '-')]
+            for k, v in value_d.items():
+                args += _render_option('--{}'.format(k.replace('_', '-')), v)
+            break
+    elif target:
+        args += ['-j', target]
+    return ' '.join(args)
+
+def _save_read(table=None, ipv6=False, counters=False, path=None):
+    """ Return the iptables-save text of a table or all tables, read from path if given """
+    if path:
+        with open(path, 'r') as f:
+            return f.read()
+    binary = IP6TABLES_SAVE if ipv6 else IPTABLES_SAVE
+    cmd = list(binary) if isinstance(binary, (list, tuple)) else [binary]
+    if table:
+        cmd += ['-t', table]
+    if counters:
+        cmd.append('-c')
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return proc.stdout.decode()
+
+def _parse_save_address(value, ipv6=False, strip_host=False):
+    """ Return an iptables-save CIDR address in the format of the iptc_rule attributes """
+    addr, _, prefixlen = value.partition('/')
+    if ipv6:
+        prefixlen = prefixlen or '128'
+        if strip_host and prefixlen == '128':
+            return addr
+        return '{}/{}'.format(addr, prefixlen)
+    if prefixlen == '' or prefixlen.isdigit():
+        prefixlen = int(prefixlen or 32)
+        if strip_host and prefixlen == 32:
+            return addr
+        netmask = socket.inet_ntoa(((0xFFFFFFFF << (32 - prefixlen)) & 0xFFFFFFFF).to_bytes(4, 'big'))
+        return '{}/{}'.format(addr, netmask)
+    # Non-contiguous netmask is already in dotted format
+    if strip_host and prefixlen == '255.255.255.255':
+        return addr
+    return value
+
+def _parse_save_params(args):
+    """ Return a dictionary of parameters with the format of iptc get_all_parameters() """
+    params = {}
+    inv = False
+    key = None
+    for x in args:
+        if x == '!':
+            # Next parameter is negated
+            inv = True
+        elif x.startswith('--'):
+            key = x[2:]
+            params[key] = ['!'] if inv else []
+            inv = False
+        elif key is not None:
+            params[key].append(x)
+    return params
+
+def _parse_save_rule(line, ipv6=False):
+    """ Return a tuple of (chain, rule_d, counters) from an iptables-save rule line """
+    counters = (0, 0)
+    if line.startswith('['):
+        _counters, line = line[1:].split(']', 1)
+        packets, nbytes = _counters.split(':')
+        counters = (int(packets), int(nbytes))
+    args = shlex.split(line)
+    assert(args[0] == '-A')
+    chain = args[1]
+    rule_opts = {'-s': 'src', '-d': 'dst', '-p': 'protocol', '-i': 'in-interface', '-o': 'out-interface'}
+    d = {}
+    matches = []
+    target = None
+    inv = False
+    i = 2
+    while i < len(args):
+        x = args[i]
+        if x == '!':
+            inv = True
+            i += 1
+            continue
+        if x in rule_opts:
+            name = rule_opts[x]
+            value = args[i + 1]
+            if name in ('src', 'dst'):
+                value = _parse_save_address(value, ipv6=ipv6, strip_host=(name == 'dst'))
+            d[name] = '!{}'.format(value) if inv else value
+            i += 2
+        elif x == '-f':
+            d['fragment'] = True
+            i += 1
+        elif x == '-c':
+            counters = (int(args[i + 1]), int(args[i + 2]))
+            i += 3
+        elif x in ('-m', '-j', '-g'):
+            # Collect all the arguments until the next match or target
+            j = i + 2
+            while j < len(args) and args[j] not in ('-m', '-j', '-g', '-c'):
+                j += 1
+            params = _parse_save_params(args[i + 2:j])
+            if x == '-m':
+                matches.append((args[i + 1], params))
+            else:
+                target = (args[i + 1], params)
+            i = j
+        else:
+            i += 1
+        inv = False
+    for name, params in matches:
+        if name not in d:
+            d[name] = params
+        elif isinstance(d[name], list):
+            d[name].append(params)
+        else:
+            d[name] = [d[name], params]
+    if target and len(target[1]):
+        d['target'] = {target[0].replace('-', '_'): target[1]}
+    elif target:
+        d['target'] = target[0]
+    return (chain, _filter_empty_field(d), counters)
+
+def _restore_exec(text, ipv6=False, noflush=False, counters=False):
+    """ Apply iptables-restore text in a single execution, raise CalledProcessError on failure """
+    binary = IP6TABLES_RESTORE if ipv6 else IPTABLES_RESTORE
+    cmd = list(binary) if isinstance(binary, (list, tuple)) else [binary]
+    if noflush:
+        cmd.append('--noflush')
+    if counters:
+        cmd.append('--counters')
+    _dual_unlocked(subprocess.run, cmd, input=text.encode(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+def _instrument_count(name, n=1):
+    with _INSTRUMENT_LOCK:
+        _INSTRUMENT_COUNTERS[name] += n
+
+def _instrument_observe(name, table, latency):
+    """ Add a latency in seconds to the histogram of a function and table """
+    key = (name, table or '')
+    with _INSTRUMENT_LOCK:
+        entry = _INSTRUMENT_LATENCY.get(key)
+        if entry is None:
+            entry = _INSTRUMENT_LATENCY[key] = [[0] * (len(INSTRUMENT_BUCKETS) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(INSTRUMENT_BUCKETS, latency)] += 1
+        entry[1] += latency
+        entry[2] += 1
+
+def _instrumented(func):
+    """ Return a wrapper of a public function recording its latency per table when INSTRUMENT is enabled """
+    params = list(inspect.signature(func).parameters)
+    position = params.index('table') if 'table' in params else None
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not INSTRUMENT:
+            return func(*args, **kwargs)
+        table = kwargs.get('table')
+        if table is None and position is not None and position < len(args):
+            table = args[position]
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _instrument_observe(func.__name__, table, time.perf_counter() - start)
+    return wrapper
+
+def _table_lock(table, ipv6=False):
+    """ Return the reentrant lock of the handle of a table """
+    key = (table, bool(ipv6))
+    lock = _TABLE_LOCKS.get(key)
+    if lock is None:
+        with _TABLE_LOCKS_LOCK:
+            lock = _TABLE_LOCKS.setdefault(key, threading.RLock())
+    return lock
+
+def _locked(func):
+    """ Return a wrapper of a public function holding the lock of its table during the call """
+    params = list(inspect.signature(func).parameters)
+    table_position, ipv6_position = params.index('table'), params.index('ipv6')
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        table = args[table_position] if table_position < len(args) else kwargs.get('table')
+        if table is None:
+            return func(*args, **kwargs)
+        ipv6 = args[ipv6_position] if ipv6_position < len(args) else kwargs.get('ipv6', False)
+        with _table_lock(table, ipv6=ipv6):
+            return func(*args, **kwargs)
+    return wrapper
+
+def _strip_suffix(value, suffix):
+    """ Return value without the trailing suffix """
+    if value.endswith(suffix):
+        return value[:-len(suffix)]
+    return value
+
 def _filter_empty_field(data_d):
     """
     Remove empty lists from dictionary values
@@ -520,6 +2546,26 @@ def _filter_empty_field(data_d):
 
 ### /INTERNAL FUNCTIONS ###
 
+# Hold the lock of the table during the public functions, see Transaction
+for _name in ('flush_table', 'flush_chain', 'zero_table', 'zero_chain', 'has_chain', 'has_rule',
+              'add_chain', 'add_rule', 'insert_rule', 'delete_chain', 'delete_rule', 'get_chains', 'get_rule',
+              'replace_rule', 'get_rule_statistics', 'get_rule_position', 'get_chain_counters', 'get_table_counters',
+              'repr_table', 'repr_chain', 'dump_table', 'dump_chain', 'write_jsonl', 'write_save',
+              'batch_add_chains', 'batch_delete_chains', 'batch_add_rules', 'batch_delete_rules', 'reconcile',
+              'restore_table', 'restore_rules'):
+    globals()[_name] = _locked(globals()[_name])
+
+# Record the latency of the public functions, calls between them resolve to the wrappers as well
+for _name in ('flush_all', 'flush_table', 'flush_chain', 'zero_all', 'zero_table', 'zero_chain', 'has_chain', 'has_rule',
+              'add_chain', 'add_rule', 'insert_rule', 'delete_chain', 'delete_rule', 'get_chains', 'get_rule',
+              'replace_rule', 'get_rule_statistics', 'get_rule_position', 'get_chain_counters', 'get_table_counters',
+              'test_rule', 'test_match', 'test_target', 'repr_all', 'repr_table', 'repr_chain',
+              'dump_all', 'dump_table', 'dump_chain', 'write_jsonl', 'write_save',
+              'batch_add_chains', 'batch_delete_chains', 'batch_add_rules', 'batch_delete_rules',
+              'batch_add_rules_dual', 'batch_delete_rules_dual', 'reconcile', 'reconcile_dual',
+              'restore_table', 'restore_rules', 'save_dump_all', 'save_dump_table', 'save_dump_chain'):
+    globals()[_name] = _instrumented(globals()[_name])
+
 
 # How to use
 if __name__== '__main__':
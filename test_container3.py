@@ -0,0 +1,529 @@
+"""
+Tests of container3, run with python -m pytest
+"""
+
+import asyncio
+import pickle
+import random
+import threading
+import time
+
+import pytest
+
+import container3
+
+class FlowNode(container3.LightContainerNode):
+    """ Node with a unique name, a shared host key and an ordered ip index key """
+    __slots__ = ('host', 'ip', 'expires', 'deleted')
+
+    def __init__(self, name, host='host', ip=0, expires=None):
+        super().__init__(name)
+        self.host = host
+        self.ip = ip
+        self.expires = expires
+        self.deleted = False
+
+    def lookupkeys(self):
+        return ((self._name, True), (self.host, False))
+
+    def indexkeys(self):
+        return (('ip', self.ip), )
+
+    def deadline(self):
+        return self.expires
+
+    def delete(self):
+        self.deleted = True
+
+    def __repr__(self):
+        return 'FlowNode({!r})'.format(self._name)
+
+def _run_threads(*targets, timeout=60):
+    """ Run targets in threads, fail if any of them is still running after timeout seconds """
+    errors = []
+    def _wrap(target):
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=_wrap, args=(target, ), daemon=True) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout)
+    assert not any(thread.is_alive() for thread in threads), 'deadlock'
+    assert errors == []
+
+def test_expire_due_nodes():
+    ct = container3.Container()
+    nodes = [FlowNode(i, expires=100 + i) for i in range(10)]
+    nodes.append(FlowNode('forever'))
+    ct.add_many(nodes)
+    assert ct.expire(now=104.5) == nodes[:5]
+    assert all(node.deleted for node in nodes[:5]) and not any(node.deleted for node in nodes[5:])
+    assert ct.lookup(0) is None and ct.lookup(5) is nodes[5]
+    assert ct.expire(now=104.5) == []
+    assert ct.stats()['expirations'] == 5
+    # Without callback the nodes are removed but not deleted
+    assert ct.expire(now=1000, callback=False) == nodes[5:10]
+    assert not any(node.deleted for node in nodes[5:])
+    assert ct.getall() == [nodes[10]]
+
+def test_expire_deadline_changes():
+    ct = container3.Container()
+    extended = FlowNode('extended', expires=100)
+    shortened = FlowNode('shortened', expires=500)
+    removed = FlowNode('removed', expires=100)
+    ct.add_many([extended, shortened, removed])
+    ct.remove(removed)
+    extended.expires = 200
+    assert ct.expire(now=150) == []
+    assert ct.expire(now=250) == [extended]
+    # A deadline brought forward is only picked up once rescheduled
+    shortened.expires = 300
+    assert ct.expire(now=350) == []
+    ct.reschedule(shortened)
+    assert ct.expire(now=350) == [shortened]
+    assert len(ct) == 0
+
+def test_start_sweeper():
+    async def _main():
+        ct = container3.Container()
+        soon = FlowNode('soon', expires=time.time() + 0.05)
+        later = FlowNode('later', expires=time.time() + 60)
+        ct.add_many([soon, later])
+        sweeper = ct.start_sweeper(interval=0.01)
+        assert ct.start_sweeper() is sweeper
+        await asyncio.sleep(0.3)
+        ct.stop_sweeper()
+        await asyncio.sleep(0)
+        assert sweeper.cancelled()
+        return ct, soon, later
+    ct, soon, later = asyncio.run(_main())
+    assert soon.deleted and not later.deleted
+    assert ct.getall() == [later]
+
+def test_maxsize_lru():
+    ct = container3.Container(maxsize=3)
+    nodes = [FlowNode(i) for i in range(4)]
+    ct.add_many(nodes[:3])
+    # The lookup makes node 0 the most recently used
+    assert ct.lookup(0) is nodes[0]
+    ct.add(nodes[3])
+    assert nodes[1].deleted and ct.lookup(1) is None
+    assert sorted(node._name for node in ct.getall()) == [0, 2, 3]
+    assert ct.stats()['evictions'] == 1
+
+def test_maxsize_lfu():
+    ct = container3.Container(maxsize=3, eviction='lfu')
+    nodes = [FlowNode(i) for i in range(5)]
+    ct.add_many(nodes[:3])
+    for _ in range(2):
+        ct.lookup(0)
+    ct.lookup(1)
+    # The new node is never the victim, node 2 is the least frequently used
+    ct.add(nodes[3])
+    assert [node._name for node in nodes if node.deleted] == [2]
+    # The oldest node among the least frequently used is evicted
+    ct.add(nodes[4])
+    assert [node._name for node in nodes if node.deleted] == [2, 3]
+    assert ct.lookup(4) is nodes[4]
+
+def test_maxsize_expiry():
+    ct = container3.Container(maxsize=3, eviction='expiry')
+    early = FlowNode('early', expires=100)
+    late = FlowNode('late', expires=300)
+    forever = FlowNode('forever')
+    ct.add_many([forever, late, early])
+    new = FlowNode('new', expires=200)
+    ct.add(new)
+    assert early.deleted and not late.deleted
+    # The extended deadline is honoured
+    new.expires = 1000
+    ct.add(FlowNode('new2', expires=400))
+    assert late.deleted and not new.deleted
+    assert sorted(node._name for node in ct.getall()) == ['forever', 'new', 'new2']
+    # Without deadlines left the oldest node is evicted
+    ct2 = container3.Container(maxsize=2, eviction='expiry')
+    ct2.add_many([FlowNode('a'), FlowNode('b')])
+    ct2.add(FlowNode('c'))
+    assert ct2.lookup('a') is None and len(ct2) == 2
+
+def test_maxsize_add_many_and_remove():
+    ct = container3.Container(maxsize=5)
+    nodes = [FlowNode(i) for i in range(8)]
+    ct.add_many(nodes)
+    assert [node._name for node in nodes if node.deleted] == [0, 1, 2]
+    assert len(ct) == 5 and ct.stats()['evictions'] == 3
+    # Removed nodes are no longer eviction candidates
+    ct.remove(nodes[3])
+    ct.add_many([FlowNode(8), FlowNode(9)])
+    assert ct.lookup(4) is None and ct.lookup(5) is nodes[5]
+
+def test_invalid_eviction():
+    with pytest.raises(Exception):
+        container3.Container(maxsize=1, eviction='random')
+
+def test_add_many():
+    ct = container3.Container()
+    nodes = [FlowNode(i, 'host{}'.format(i % 2), ip=i) for i in range(6)]
+    ct.add_many(nodes)
+    assert len(ct) == 6 and ct.lookup(3) is nodes[3]
+    assert ct.lookup('host1') == {nodes[1], nodes[3], nodes[5]}
+    assert ct.lookup_range('ip', 2, 3) == nodes[2:4]
+    # A collision with a stored or another new node adds none of them
+    with pytest.raises(KeyError):
+        ct.add_many([FlowNode(10), FlowNode(3)])
+    with pytest.raises(KeyError):
+        ct.add_many([FlowNode(10), FlowNode(10)])
+    with pytest.raises(KeyError):
+        ct.add_many([FlowNode(10), FlowNode(11, host=10)])
+    with pytest.raises(Exception):
+        ct.add_many([nodes[0]])
+    assert len(ct) == 6 and ct.lookup(10) is None
+
+def test_remove_many():
+    ct = container3.Container()
+    nodes = [FlowNode(i, 'host{}'.format(i % 2), ip=i) for i in range(6)]
+    ct.add_many(nodes)
+    # A missing or repeated node removes none of them
+    with pytest.raises(KeyError):
+        ct.remove_many([nodes[0], FlowNode(10)])
+    with pytest.raises(KeyError):
+        ct.remove_many([nodes[0], nodes[0]])
+    assert len(ct) == 6 and not nodes[0].deleted
+    ct.remove_many(nodes[:3])
+    assert all(node.deleted for node in nodes[:3])
+    assert ct.lookup('host1') == {nodes[3], nodes[5]}
+    assert ct.lookup_range('ip') == nodes[3:]
+    ct.remove_many(nodes[3:], callback=False)
+    assert len(ct) == 0 and not nodes[3].deleted
+    assert ct.lookup('host0') is None and ct.lookup_range('ip') == []
+
+def test_updatekeys_many():
+    ct = container3.Container()
+    a, b, c = FlowNode('a', ip=1), FlowNode('b', ip=2), FlowNode('c', ip=3)
+    ct.add_many([a, b, c])
+    # The unique keys of the updated nodes are released first, two nodes can swap them
+    a._name, b._name = 'b', 'a'
+    a.ip, b.host = 5, 'other'
+    ct.updatekeys_many([a, b])
+    assert ct.lookup('a') is b and ct.lookup('b') is a
+    assert ct.lookup('host') == {a, c} and ct.lookup('other') == {b}
+    assert ct.lookup_range('ip') == [b, c, a]
+    # A collision updates none of them
+    a._name, b._name = 'x', 'c'
+    with pytest.raises(KeyError):
+        ct.updatekeys_many([a, b])
+    assert ct.lookup('b') is a and ct.lookup('a') is b and ct.lookup('x') is None
+    with pytest.raises(KeyError):
+        ct.updatekeys_many([FlowNode('d')])
+
+@pytest.mark.parametrize('datatype', ['list', 'ordered'])
+def test_ordered_datatype(datatype):
+    ct = container3.Container(datatype=datatype)
+    nodes = [FlowNode(i, 'host{}'.format(i % 2)) for i in range(10)]
+    for node in nodes[:5]:
+        ct.add(node)
+    ct.add_many(nodes[5:])
+    # Insertion order is kept by getall and by the storage of the shared keys
+    assert ct.getall() == nodes
+    assert list(ct.lookup('host0')) == nodes[0::2]
+    ct.remove(nodes[4])
+    ct.remove_many([nodes[0], nodes[7]])
+    assert ct.getall() == [nodes[i] for i in (1, 2, 3, 5, 6, 8, 9)]
+    assert list(ct.lookup('host1')) == [nodes[i] for i in (1, 3, 5, 9)]
+    # A node added again goes to the end
+    ct.add(nodes[0])
+    assert ct.getall()[-1] is nodes[0]
+    assert list(ct.lookup('host0'))[-1] is nodes[0]
+
+def test_invalid_datatype():
+    with pytest.raises(Exception):
+        container3.Container(datatype='tuple')
+
+def test_lookup_range():
+    ct = container3.Container()
+    nodes = [FlowNode(i, ip=i // 2) for i in range(20)]
+    ct.add_many(nodes[10:])
+    for node in nodes[:10]:
+        ct.add(node)
+    # Duplicated keys are returned in insertion order, bounds are inclusive
+    assert ct.lookup_range('ip', 3, 6) == nodes[6:14]
+    assert ct.lookup_range('ip', None, 1) == nodes[:4]
+    assert ct.lookup_range('ip', 8) == nodes[16:]
+    assert ct.lookup_range('ip') == nodes
+    assert ct.lookup_range('ip', 7, 6) == []
+    assert ct.lookup_range('missing') == []
+    # The index follows updatekeys and remove
+    nodes[0].ip = 100
+    ct.updatekeys(nodes[0])
+    ct.remove(nodes[1])
+    assert ct.lookup_range('ip', None, 1) == nodes[2:4]
+    assert ct.lookup_range('ip', 50) == [nodes[0]]
+
+def test_lookup_prefix():
+    ct = container3.Container()
+    nets = [FlowNode(i, ip=(10, i % 3, i)) for i in range(9)]
+    ct.add_many(nets)
+    assert ct.lookup_prefix('ip', (10, 1)) == [nets[1], nets[4], nets[7]]
+    assert ct.lookup_prefix('ip', (10, )) == sorted(nets, key=lambda node: node.ip)
+    assert ct.lookup_prefix('ip', (11, )) == []
+    names = container3.Container()
+    hosts = [FlowNode(name, ip=name) for name in ('web-2', 'db-1', 'web-1', 'web', 'webmail')]
+    names.add_many(hosts)
+    assert names.lookup_prefix('ip', 'web-') == [hosts[2], hosts[0]]
+    assert names.lookup_prefix('ip', 'web') == [hosts[3], hosts[2], hosts[0], hosts[4]]
+
+def test_lookup_range_random():
+    # Enough keys to split and empty the blocks of the index, checked against a sorted list
+    rand = random.Random(21)
+    ct = container3.Container()
+    expected = {}
+    for i in range(5000):
+        if expected and rand.random() < 0.4:
+            node = expected.pop(rand.choice(list(expected)))
+            ct.remove(node)
+        else:
+            node = FlowNode(i, ip=rand.randrange(1000))
+            ct.add(node)
+            expected[i] = node
+        if i % 500 == 0:
+            bulk = [FlowNode(j, ip=rand.randrange(1000)) for j in range(10000 + i, 10200 + i)]
+            ct.add_many(bulk)
+            expected.update((node._name, node) for node in bulk)
+    ordered = sorted(expected.values(), key=lambda node: node.ip)
+    assert [node.ip for node in ct.lookup_range('ip')] == [node.ip for node in ordered]
+    for _ in range(100):
+        low = rand.randrange(1000)
+        high = low + rand.randrange(50)
+        assert set(ct.lookup_range('ip', low, high)) == {node for node in ordered if low <= node.ip <= high}
+
+def test_concurrent_writers():
+    ct = container3.ConcurrentContainer(datatype='ordered', stripes=8)
+    def _writer(base):
+        def _run():
+            for i in range(base, base + 500):
+                node = FlowNode(i, 'host{}'.format(i % 5), ip=i)
+                ct.add(node)
+                node.host = 'moved{}'.format(i % 3)
+                ct.updatekeys(node)
+                if i % 2:
+                    ct.remove(node)
+        return _run
+    def _reader():
+        for _ in range(200):
+            ct.lookup_range('ip', 0, 100)
+            ct.getall()
+    _run_threads(*[_writer(base) for base in range(0, 4000, 500)], _reader)
+    nodes = ct.getall()
+    assert len(ct) == len(nodes) == 2000
+    assert sorted(node._name for node in nodes) == list(range(0, 4000, 2))
+    assert ct.lookup('host0') is None
+    assert sum(len(ct.lookup('moved{}'.format(i))) for i in range(3)) == 2000
+    assert [node.ip for node in ct.lookup_range('ip')] == list(range(0, 4000, 2))
+
+def test_concurrent_maxsize():
+    ct = container3.ConcurrentContainer(maxsize=100, stripes=8)
+    nodes = [FlowNode(i, 'host{}'.format(i % 7)) for i in range(4000)]
+    def _adder(part):
+        return lambda: [ct.add(node) for node in nodes[part::4]]
+    _run_threads(*[_adder(part) for part in range(4)])
+    assert len(ct) == 100 and ct.stats()['evictions'] == 3900
+    assert sum(node.deleted for node in nodes) == 3900
+    assert all(not node.deleted for node in ct.getall())
+
+def test_concurrent_expire():
+    ct = container3.ConcurrentContainer(stripes=8)
+    nodes = [FlowNode(i, expires=i) for i in range(2000)]
+    ct.add_many(nodes[:1000])
+    expired = []
+    def _expirer():
+        for now in range(0, 2000, 50):
+            expired.extend(ct.expire(now=now))
+    def _adder():
+        for node in nodes[1000:]:
+            ct.add(node)
+    _run_threads(_expirer, _adder)
+    expired.extend(ct.expire(now=2000))
+    assert sorted(node._name for node in expired) == list(range(2000))
+    assert len(ct) == 0
+
+def test_concurrent_list_datatype():
+    with pytest.raises(Exception):
+        container3.ConcurrentContainer(datatype='list')
+
+def test_light_node():
+    a, b = FlowNode('a'), FlowNode('b')
+    assert not hasattr(a, '__dict__')
+    assert a._logger is b._logger
+    with pytest.raises(AttributeError):
+        a.undeclared = 1
+    copy = pickle.loads(pickle.dumps(a))
+    assert copy.lookupkeys() == a.lookupkeys() and copy._logger is a._logger
+
+def test_compact_keys():
+    ct = container3.Container(compact=True)
+    nodes = [FlowNode(i, 'host{}'.format(i % 2), ip=i) for i in range(6)]
+    ct.add(nodes[0])
+    ct.add_many(nodes[1:])
+    # The keys are stored flat, sharing the tuple of unique flags
+    keys = [ct._dict_id2keys[id(node)] for node in nodes]
+    assert keys[0] == ((True, False), 0, 'host0')
+    assert all(k[0] is keys[0][0] for k in keys)
+    assert ct.lookup(3) is nodes[3] and ct.lookup('host1') == {nodes[1], nodes[3], nodes[5]}
+    nodes[3]._name, nodes[3].host = 'three', 'host0'
+    ct.updatekeys(nodes[3])
+    assert ct.lookup(3) is None and ct.lookup('three') is nodes[3]
+    assert nodes[3] in ct.lookup('host0')
+    ct.remove(nodes[0])
+    ct.remove_many(nodes[1:3])
+    assert ct.lookup('host0') == {nodes[3], nodes[4]}
+    ct.removeall()
+    assert len(ct) == 0 and ct.lookup('host1') is None
+
+def test_snapshot_load(tmp_path, monkeypatch):
+    monkeypatch.setattr(container3, 'SNAPSHOT_CHUNK', 7)
+    path = str(tmp_path / 'snapshot')
+    source = container3.Container()
+    source.add_many(FlowNode(i, 'host{}'.format(i % 3), ip=i, expires=1000 + i if i % 2 else None) for i in range(50))
+    assert source.snapshot(path) == 50
+    assert list(tmp_path.iterdir()) == [tmp_path / 'snapshot']
+    ct = container3.Container(datatype='ordered')
+    assert ct.load(path) == 50
+    # Only the keys are read, a node is unpickled on its first lookup
+    assert all(type(node) is container3._SnapshotNode for node in ct._nodes)
+    node = ct.lookup(7)
+    assert type(node) is FlowNode and (node.host, node.ip, node.expires) == ('host1', 7, 1007)
+    assert ct.lookup(7) is node
+    assert list(ct._nodes)[-1] is node
+    assert sum(type(node) is container3._SnapshotNode for node in ct._nodes) == 49
+    assert len(ct.lookup('host1')) == 17
+    assert [node.ip for node in ct.lookup_range('ip', 10, 14)] == [10, 11, 12, 13, 14]
+    # The stored deadlines expire the nodes still loaded
+    expired = ct.expire(now=1010)
+    assert sorted(node.ip for node in expired) == [1, 3, 5, 7, 9]
+    assert all(type(node) is FlowNode and node.deleted for node in expired)
+    assert sorted(node.ip for node in ct.getall()) == [i for i in range(50) if i not in (1, 3, 5, 7, 9)]
+
+def test_snapshot_loaded(tmp_path):
+    # Snapshot of a loaded Container copies the pickled nodes
+    first, second = str(tmp_path / 'first'), str(tmp_path / 'second')
+    source = container3.Container()
+    source.add_many(FlowNode(i, ip=i) for i in range(10))
+    source.snapshot(first)
+    ct = container3.Container()
+    ct.load(first)
+    ct.lookup(3).host = 'changed'
+    assert ct.snapshot(second) == 10
+    assert sum(type(node) is container3._SnapshotNode for node in ct._nodes) == 9
+    copy = container3.Container()
+    copy.load(second)
+    assert copy.lookup(3).host == 'changed' and copy.lookup(4).host == 'host'
+
+def test_load_invalid(tmp_path):
+    path = tmp_path / 'invalid'
+    path.write_bytes(b'not a snapshot')
+    with pytest.raises(Exception):
+        container3.Container().load(str(path))
+
+def test_subscribe():
+    ct = container3.Container(maxsize=2)
+    seen = []
+    callback = lambda event, node: seen.append((event, node._name))
+    ct.subscribe(callback)
+    a, b, c, d = (FlowNode(name) for name in 'abcd')
+    ct.add(a)
+    ct.add_many([b])
+    a.host = 'other'
+    ct.updatekeys(a)
+    # The add of the new node comes before the remove of the evicted one
+    ct.add(c)
+    ct.add_many([d])
+    assert seen == [('add', 'a'), ('add', 'b'), ('updatekeys', 'a'),
+                    ('add', 'c'), ('remove', 'a'), ('add', 'd'), ('remove', 'b')]
+    del seen[:]
+    c.expires = 10
+    ct.reschedule(c)
+    ct.expire(now=20)
+    ct.remove(d)
+    ct.unsubscribe(callback)
+    ct.add(a)
+    assert seen == [('expire', 'c'), ('remove', 'd')]
+
+def test_subscribe_load(tmp_path):
+    # A load sends a single event, without unpickling the nodes
+    path = str(tmp_path / 'snapshot')
+    source = container3.Container()
+    source.add_many(FlowNode(i) for i in range(10))
+    source.snapshot(path)
+    ct = container3.Container()
+    seen = []
+    ct.subscribe(lambda event, node: seen.append((event, node)))
+    ct.load(path)
+    assert seen == [('load', None)]
+    assert all(type(node) is container3._SnapshotNode for node in ct._nodes)
+    node = ct.lookup(3)
+    ct.remove(node)
+    assert seen == [('load', None), ('remove', node)] and type(node) is FlowNode
+
+def test_events():
+    async def _main():
+        ct = container3.Container()
+        events = ct.events()
+        a, b, c = FlowNode('a'), FlowNode('b'), FlowNode('c')
+        # The pending events of a node are coalesced
+        ct.add(a)
+        ct.updatekeys(a)
+        ct.add(b)
+        ct.remove(b)
+        ct.add(c)
+        result = [await events.__anext__(), await events.__anext__()]
+        ct.remove(a)
+        ct.add(a)
+        result.append(await events.__anext__())
+        events.close()
+        result.extend([event async for event in events])
+        return result, a, c
+    result, a, c = asyncio.run(_main())
+    assert result == [('add', a), ('add', c), ('updatekeys', a)]
+
+def test_events_threads_overflow():
+    async def _main():
+        ct = container3.ConcurrentContainer()
+        events = ct.events(maxsize=10)
+        nodes = [FlowNode(i) for i in range(5)]
+        # The events of other threads wake up the consumer
+        thread = threading.Thread(target=ct.add_many, args=(nodes, ))
+        thread.start()
+        received = []
+        while len(received) < 5:
+            received.append(await asyncio.wait_for(events.__anext__(), 10))
+        thread.join()
+        thread = threading.Thread(target=ct.add_many, args=([FlowNode(i) for i in range(5, 20)], ))
+        thread.start()
+        thread.join()
+        overflow = await asyncio.wait_for(events.__anext__(), 10)
+        return received, nodes, overflow
+    received, nodes, overflow = asyncio.run(_main())
+    assert received == [('add', node) for node in nodes]
+    assert overflow == ('overflow', None)
+
+def test_concurrent_lookup_range_loaded(tmp_path):
+    # Unpickling the loaded nodes of a range lookup must not deadlock with writers
+    path = str(tmp_path / 'snapshot')
+    source = container3.Container()
+    source.add_many(FlowNode(i, 'host{}'.format(i % 4), ip=i) for i in range(2000))
+    source.snapshot(path)
+    ct = container3.ConcurrentContainer(stripes=4)
+    ct.load(path)
+    def _reader():
+        for low in range(0, 2000, 20):
+            assert [node.ip for node in ct.lookup_range('ip', low, low + 19)] == list(range(low, low + 20))
+    def _writer():
+        for i in range(2000, 4000):
+            node = FlowNode(i, 'host{}'.format(i % 4), ip=i)
+            ct.add(node)
+            ct.remove(node)
+    _run_threads(_reader, _writer)
+    assert len(ct) == 2000
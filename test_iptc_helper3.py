@@ -0,0 +1,296 @@
+"""
+Tests of iptc_helper3 on the memory backend, run with python -m pytest
+"""
+
+import io
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+import iptc_helper3
+
+@pytest.fixture
+def backend():
+    """ Fresh memory backend with an empty TEST chain in the filter table """
+    backend = iptc_helper3.set_backend('memory')
+    iptc_helper3.add_chain('filter', 'TEST')
+    yield backend
+    iptc_helper3.set_backend('memory')
+
+def _rule(n):
+    return {'src': '10.0.0.{}'.format(n), 'target': 'ACCEPT'}
+
+def test_coalescer_flushes_on_window(backend):
+    # A single write below count is flushed by the time window alone, on every flush
+    coalescer = iptc_helper3.WriteCoalescer(window=0.05, count=100)
+    try:
+        for n in range(3):
+            coalescer.add_rule('filter', 'TEST', _rule(n)).result(timeout=2)
+            assert iptc_helper3.has_rule('filter', 'TEST', _rule(n))
+        assert coalescer.flushes == 3
+    finally:
+        coalescer.close()
+
+def test_coalescer_flushes_in_order(backend, monkeypatch):
+    # A delete buffered while a flush of the caller applies its add is committed after it
+    coalescer = iptc_helper3.WriteCoalescer(window=0.01, count=100)
+    apply = coalescer._apply
+    caller = threading.current_thread()
+    def _slow_apply(pending):
+        if threading.current_thread() is caller:
+            time.sleep(0.2)
+        apply(pending)
+    monkeypatch.setattr(coalescer, '_apply', _slow_apply)
+    futures = []
+    def _delete():
+        time.sleep(0.05)
+        futures.append(coalescer.delete_rule('filter', 'TEST', _rule(1)))
+    thread = threading.Thread(target=_delete)
+    try:
+        added = coalescer.add_rule('filter', 'TEST', _rule(1))
+        thread.start()
+        coalescer.flush()
+        thread.join(timeout=2)
+        added.result(timeout=2)
+        futures[0].result(timeout=2)
+        assert not iptc_helper3.has_rule('filter', 'TEST', _rule(1))
+    finally:
+        coalescer.close()
+
+def test_transaction_isolated_from_other_threads(backend):
+    # Another thread waits for the end of the transaction and does not commit its changes
+    started, seen = threading.Event(), []
+    def _other():
+        started.wait()
+        seen.append(iptc_helper3.has_rule('filter', 'TEST', _rule(1)))
+        iptc_helper3.add_rule('filter', 'TEST', _rule(2))
+    thread = threading.Thread(target=_other)
+    thread.start()
+    with pytest.raises(ValueError):
+        with iptc_helper3.Transaction('filter'):
+            iptc_helper3.add_rule('filter', 'TEST', _rule(1))
+            started.set()
+            thread.join(timeout=0.2)
+            assert thread.is_alive()
+            raise ValueError('rollback')
+    thread.join(timeout=2)
+    assert seen == [False]
+    assert len(iptc_helper3.dump_chain('filter', 'TEST')) == 1
+    assert not iptc_helper3.has_rule('filter', 'TEST', _rule(1))
+    assert iptc_helper3.has_rule('filter', 'TEST', _rule(2))
+
+def test_rule_changed_outside(backend):
+    # The cached position of a rule is checked after the refresh of a chain changed by another process
+    for n in range(3):
+        iptc_helper3.add_rule('filter', 'TEST', _rule(n))
+    assert iptc_helper3.get_rule_position('filter', 'TEST', _rule(0)) == 0
+    chains, policies = backend.load('filter')
+    chains['TEST'].reverse()
+    backend.store('filter', chains, policies)
+    iptc_helper3.replace_rule('filter', 'TEST', _rule(0), _rule(9))
+    assert [iptc_helper3.get_rule_position('filter', 'TEST', _rule(n)) for n in (2, 1, 9)] == [0, 1, 2]
+    assert not iptc_helper3.has_rule('filter', 'TEST', _rule(0))
+    assert iptc_helper3.get_rule_statistics('filter', 'TEST', _rule(9)) == (0, 0)
+    del chains['TEST'][1:]
+    backend.store('filter', chains, policies)
+    with pytest.raises(AttributeError):
+        iptc_helper3.get_rule_statistics('filter', 'TEST', _rule(9))
+
+def test_batch_per_thread(backend):
+    # A batch defers the commits of its own thread only
+    iptc_helper3.add_chain('nat', 'TEST')
+    iptc_helper3.batch_begin('filter')
+    try:
+        iptc_helper3.add_rule('filter', 'TEST', _rule(1))
+        errors = []
+        def _other():
+            try:
+                iptc_helper3.batch_end()
+                iptc_helper3.add_rule('nat', 'TEST', _rule(2))
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=_other)
+        thread.start()
+        thread.join(timeout=2)
+        assert errors == []
+        assert len(backend.load('nat')[0]['TEST']) == 1
+        assert backend.load('filter')[0]['TEST'] == []
+    finally:
+        iptc_helper3.batch_end()
+    assert len(backend.load('filter')[0]['TEST']) == 1
+    assert iptc_helper3.has_rule('filter', 'TEST', _rule(1))
+
+def test_encode_cache_match_order(backend):
+    # Rules with the same matches in another order keep their own match order
+    tcp, comment = {'dport': '22'}, {'comment': 'ssh'}
+    iptc_helper3.add_rule('filter', 'TEST', {'protocol': 'tcp', 'tcp': tcp, 'comment': comment, 'target': 'ACCEPT'})
+    iptc_helper3.add_rule('filter', 'TEST', {'protocol': 'tcp', 'comment': comment, 'tcp': tcp, 'target': 'ACCEPT'})
+    assert [list(rule_d) for rule_d in iptc_helper3.dump_chain('filter', 'TEST')] == [
+        ['protocol', 'tcp', 'comment', 'target'], ['protocol', 'comment', 'tcp', 'target']]
+
+SAVE = """# Generated by iptables-save
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD DROP [0:0]
+:OUTPUT ACCEPT [0:0]
+:TEST - [0:0]
+[10:600] -A INPUT -s 10.0.0.0/8 ! -d 192.168.1.1/32 -i eth0 -p tcp -m tcp --dport 22 -m comment --comment "ssh \\"admin\\" access" -j ACCEPT
+[0:0] -A INPUT ! -s 10.1.0.0/16 -p tcp -m tcp --tcp-flags FIN,SYN,RST,ACK SYN -j DROP
+[0:0] -A INPUT -p tcp -m tcp ! --dport 80 -j REJECT --reject-with tcp-reset
+[3:180] -A FORWARD -j LOG --log-prefix "fw drop: " --log-level 4
+[0:0] -A TEST -m mark --mark 0x1/0xff -j MARK --set-xmark 0x2/0xff
+COMMIT
+"""
+
+POLICIES = {'INPUT': 'ACCEPT', 'FORWARD': 'DROP', 'OUTPUT': 'ACCEPT'}
+
+def test_parse_save():
+    chains_d = iptc_helper3.parse_save(SAVE)['filter']
+    assert list(chains_d) == ['INPUT', 'FORWARD', 'OUTPUT', 'TEST']
+    (ssh, syn, reject) = chains_d['INPUT']
+    assert ssh['src'] == '10.0.0.0/255.0.0.0'
+    assert ssh['dst'] == '!192.168.1.1'
+    assert ssh['comment'] == {'comment': 'ssh "admin" access'}
+    assert syn['src'] == '!10.1.0.0/255.255.0.0'
+    assert syn['tcp'] == {'tcp-flags': ['FIN,SYN,RST,ACK', 'SYN']}
+    assert reject['tcp'] == {'dport': ['!', '80']}
+    assert reject['target'] == {'REJECT': {'reject-with': 'tcp-reset'}}
+    assert chains_d['FORWARD'] == [{'target': {'LOG': {'log-prefix': 'fw drop: ', 'log-level': '4'}}}]
+    assert chains_d['TEST'] == [{'mark': {'mark': '0x1/0xff'}, 'target': {'MARK': {'set-xmark': '0x2/0xff'}}}]
+
+def test_parse_save_counters():
+    chains_d = iptc_helper3.parse_save(SAVE, counters=True)['filter']
+    assert [counters for (rule_d, counters) in chains_d['INPUT']] == [(10, 600), (0, 0), (0, 0)]
+    assert chains_d['FORWARD'][0][1] == (3, 180)
+
+@pytest.mark.parametrize('chain', ['INPUT', 'FORWARD', 'TEST'])
+def test_save_roundtrip_rules(chain):
+    # Every rule renders to arguments parsed back to the same rule_d
+    for rule_d in iptc_helper3.parse_save(SAVE)['filter'][chain]:
+        text = iptc_helper3.render_restore_rules('filter', [(chain, rule_d, 0)])
+        assert iptc_helper3.parse_save(text)['filter'][chain] == [rule_d]
+
+def test_save_roundtrip_table():
+    d = iptc_helper3.parse_save(SAVE)
+    text = iptc_helper3.render_restore_table('filter', d['filter'], policies=POLICIES)
+    assert iptc_helper3.parse_save(text) == d
+    # A second round trip renders the same text
+    assert iptc_helper3.render_restore_table('filter', iptc_helper3.parse_save(text)['filter'], policies=POLICIES) == text
+
+def test_restore_backend_policy_counters(tmp_path, monkeypatch):
+    # The policy counters read by iptables-save are kept by a commit and written by write_save
+    saved, restored = tmp_path / 'save', tmp_path / 'restore'
+    saved.write_text(SAVE.replace(':FORWARD DROP [0:0]', ':FORWARD DROP [12:3456]'))
+    monkeypatch.setattr(iptc_helper3, 'IPTABLES_SAVE',
+                        [sys.executable, '-c', 'import sys; sys.stdout.write(open(sys.argv[1]).read())', str(saved)])
+    monkeypatch.setattr(iptc_helper3, 'IPTABLES_RESTORE',
+                        [sys.executable, '-c', 'import sys; open(sys.argv[1], "w").write(sys.stdin.read())', str(restored)])
+    iptc_helper3.set_backend('restore')
+    try:
+        iptc_helper3.add_rule('filter', 'TEST', _rule(1))
+        text = restored.read_text()
+        assert ':FORWARD DROP [12:3456]' in text and ':INPUT ACCEPT [0:0]' in text and ':TEST - [0:0]' in text
+        f = io.StringIO()
+        iptc_helper3.write_save(f, 'filter')
+        assert ':FORWARD DROP [12:3456]\n' in f.getvalue() and ':TEST - [0:0]\n' in f.getvalue()
+    finally:
+        iptc_helper3.set_backend('memory')
+
+def _host(n):
+    # Rules as decoded from the table, desired states compare equal to them
+    return {'src': '10.0.0.{}/255.255.255.255'.format(n), 'target': 'ACCEPT'}
+
+@pytest.mark.parametrize('desired, ops', [
+    ([1, 2, 3], []),
+    ([1, 3], [('delete', 'TEST', 2, 2)]),
+    ([1, 4, 2, 3], [('insert', 'TEST', 2, 4)]),
+    ([1, 2, 3, 4], [('insert', 'TEST', 4, 4)]),
+    ([1, 5, 3], [('replace', 'TEST', 2, 5)]),
+])
+def test_reconcile_minimal(backend, desired, ops):
+    iptc_helper3.batch_add_rules('filter', [('TEST', _host(n), 0) for n in (1, 2, 3)])
+    commits = backend.commits
+    plan = iptc_helper3.reconcile({'TEST': [_host(n) for n in desired]}, 'filter')
+    assert plan == [(op, chain, position, _host(n)) for (op, chain, position, n) in ops]
+    assert iptc_helper3.dump_chain('filter', 'TEST') == [_host(n) for n in desired]
+    # A change is applied in a single commit, no change does not commit
+    assert backend.commits - commits == (1 if ops else 0)
+    assert iptc_helper3.reconcile({'TEST': [_host(n) for n in desired]}, 'filter') == []
+
+def test_reconcile_chains(backend):
+    iptc_helper3.add_chain('filter', 'OTHER')
+    iptc_helper3.add_rule('filter', 'OTHER', _host(9))
+    plan = iptc_helper3.reconcile({'NEW': [_host(1)]}, 'filter')
+    assert plan == [('add_chain', 'NEW', None, None), ('insert', 'NEW', 1, _host(1))]
+    # Chains not in desired are left untouched
+    assert iptc_helper3.dump_chain('filter', 'OTHER') == [_host(9)]
+
+def test_reconcile_dry_run(backend):
+    iptc_helper3.add_rule('filter', 'TEST', _host(1))
+    commits = backend.commits
+    assert iptc_helper3.reconcile({'TEST': []}, 'filter', dry_run=True) == [('delete', 'TEST', 1, _host(1))]
+    assert backend.commits == commits
+    assert iptc_helper3.dump_chain('filter', 'TEST') == [_host(1)]
+
+def _ssh(src):
+    return {'src': src, 'protocol': 'tcp', 'tcp': {'dport': '22'}, 'target': 'ACCEPT'}
+
+IPSET_RULES = [_ssh('10.0.0.1'), _ssh('10.0.0.2'),
+               {'src': '10.0.1.0/24', 'protocol': 'tcp', 'tcp': {'dport': '80'}, 'target': 'ACCEPT'},
+               _ssh('10.0.0.3'),
+               {'dst': '10.9.0.0/16', 'target': 'DROP'}, {'dst': '10.8.0.0/255.255.0.0', 'target': 'DROP'}]
+
+def test_compile_ipsets():
+    rules, sets = iptc_helper3.compile_ipsets(IPSET_RULES)
+    assert len(rules) == 4 and len(sets) == 2
+    (ssh, web, single, drop) = rules
+    (ssh_set, ssh_field) = ssh['set']['match-set']
+    assert ssh_field == 'src' and 'src' not in ssh
+    assert sets[ssh_set] == {'stype': 'hash:ip', 'family': socket.AF_INET, 'entries': ['10.0.0.1', '10.0.0.2']}
+    # Only consecutive rules are grouped
+    assert web == IPSET_RULES[2] and single == IPSET_RULES[3]
+    (drop_set, drop_field) = drop['set']['match-set']
+    assert drop_field == 'dst'
+    assert sets[drop_set] == {'stype': 'hash:net', 'family': socket.AF_INET, 'entries': ['10.9.0.0/16', '10.8.0.0/16']}
+    # Names are stable across compilations
+    assert iptc_helper3.compile_ipsets(IPSET_RULES) == (rules, sets)
+
+def test_compile_ipsets_reorder():
+    rules, sets = iptc_helper3.compile_ipsets(IPSET_RULES, reorder=True)
+    assert len(rules) == 3
+    assert sets[rules[0]['set']['match-set'][0]]['entries'] == ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+def test_compile_ipsets_min_size():
+    assert iptc_helper3.compile_ipsets(IPSET_RULES, min_size=3) == (IPSET_RULES, {})
+
+def test_compile_ipsets_ipv6():
+    rules, sets = iptc_helper3.compile_ipsets([{'src': '2001:db8::1', 'target': 'DROP'},
+                                               {'src': '2001:db8::2', 'target': 'DROP'}], ipv6=True)
+    (name, field) = rules[0]['set']['match-set']
+    assert sets[name] == {'stype': 'hash:ip', 'family': socket.AF_INET6, 'entries': ['2001:db8::1', '2001:db8::2']}
+    assert len(name) <= iptc_helper3.IPSET_MAXLEN
+
+def test_dual_batches_concurrent(backend, monkeypatch):
+    # Two dual-stack batches on the same table from two threads both complete
+    iptc_helper3.add_chain('filter', 'TEST', ipv6=True)
+    store = backend.store
+    def _slow_store(*args, **kwargs):
+        # Let the worker of the other batch run while this one commits
+        time.sleep(0.005)
+        store(*args, **kwargs)
+    monkeypatch.setattr(backend, 'store', _slow_store)
+    def _batch(base):
+        for n in range(base, base + 20):
+            iptc_helper3.batch_add_rules_dual('filter', [('TEST', _rule(n), 0),
+                                                         ('TEST', {'src': '2001:db8::{:x}'.format(n), 'target': 'ACCEPT'}, 0)])
+    threads = [threading.Thread(target=_batch, args=(base, ), daemon=True) for base in (0, 100)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    assert not any(thread.is_alive() for thread in threads), 'deadlock'
+    assert len(iptc_helper3.dump_chain('filter', 'TEST')) == 40
+    assert len(iptc_helper3.dump_chain('filter', 'TEST', ipv6=True)) == 40